@@ -396,6 +396,7 @@ $POWERPROXY_URL = "https://$(`
 Write-Host "🎉 PowerProxy has been deployed successfully and is ready to serve requests."
 Write-Host "Endpoint      : $POWERPROXY_URL"
 Write-Host "Liveness test : $POWERPROXY_URL/powerproxy/health/liveness"
+Write-Host "Readiness test: $POWERPROXY_URL/powerproxy/health/readiness"
 Write-Host "Enjoy!"
 
 #--------------------------------------------[Cleanup]----------------------------------------------
@@ -0,0 +1,87 @@
+"""Several methods and classes around letting requests wait for admission instead of rejecting them right away."""
+
+import asyncio
+import time
+
+from helpers.metrics import ADMISSION_QUEUE_DEPTH, ADMISSION_QUEUE_WAIT_SECONDS
+
+
+class AdmissionQueue:
+    """
+    Lets requests which cannot be admitted right away wait for admission, so short bursts do not end up in 429s.
+
+    Requests wait per key (e.g. client and virtual deployment) in the order in which they arrived. Only the first
+    request of a key retries to get admitted, once the time it was told to wait has passed but at least every
+    'poll_interval_ms'. A request is not queued if the queue of its key is full ('max_depth') or if it would have to
+    wait longer than 'max_wait_ms' anyway, and it leaves the queue once it becomes clear that it cannot be admitted
+    within 'max_wait_ms'. Queue depths and wait times are exported as metrics.
+    """
+
+    def __init__(self, name, max_wait_ms=5_000, max_depth=100, poll_interval_ms=100):
+        """Constructor."""
+        self.name = name
+        self.max_wait_ms = max_wait_ms
+        self.max_depth = max_depth
+        self.poll_interval_ms = poll_interval_ms
+        self.depths = {}
+        self.head_locks = {}
+
+    async def wait_for_admission(self, key, try_admit):
+        """
+        Let the request wait until it is admitted or it cannot be admitted in time.
+
+        try_admit is an async function trying to admit the request and returning the time in ms until the request
+        may be admitted (0 if it has been admitted). Returns the value returned by the last call to try_admit.
+        """
+        # note: requests only skip the queue if nobody is waiting for the same key, so waiting requests go first
+        retry_after_ms = None
+        depth = self.depths.get(key, 0)
+        if depth == 0 or depth >= self.max_depth:
+            retry_after_ms = await try_admit()
+            if retry_after_ms <= 0 or retry_after_ms > self.max_wait_ms or depth >= self.max_depth:
+                return retry_after_ms
+
+        # wait in the queue
+        start_time = time.monotonic()
+        deadline = start_time + self.max_wait_ms / 1_000
+        self.depths[key] = depth + 1
+        ADMISSION_QUEUE_DEPTH.labels(self.name).inc()
+        try:
+            head_lock = self.head_locks.setdefault(key, asyncio.Lock())
+            try:
+                await asyncio.wait_for(head_lock.acquire(), timeout=max(0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                retry_after_ms = await try_admit()
+                return retry_after_ms
+            try:
+                while True:
+                    if retry_after_ms is not None:
+                        await asyncio.sleep(
+                            min(retry_after_ms, self.poll_interval_ms, (deadline - time.monotonic()) * 1_000) / 1_000
+                        )
+                    retry_after_ms = await try_admit()
+                    if retry_after_ms <= 0 or retry_after_ms > (deadline - time.monotonic()) * 1_000:
+                        return retry_after_ms
+            finally:
+                head_lock.release()
+        finally:
+            self.depths[key] -= 1
+            if not self.depths[key]:
+                del self.depths[key]
+                del self.head_locks[key]
+            ADMISSION_QUEUE_DEPTH.labels(self.name).dec()
+            ADMISSION_QUEUE_WAIT_SECONDS.labels(
+                self.name, "admitted" if retry_after_ms is not None and retry_after_ms <= 0 else "rejected"
+            ).observe(time.monotonic() - start_time)
+
+    @staticmethod
+    def from_config(name, admission_queue_config):
+        """Return an admission queue for the given config, or None if the config does not enable it."""
+        if not admission_queue_config or not admission_queue_config.get("enabled", True):
+            return None
+        return AdmissionQueue(
+            name,
+            max_wait_ms=float(admission_queue_config.get("max_wait_ms", 5_000)),
+            max_depth=int(admission_queue_config.get("max_depth", 100)),
+            poll_interval_ms=float(admission_queue_config.get("poll_interval_ms", 100)),
+        )
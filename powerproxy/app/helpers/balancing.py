@@ -0,0 +1,145 @@
+"""Several methods and classes around balancing requests across AOAI targets."""
+
+from itertools import groupby
+
+from helpers.metrics import TARGET_OUTSTANDING_REQUESTS
+
+
+class LoadBalancer:
+    """
+    Decides in which order the targets for a virtual deployment (or the list of endpoints) are tried.
+
+    Targets are grouped into priority tiers ('priority', lower values are tried first, default: 0). Within a tier, the
+    strategy implemented by the subclass decides the order. Targets which are blocked or have reached their
+    'max_outstanding_requests' are skipped, so requests spill over to other targets before the target returns 429s.
+    """
+
+    strategy_name = None
+
+    def __init__(self, targets):
+        """Constructor."""
+        self.targets = tuple(targets)
+        self.tiers = tuple(
+            tuple(tier_targets)
+            for _, tier_targets in groupby(
+                sorted(self.targets, key=lambda target: target["priority"]), key=lambda target: target["priority"]
+            )
+        )
+
+    def get_ordered_targets(self, now_timestamp_ms):
+        """Return the targets available at the given time, in the order in which they should be tried."""
+        ordered_targets = []
+        for tier in self.tiers:
+            available_targets = [target for target in tier if is_target_available(target, now_timestamp_ms)]
+            if available_targets:
+                ordered_targets.extend(self._order_tier(available_targets))
+        return ordered_targets
+
+    def _order_tier(self, available_targets):
+        """Return the given available targets of a tier in the order in which they should be tried."""
+        raise NotImplementedError()
+
+    @staticmethod
+    def get_load_balancer(strategy_name, targets):
+        """Return a load balancer for the given strategy name and targets."""
+        load_balancer_class = next(
+            (
+                load_balancer_class
+                for load_balancer_class in LoadBalancer.__subclasses__()
+                if load_balancer_class.strategy_name == (strategy_name or FirstAvailableLoadBalancer.strategy_name)
+            ),
+            None,
+        )
+        if load_balancer_class is None:
+            raise ValueError(f"Load balancing strategy '{strategy_name}' is not supported.")
+        return load_balancer_class(targets)
+
+
+class FirstAvailableLoadBalancer(LoadBalancer):
+    """Tries the targets of a tier in the configured order (default)."""
+
+    strategy_name = "first_available"
+
+    def _order_tier(self, available_targets):
+        """Return the given available targets of a tier in the order in which they should be tried."""
+        return available_targets
+
+
+class SmoothWeightedRoundRobinLoadBalancer(LoadBalancer):
+    """
+    Distributes the requests within a tier proportionally to the targets' 'weight' (default: 1).
+
+    Uses the smooth weighted round robin algorithm known from nginx, which interleaves the targets instead of sending
+    bursts to the same target. Remaining targets follow in the order of their current weights for failover.
+    """
+
+    strategy_name = "smooth_weighted_round_robin"
+
+    def __init__(self, targets):
+        """Constructor."""
+        super().__init__(targets)
+        self.current_weights = {target["name"]: 0.0 for target in self.targets}
+
+    def _order_tier(self, available_targets):
+        """Return the given available targets of a tier in the order in which they should be tried."""
+        total_weight = 0.0
+        for target in available_targets:
+            self.current_weights[target["name"]] += target["weight"]
+            total_weight += target["weight"]
+        ordered_targets = sorted(
+            available_targets, key=lambda target: self.current_weights[target["name"]], reverse=True
+        )
+        self.current_weights[ordered_targets[0]["name"]] -= total_weight
+        return ordered_targets
+
+
+class LeastOutstandingRequestsLoadBalancer(LoadBalancer):
+    """
+    Prefers the targets within a tier with the fewest requests in flight, relative to their 'weight' (default: 1).
+
+    Ties are resolved by the configured order.
+    """
+
+    strategy_name = "least_outstanding_requests"
+
+    def _order_tier(self, available_targets):
+        """Return the given available targets of a tier in the order in which they should be tried."""
+        return sorted(
+            available_targets, key=lambda target: target["state"].get_outstanding_requests() / target["weight"]
+        )
+
+
+def is_target_available(target, now_timestamp_ms):
+    """Return True if the target is neither blocked by its circuit breaker nor at its limit of outstanding requests."""
+    return target["circuit_breaker"].is_request_permitted(now_timestamp_ms) and (
+        target["max_outstanding_requests"] is None
+        or target["state"].get_outstanding_requests() < target["max_outstanding_requests"]
+    )
+
+
+def get_ms_until_target_available(targets, now_timestamp_ms):
+    """
+    Return the time in ms until the first of the given targets is no longer blocked by its circuit breaker.
+
+    Returns None if a target is not blocked but at its limit of outstanding requests or of half-open probes, because it
+    is not known when a request in flight will finish.
+    """
+    blocked_until_timestamps_ms = []
+    for target in targets:
+        blocked_until_timestamp_ms = target["circuit_breaker"].get_blocked_until_timestamp_ms()
+        if blocked_until_timestamp_ms <= now_timestamp_ms:
+            return None
+        blocked_until_timestamps_ms.append(blocked_until_timestamp_ms)
+    return min(blocked_until_timestamps_ms) - now_timestamp_ms if blocked_until_timestamps_ms else None
+
+
+def acquire_target(target):
+    """Count a new request in flight at the given target."""
+    target["state"].add_outstanding_requests(1)
+    TARGET_OUTSTANDING_REQUESTS.labels(target["name"]).inc()
+
+
+def release_target(target):
+    """Count a request in flight at the given target as finished."""
+    target["state"].add_outstanding_requests(-1)
+    TARGET_OUTSTANDING_REQUESTS.labels(target["name"]).dec()
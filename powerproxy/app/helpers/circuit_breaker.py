@@ -0,0 +1,241 @@
+"""Several methods and classes around circuit breakers, ie. keeping requests away from failing AOAI targets."""
+
+from collections import deque
+
+from helpers.metrics import CIRCUIT_BREAKER_STATE, CIRCUIT_BREAKER_TRANSITIONS
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreakerSettings:
+    """Settings shared by the circuit breakers of all targets."""
+
+    def __init__(
+        self,
+        failure_rate_threshold=0.5,
+        slow_call_duration_ms=None,
+        slow_call_rate_threshold=0.8,
+        window_size=20,
+        min_calls=10,
+        base_open_ms=10_000,
+        max_open_ms=120_000,
+        half_open_max_probes=1,
+    ):
+        """Constructor."""
+        self.failure_rate_threshold = failure_rate_threshold
+        self.slow_call_duration_ms = slow_call_duration_ms
+        self.slow_call_rate_threshold = slow_call_rate_threshold
+        self.window_size = window_size
+        self.min_calls = min_calls
+        self.base_open_ms = base_open_ms
+        self.max_open_ms = max_open_ms
+        self.half_open_max_probes = half_open_max_probes
+
+    @staticmethod
+    def from_config(circuit_breaker_config):
+        """Return the settings for the given circuit breaker config, using defaults for anything not configured."""
+        circuit_breaker_config = circuit_breaker_config or {}
+        return CircuitBreakerSettings(
+            failure_rate_threshold=float(circuit_breaker_config.get("failure_rate_threshold", 0.5)),
+            slow_call_duration_ms=(
+                float(circuit_breaker_config["slow_call_duration_ms"])
+                if "slow_call_duration_ms" in circuit_breaker_config
+                else None
+            ),
+            slow_call_rate_threshold=float(circuit_breaker_config.get("slow_call_rate_threshold", 0.8)),
+            window_size=int(circuit_breaker_config.get("window_size", 20)),
+            min_calls=int(circuit_breaker_config.get("min_calls", 10)),
+            base_open_ms=int(circuit_breaker_config.get("base_open_ms", 10_000)),
+            max_open_ms=int(circuit_breaker_config.get("max_open_ms", 120_000)),
+            half_open_max_probes=int(circuit_breaker_config.get("half_open_max_probes", 1)),
+        )
+
+
+class CircuitBreaker:
+    """
+    Circuit breaker for a single AOAI target.
+
+    The breaker is 'closed' while the target is healthy and lets all requests through. It opens, ie. blocks the target,
+    - immediately if the target returns a retriable response (408, 429, 5xx) or cannot be reached, or
+    - if the failure rate or the rate of slow calls among the last calls exceeds its threshold.
+    The target is blocked for the time given by AOAI's 'retry-after-ms' header or, if not given, for an exponentially
+    growing time. Afterwards, the breaker is 'half_open' and lets a limited number of probe requests through. A
+    successful probe closes the breaker again, a failed probe opens it again. Only the outcomes of probes change the
+    state of an open or half-open breaker, responses to requests sent before the breaker opened do not.
+
+    The time until which the target is blocked, whether the breaker is open and the number of probes in flight are also
+    published to the target's state, which may be shared with other worker processes. A target blocked by the breaker of
+    any worker is blocked for all workers. Once the time has passed, the breakers of all workers are half-open until a
+    probe of any worker closes them, and the limit of probes applies to all workers together. While any worker has a
+    probe in flight, the other workers do not send requests to the target either.
+    """
+
+    def __init__(self, target_name, settings, target_state):
+        """Constructor."""
+        self.target_name = target_name
+        self.settings = settings
+        self.target_state = target_state
+        self.state = CLOSED
+        self.open_until_timestamp_ms = 0
+        self.consecutive_openings = 0
+        self.probes_in_flight = 0
+        self.outcomes = deque(maxlen=settings.window_size)
+        self.failures = 0
+        self.slow_calls = 0
+        CIRCUIT_BREAKER_STATE.labels(target_name).set(STATE_VALUES[CLOSED])
+
+    def is_request_permitted(self, now_timestamp_ms):
+        """Return True if a request could be sent to the target at the given time."""
+        if self.target_state.get_blocked_until_timestamp_ms() > now_timestamp_ms:
+            return False
+        probes_in_flight = self.target_state.get_probes_in_flight()
+        if self.state == CLOSED and not self.target_state.is_breaker_open():
+            return probes_in_flight == self.probes_in_flight
+        if self.state == OPEN and now_timestamp_ms < self.open_until_timestamp_ms:
+            return False
+        return probes_in_flight < self.settings.half_open_max_probes
+
+    def get_blocked_until_timestamp_ms(self):
+        """Return the time until which the target is blocked (a past time or 0 if it is not blocked)."""
+        return max(
+            self.target_state.get_blocked_until_timestamp_ms(),
+            self.open_until_timestamp_ms if self.state == OPEN else 0,
+        )
+
+    def try_acquire_permission(self, now_timestamp_ms):
+        """
+        Return a tuple (is_permitted, is_probe): whether a request may be sent to the target at the given time and
+        whether the request is a probe of the half-open breaker.
+
+        Each acquired permission needs to be followed by record_success, record_failure or release_permission, passing
+        is_probe along.
+        """
+        if self.target_state.get_blocked_until_timestamp_ms() > now_timestamp_ms:
+            return False, False
+        if self.state == OPEN and now_timestamp_ms >= self.open_until_timestamp_ms:
+            self._transition_to(HALF_OPEN)
+        self._sync_with_other_workers()
+        # note: probes of other workers' breakers are only visible in the target's state
+        probes_in_flight = self.target_state.get_probes_in_flight()
+        if self.state == CLOSED:
+            return probes_in_flight == self.probes_in_flight, False
+        if self.state == HALF_OPEN and probes_in_flight < self.settings.half_open_max_probes:
+            self.probes_in_flight += 1
+            self.target_state.set_probes_in_flight(self.probes_in_flight)
+            return True, True
+        return False, False
+
+    def release_permission(self, is_probe):
+        """Release a permission without outcome, e.g. because the request was cancelled."""
+        if is_probe and self.probes_in_flight > 0:
+            self.probes_in_flight -= 1
+            self.target_state.set_probes_in_flight(self.probes_in_flight)
+
+    def record_success(self, now_timestamp_ms, duration_ms, is_probe=False):
+        """Record a request to the target which succeeded after the given duration."""
+        is_slow = self.settings.slow_call_duration_ms is not None and duration_ms > self.settings.slow_call_duration_ms
+        if is_probe:
+            self.release_permission(is_probe)
+            if self.state == HALF_OPEN:
+                if is_slow:
+                    self._open(now_timestamp_ms)
+                else:
+                    self._close()
+                return
+        if self.state != CLOSED:
+            # note: requests sent before the breaker opened are no probes and must not close it
+            return
+        self._record_outcome(False, is_slow)
+        self._open_if_threshold_exceeded(now_timestamp_ms)
+
+    def record_failure(self, now_timestamp_ms, retry_after_ms=None, is_retriable=True, is_probe=False):
+        """
+        Record a failed request to the target.
+
+        Retriable failures (e.g. 429 or the target not reachable) open the breaker immediately, for retry_after_ms if
+        given. Other failures only count towards the failure rate. Failed probes always open a half-open breaker.
+        """
+        if is_probe:
+            self.release_permission(is_probe)
+            if self.state == HALF_OPEN:
+                self._open(now_timestamp_ms, retry_after_ms)
+                return
+        if self.state == HALF_OPEN:
+            # note: requests sent before the breaker opened are no probes and must not open it again
+            return
+        if self.state == OPEN:
+            # note: requests sent before the breaker opened do not extend the backoff, only AOAI's retry-after-ms
+            if retry_after_ms is not None:
+                self.open_until_timestamp_ms = max(self.open_until_timestamp_ms, now_timestamp_ms + retry_after_ms)
+                self.target_state.set_blocked_until_timestamp_ms(self.open_until_timestamp_ms)
+            return
+        self._record_outcome(True, False)
+        if is_retriable:
+            self._open(now_timestamp_ms, retry_after_ms)
+        else:
+            self._open_if_threshold_exceeded(now_timestamp_ms)
+
+    def _sync_with_other_workers(self):
+        """Adopt openings and closings by the breakers of other workers, only visible in the target's state."""
+        is_breaker_open = self.target_state.is_breaker_open()
+        if self.state == CLOSED and is_breaker_open:
+            # note: another worker opened the breaker and the target is not blocked anymore, so probes decide
+            self._transition_to(HALF_OPEN)
+        elif self.state != CLOSED and not is_breaker_open:
+            # note: a probe of another worker closed the breaker
+            self._close(is_closed_by_this_worker=False)
+
+    def _record_outcome(self, is_failure, is_slow):
+        """Add the outcome of a call to the window of recent calls."""
+        if len(self.outcomes) == self.outcomes.maxlen:
+            dropped_is_failure, dropped_is_slow = self.outcomes[0]
+            self.failures -= dropped_is_failure
+            self.slow_calls -= dropped_is_slow
+        self.outcomes.append((is_failure, is_slow))
+        self.failures += is_failure
+        self.slow_calls += is_slow
+
+    def _open_if_threshold_exceeded(self, now_timestamp_ms):
+        """Open the breaker if the failure rate or the rate of slow calls exceeds its threshold."""
+        calls = len(self.outcomes)
+        if self.state != CLOSED or calls < self.settings.min_calls:
+            return
+        if self.failures / calls >= self.settings.failure_rate_threshold or (
+            self.settings.slow_call_duration_ms is not None
+            and self.slow_calls / calls >= self.settings.slow_call_rate_threshold
+        ):
+            self._open(now_timestamp_ms)
+
+    def _open(self, now_timestamp_ms, retry_after_ms=None):
+        """Open the breaker for the given time or, if not given, for an exponentially growing time."""
+        if retry_after_ms is None:
+            retry_after_ms = min(
+                self.settings.max_open_ms, self.settings.base_open_ms * 2**self.consecutive_openings
+            )
+        self.consecutive_openings += 1
+        self.open_until_timestamp_ms = max(self.open_until_timestamp_ms, now_timestamp_ms + retry_after_ms)
+        self.target_state.set_blocked_until_timestamp_ms(self.open_until_timestamp_ms)
+        if self.state != OPEN:
+            self.target_state.mark_breaker_opened()
+            self._transition_to(OPEN)
+
+    def _close(self, is_closed_by_this_worker=True):
+        """Close the breaker, forgetting all previous calls."""
+        self.consecutive_openings = 0
+        self.outcomes.clear()
+        self.failures = 0
+        self.slow_calls = 0
+        self.target_state.set_blocked_until_timestamp_ms(0)
+        if is_closed_by_this_worker:
+            self.target_state.mark_breaker_closed()
+        self._transition_to(CLOSED)
+
+    def _transition_to(self, state):
+        """Change to the given state and update the metrics."""
+        CIRCUIT_BREAKER_TRANSITIONS.labels(self.target_name, self.state, state).inc()
+        CIRCUIT_BREAKER_STATE.labels(self.target_name).set(STATE_VALUES[state])
+        self.state = state
@@ -22,9 +22,12 @@ class Configuration:
             if "uses_entra_id_auth" in client and client["uses_entra_id_auth"]:
                 self.entra_id_client = client
         self.key_client_map = {client["key"]: client["name"] for client in self.get("clients") if "key" in client}
-        if 'opensource_deployments' in client:
-            self.opensource_deployments = client['opensource_deployments']
-            print("opensource_deployments",self.opensource_deployments)
+        # deployments which are requested via the 'model' field in the body instead of the path
+        self.opensource_deployments = frozenset(
+            deployment
+            for client in self.get("clients")
+            for deployment in client.get("opensource_deployments", [])
+        )
         self.plugin_names = [plugin["name"] for plugin in self.get("plugins") or []]
         self.plugins = [
             PowerProxyPlugin.get_plugin_instance(plugin_config["name"], self, QueryDict(plugin_config))
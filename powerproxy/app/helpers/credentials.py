@@ -0,0 +1,101 @@
+"""Several methods and classes around credentials for Azure services."""
+
+import asyncio
+import threading
+import time
+
+from azure.identity import DefaultAzureCredential
+
+COGNITIVE_SERVICES_SCOPE = "https://cognitiveservices.azure.com/.default"
+
+# token provider wrapping a DefaultAzureCredential, shared by PowerProxy and plugins. see get_default_token_provider.
+default_token_provider = None
+
+
+class CachedTokenProvider:
+    """
+    Caches the access tokens of a (synchronous) Azure credential until shortly before they expire.
+
+    Within the event loop, use get_token_async: a cached token is returned immediately while it is valid, and tokens
+    which are about to expire are refreshed in the background on a worker thread. Concurrent refreshes for the same
+    scopes are combined into one. Requests only wait for the credential if there is no valid token at all, ie. for the
+    very first token or if refreshing has failed until expiry.
+
+    Also implements get_token (the azure-core TokenCredential protocol), so it can be passed as a credential to Azure
+    SDK clients used outside of the event loop.
+    """
+
+    def __init__(self, credential, refresh_margin_seconds=300, min_validity_seconds=30):
+        """
+        Constructor.
+
+        Tokens are refreshed in the background once they expire in less than refresh_margin_seconds. Tokens expiring in
+        less than min_validity_seconds are not handed out anymore.
+        """
+        self.credential = credential
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.min_validity_seconds = min_validity_seconds
+        self.tokens = {}
+        self.refresh_tasks = {}
+        self.lock = threading.Lock()
+
+    async def get_token_async(self, *scopes):
+        """Return an access token for the given scopes, without blocking the event loop."""
+        token = self.tokens.get(scopes)
+        seconds_to_expiry = token.expires_on - time.time() if token else 0
+        if seconds_to_expiry > self.refresh_margin_seconds:
+            return token
+        if seconds_to_expiry > self.min_validity_seconds:
+            self._get_refresh_task(scopes)
+            return token
+        return await asyncio.shield(self._get_refresh_task(scopes))
+
+    def get_token(self, *scopes, **kwargs):  # pylint: disable=unused-argument
+        """Return an access token for the given scopes, blocking until it is available if not cached."""
+        token = self.tokens.get(scopes)
+        if token and token.expires_on - time.time() > self.refresh_margin_seconds:
+            return token
+        return self._fetch_token(scopes)
+
+    def close(self):
+        """Cancel pending refreshes and close the wrapped credential."""
+        for refresh_task in self.refresh_tasks.values():
+            refresh_task.cancel()
+        self.refresh_tasks.clear()
+        if hasattr(self.credential, "close"):
+            self.credential.close()
+
+    def _get_refresh_task(self, scopes):
+        """Return the task refreshing the token for the given scopes, starting a new one if none is running."""
+        refresh_task = self.refresh_tasks.get(scopes)
+        if refresh_task is None:
+            refresh_task = self.refresh_tasks[scopes] = asyncio.create_task(
+                asyncio.to_thread(self._fetch_token, scopes)
+            )
+            refresh_task.add_done_callback(lambda task: self._on_refresh_task_done(scopes, task))
+        return refresh_task
+
+    def _on_refresh_task_done(self, scopes, refresh_task):
+        """Forget the finished refresh task for the given scopes, reporting failed refreshes."""
+        if self.refresh_tasks.get(scopes) is refresh_task:
+            del self.refresh_tasks[scopes]
+        if not refresh_task.cancelled() and refresh_task.exception():
+            print(f"Could not refresh access token for scopes {scopes}: {refresh_task.exception()}")
+
+    def _fetch_token(self, scopes):
+        """Get a new token for the given scopes from the wrapped credential and cache it."""
+        with self.lock:
+            # note: another thread may have fetched a new token while waiting for the lock
+            token = self.tokens.get(scopes)
+            if token and token.expires_on - time.time() > self.refresh_margin_seconds:
+                return token
+            token = self.tokens[scopes] = self.credential.get_token(*scopes)
+            return token
+
+
+def get_default_token_provider():
+    """Return the token provider wrapping a DefaultAzureCredential, creating it on first use."""
+    global default_token_provider  # pylint: disable=global-statement
+    if default_token_provider is None:
+        default_token_provider = CachedTokenProvider(DefaultAzureCredential())
+    return default_token_provider
@@ -0,0 +1,135 @@
+"""Several methods and classes around sharing the capacity of AOAI targets fairly among clients."""
+
+from helpers.metrics import FAIR_SHARE_SPILLED_REQUESTS
+
+
+class FairShareScheduler:
+    """
+    Shares the capacity of the first priority tier of each virtual deployment (e.g. its PTU standins) among clients.
+
+    The capacity of a tier is the sum of its targets' 'max_outstanding_requests' (tiers with a target without such a
+    limit are not scheduled). Each client gets a share of the capacity proportional to its 'fair_share_weight'
+    (default: 1), among the clients which are active, ie. which have requests in flight at the tier or have sent a
+    request within 'activity_window_ms'. Shares of idle clients go to the active ones, so the tier can be used fully
+    even by a single client.
+
+    A client below its share may always use the tier. A client at or above its share may only use the capacity which
+    the other active clients below their share are not entitled to. Otherwise, its requests skip the tier and spill over
+    to the next tier (e.g. pay-as-you-go standins), so clients sending few requests are not starved by clients sending
+    many.
+
+    The requests in flight and the times of the last requests per virtual deployment and client are kept in the
+    targets' state (see TargetStates), which may be shared with other worker processes, so the shares apply to all
+    workers together. As workers check and count requests without locking each other, the shares are approximate: a
+    client may briefly exceed its share if several workers admit its requests at the same time.
+    """
+
+    def __init__(self, client_weights, fair_share_states, activity_window_ms=10_000):
+        """
+        Constructor.
+
+        The fair share states map virtual deployments (None for the targets without virtual deployment) to dicts
+        mapping the clients to their fair share state.
+        """
+        self.client_weights = client_weights
+        self.fair_share_states = fair_share_states
+        self.activity_window_ms = activity_window_ms
+
+    def is_tier_permitted(self, virtual_deployment, client, tier_targets, now_timestamp_ms):
+        """Return True if a request of the given client may use the given first tier of the given virtual deployment."""
+        capacity = self.get_capacity(tier_targets)
+        fair_share_states = self.get_fair_share_states(virtual_deployment)
+        if capacity is None or client not in fair_share_states:
+            return True
+        fair_share_states[client].set_last_request_timestamp_ms(now_timestamp_ms)
+
+        # get the clients which are active, ie. which have requests in flight or have sent a request recently
+        requests_in_flight = {
+            active_client: fair_share_state.get_requests_in_flight()
+            for active_client, fair_share_state in fair_share_states.items()
+        }
+        active_clients = [
+            active_client
+            for active_client, fair_share_state in fair_share_states.items()
+            if requests_in_flight[active_client]
+            or now_timestamp_ms - fair_share_state.get_last_request_timestamp_ms() <= self.activity_window_ms
+        ]
+
+        # check if the client is below its share or if there is capacity the other clients are not entitled to
+        total_weight = sum(self.get_weight(active_client) for active_client in active_clients)
+        if requests_in_flight[client] < capacity * self.get_weight(client) / total_weight:
+            return True
+        unused_shares_of_other_clients = sum(
+            max(0, capacity * self.get_weight(active_client) / total_weight - requests_in_flight[active_client])
+            for active_client in active_clients
+            if active_client != client
+        )
+        if capacity - sum(requests_in_flight.values()) > unused_shares_of_other_clients:
+            return True
+        FAIR_SHARE_SPILLED_REQUESTS.labels(virtual_deployment, client).inc()
+        return False
+
+    def acquire(self, virtual_deployment, client):
+        """Count a new request of the given client in flight at the first tier of the given virtual deployment."""
+        fair_share_state = self.get_fair_share_states(virtual_deployment).get(client)
+        if fair_share_state:
+            fair_share_state.add_requests_in_flight(1)
+
+    def release(self, virtual_deployment, client):
+        """Count a request of the given client in flight at the first tier of the given virtual deployment as done."""
+        fair_share_state = self.get_fair_share_states(virtual_deployment).get(client)
+        if fair_share_state:
+            fair_share_state.add_requests_in_flight(-1)
+
+    def get_fair_share_states(self, virtual_deployment):
+        """Return the fair share states of the clients at the given virtual deployment."""
+        # note: requests for deployments which are not virtual all go to the targets without virtual deployment
+        return self.fair_share_states.get(virtual_deployment) or self.fair_share_states.get(None, {})
+
+    def get_weight(self, client):
+        """Return the weight of the given client."""
+        return self.client_weights.get(client, 1.0)
+
+    @staticmethod
+    def get_capacity(tier_targets):
+        """Return the requests the given targets can have in flight together, or None if that is not limited."""
+        if any(target["max_outstanding_requests"] is None for target in tier_targets):
+            return None
+        return sum(target["max_outstanding_requests"] for target in tier_targets)
+
+    @staticmethod
+    def get_fair_share_keys(fair_share_config, clients_config, virtual_deployment_names):
+        """
+        Return the (virtual deployment, client) tuples to keep fair share states for in the targets' state, or an empty
+        list if fair sharing is not enabled.
+        """
+        if not fair_share_config or not fair_share_config.get("enabled", True):
+            return []
+        return [
+            (virtual_deployment, client_config["name"])
+            for virtual_deployment in [None, *sorted(virtual_deployment_names)]
+            for client_config in clients_config
+        ]
+
+    @staticmethod
+    def from_config(fair_share_config, clients_config, target_states):
+        """
+        Return a fair share scheduler for the given config, keeping its state in the given target states (see
+        get_fair_share_keys), or None if fair sharing is not enabled.
+        """
+        if not fair_share_config or not fair_share_config.get("enabled", True):
+            return None
+        fair_share_states = {}
+        for virtual_deployment, client in target_states.fair_share_key_indexes:
+            fair_share_states.setdefault(virtual_deployment, {})[client] = target_states.get_fair_share_state(
+                virtual_deployment, client
+            )
+        return FairShareScheduler(
+            {
+                client_config["name"]: float(client_config["fair_share_weight"])
+                for client_config in clients_config
+                if "fair_share_weight" in client_config
+            },
+            fair_share_states,
+            activity_window_ms=float(fair_share_config.get("activity_window_ms", 10_000)),
+        )
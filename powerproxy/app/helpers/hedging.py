@@ -0,0 +1,85 @@
+"""Several methods and classes around hedging requests, ie. sending slow requests to a second target."""
+
+from collections import deque
+
+
+class HedgingPolicy:
+    """
+    Decides when a slow non-streaming request is also sent to the next eligible target ("hedged").
+
+    The delay before hedging is either fixed ('delay_ms') or the given percentile of the latencies recently observed
+    for the virtual deployment ('delay_percentile'), using the fixed delay until enough latencies have been observed.
+    To cap the extra load, hedges earn a budget of 'max_hedged_fraction' per request, ie. a value of 0.1 allows at most
+    one hedge per ten requests on average.
+    """
+
+    def __init__(
+        self,
+        delay_ms=None,
+        delay_percentile=None,
+        max_hedged_fraction=0.1,
+        latency_window_size=200,
+        min_latency_samples=20,
+        max_budget=10,
+    ):
+        """Constructor."""
+        self.delay_ms = delay_ms
+        self.delay_percentile = delay_percentile
+        self.max_hedged_fraction = max_hedged_fraction
+        self.latency_window_size = latency_window_size
+        self.min_latency_samples = min_latency_samples
+        self.max_budget = max_budget
+        self.latencies_ms = {}
+        self.latency_sample_counts = {}
+        self.percentile_delays_ms = {}
+        self.budgets = {}
+
+    def get_delay_seconds(self, virtual_deployment):
+        """
+        Return the seconds to wait for a response before hedging a request for the given virtual deployment.
+
+        Also credits the hedging budget for the virtual deployment, so this needs to be called once per request.
+        """
+        self.budgets[virtual_deployment] = min(
+            self.max_budget, self.budgets.get(virtual_deployment, 0.0) + self.max_hedged_fraction
+        )
+        delay_ms = self.percentile_delays_ms.get(virtual_deployment, self.delay_ms)
+        return delay_ms / 1_000 if delay_ms is not None else None
+
+    def try_consume_budget(self, virtual_deployment):
+        """Return True and consume budget if another hedge is allowed for the given virtual deployment."""
+        if self.budgets.get(virtual_deployment, 0.0) < 1:
+            return False
+        self.budgets[virtual_deployment] -= 1
+        return True
+
+    def record_latency(self, virtual_deployment, latency_ms):
+        """Record the latency of a successful non-streaming request for the given virtual deployment."""
+        if self.delay_percentile is None:
+            return
+        latencies_ms = self.latencies_ms.get(virtual_deployment)
+        if latencies_ms is None:
+            latencies_ms = self.latencies_ms[virtual_deployment] = deque(maxlen=self.latency_window_size)
+        latencies_ms.append(latency_ms)
+        self.latency_sample_counts[virtual_deployment] = self.latency_sample_counts.get(virtual_deployment, 0) + 1
+        # note: the percentile is recomputed every few samples only, so recording stays cheap
+        if (
+            len(latencies_ms) >= self.min_latency_samples
+            and self.latency_sample_counts[virtual_deployment] % 10 == 0
+        ):
+            sorted_latencies_ms = sorted(latencies_ms)
+            index = min(len(sorted_latencies_ms) - 1, int(len(sorted_latencies_ms) * self.delay_percentile / 100))
+            self.percentile_delays_ms[virtual_deployment] = sorted_latencies_ms[index]
+
+    @staticmethod
+    def from_config(hedging_config):
+        """Return a hedging policy for the given hedging config, or None if hedging is not enabled."""
+        if not hedging_config or not hedging_config.get("enabled", True):
+            return None
+        return HedgingPolicy(
+            delay_ms=float(hedging_config["delay_ms"]) if "delay_ms" in hedging_config else None,
+            delay_percentile=(
+                float(hedging_config["delay_percentile"]) if "delay_percentile" in hedging_config else None
+            ),
+            max_hedged_fraction=float(hedging_config.get("max_hedged_fraction", 0.1)),
+        )
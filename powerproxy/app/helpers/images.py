@@ -0,0 +1,117 @@
+"""Several methods around images sent in requests."""
+
+import binascii
+import math
+import re
+from base64 import b64decode
+
+# tokens used by an image, as documented for OpenAI's vision models: a base amount and an amount per 512px tile
+# note: images with detail 'low' only use the base tokens
+IMAGE_BASE_TOKENS = 85
+IMAGE_TILE_TOKENS = 170
+IMAGE_TILE_SIZE = 512
+# size to which images with detail 'high' are scaled: to fit into the max. size, then the shorter side to the min. size
+IMAGE_MAX_SIZE = 2048
+IMAGE_MIN_SIZE = 768
+# size assumed for images whose size cannot be determined, e.g. images referenced by URL
+DEFAULT_IMAGE_SIZE = (1024, 1024)
+
+# numbers of base64 characters decoded to find the size of an image, the larger one only if the smaller one is not
+# enough (e.g. JPEGs may have up to 64 KB of metadata before the frame header containing the size)
+BASE64_CHARACTERS_FOR_IMAGE_SIZE = (1_024, 96 * 1_024)
+
+DATA_URL_PATTERN = re.compile(r"data:[^;,]*(;[^;,]*)*;base64,")
+
+
+def estimate_image_tokens(image_url):
+    """
+    Return the estimated number of tokens used by the given 'image_url' content part value.
+
+    Only the headers of images sent as base64 data URL are decoded to get their size, the image data is never decoded.
+    """
+    if not isinstance(image_url, dict):
+        image_url = {"url": image_url}
+    if image_url.get("detail") == "low":
+        return IMAGE_BASE_TOKENS
+    width, height = get_image_size_from_url(image_url.get("url")) or DEFAULT_IMAGE_SIZE
+    return IMAGE_BASE_TOKENS + IMAGE_TILE_TOKENS * get_image_tile_count(width, height)
+
+
+def get_image_tile_count(width, height):
+    """Return the number of tiles of an image with the given size, after scaling it like detail 'high' does."""
+    if width <= 0 or height <= 0:
+        return 1
+    if max(width, height) > IMAGE_MAX_SIZE:
+        scale = IMAGE_MAX_SIZE / max(width, height)
+        width, height = width * scale, height * scale
+    if min(width, height) > IMAGE_MIN_SIZE:
+        scale = IMAGE_MIN_SIZE / min(width, height)
+        width, height = width * scale, height * scale
+    return math.ceil(width / IMAGE_TILE_SIZE) * math.ceil(height / IMAGE_TILE_SIZE)
+
+
+def get_image_size_from_url(url):
+    """Return the size (width, height) of the image in the given base64 data URL, or None if it cannot be determined."""
+    if not isinstance(url, str):
+        return None
+    data_url_match = DATA_URL_PATTERN.match(url)
+    if not data_url_match:
+        return None
+    start = data_url_match.end()
+    for base64_characters in BASE64_CHARACTERS_FOR_IMAGE_SIZE:
+        # note: base64 is decoded in groups of 4 characters
+        end = start + min(base64_characters, (len(url) - start) // 4 * 4)
+        try:
+            image_size = get_image_size(b64decode(url[start:end]))
+        except (binascii.Error, ValueError):
+            return None
+        if image_size or end == len(url):
+            return image_size
+    return None
+
+
+def get_image_size(header):
+    """Return the size (width, height) of the image starting with the given bytes, or None if it is not known."""
+    if header.startswith(b"\x89PNG\r\n\x1a\n") and len(header) >= 24:
+        return int.from_bytes(header[16:20], "big"), int.from_bytes(header[20:24], "big")
+    if header[:6] in (b"GIF87a", b"GIF89a") and len(header) >= 10:
+        return int.from_bytes(header[6:8], "little"), int.from_bytes(header[8:10], "little")
+    if header.startswith(b"\xff\xd8"):
+        return get_jpeg_size(header)
+    if header[:4] == b"RIFF" and header[8:12] == b"WEBP":
+        return get_webp_size(header)
+    return None
+
+
+def get_jpeg_size(header):
+    """Return the size (width, height) from the frame header of a JPEG, or None if not found in the given bytes."""
+    position = 2
+    while position + 9 <= len(header):
+        if header[position] != 0xFF:
+            return None
+        marker = header[position + 1]
+        # note: markers without payload, and fill bytes
+        if marker == 0xFF or marker in (0x01, 0xD8) or 0xD0 <= marker <= 0xD7:
+            position += 1 if marker == 0xFF else 2
+            continue
+        # note: start of frame markers, except DHT (0xC4), JPG (0xC8) and DAC (0xCC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return (
+                int.from_bytes(header[position + 7 : position + 9], "big"),
+                int.from_bytes(header[position + 5 : position + 7], "big"),
+            )
+        position += 2 + int.from_bytes(header[position + 2 : position + 4], "big")
+    return None
+
+
+def get_webp_size(header):
+    """Return the size (width, height) of a WebP image, or None if not found in the given bytes."""
+    chunk_type = header[12:16]
+    if chunk_type == b"VP8X" and len(header) >= 30:
+        return int.from_bytes(header[24:27], "little") + 1, int.from_bytes(header[27:30], "little") + 1
+    if chunk_type == b"VP8L" and len(header) >= 25:
+        bits = int.from_bytes(header[21:25], "little")
+        return (bits & 0x3FFF) + 1, ((bits >> 14) & 0x3FFF) + 1
+    if chunk_type == b"VP8 " and len(header) >= 30:
+        return int.from_bytes(header[26:28], "little") & 0x3FFF, int.from_bytes(header[28:30], "little") & 0x3FFF
+    return None
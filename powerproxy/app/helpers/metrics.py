@@ -0,0 +1,89 @@
+"""Declares PowerProxy-specific metrics, exposed at /metrics next to the default HTTP metrics."""
+
+from prometheus_client import Counter, Gauge, Histogram
+
+PLUGIN_HOOK_DURATION_SECONDS = Histogram(
+    "powerproxy_plugin_hook_duration_seconds",
+    "Time spent in plugin hooks, by plugin, hook and execution mode (sync, async or blocking).",
+    ["plugin", "hook", "mode"],
+    buckets=(0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5),
+)
+
+TARGET_OUTSTANDING_REQUESTS = Gauge(
+    "powerproxy_target_outstanding_requests",
+    "Requests currently in flight at an AOAI target (endpoint or virtual deployment standin).",
+    ["target"],
+)
+
+HEDGED_REQUESTS_FIRED = Counter(
+    "powerproxy_hedged_requests_fired",
+    "Non-streaming requests which were sent to a second target because the first target was too slow.",
+    ["virtual_deployment"],
+)
+
+HEDGED_REQUESTS_WON = Counter(
+    "powerproxy_hedged_requests_won",
+    "Hedged requests where the second target responded first.",
+    ["virtual_deployment"],
+)
+
+CIRCUIT_BREAKER_STATE = Gauge(
+    "powerproxy_circuit_breaker_state",
+    "State of the circuit breaker of an AOAI target (0: closed, 1: half open, 2: open).",
+    ["target"],
+)
+
+CIRCUIT_BREAKER_TRANSITIONS = Counter(
+    "powerproxy_circuit_breaker_transitions",
+    "State transitions of the circuit breakers of AOAI targets.",
+    ["target", "from_state", "to_state"],
+)
+
+LIMIT_USAGE_STORAGE_FAILURES = Counter(
+    "powerproxy_limit_usage_storage_failures",
+    "Failed reads and updates of the usage tracked by the LimitUsage plugin, by operation (read or update).",
+    ["operation"],
+)
+
+LIMIT_USAGE_LEASE_OPERATIONS = Counter(
+    "powerproxy_limit_usage_lease_operations",
+    "Operations on the usage storage by the LimitUsage plugin's budget leasing, by operation (claim or return).",
+    ["operation"],
+)
+
+LIMIT_USAGE_OVERSHOOT_TOKENS = Counter(
+    "powerproxy_limit_usage_overshoot_tokens",
+    "Tokens used beyond the budget slices leased by this worker (LimitUsage plugin with budget leasing).",
+)
+
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "powerproxy_admission_queue_depth",
+    "Requests currently waiting for admission, by queue (limit_usage or targets).",
+    ["queue"],
+)
+
+ADMISSION_QUEUE_WAIT_SECONDS = Histogram(
+    "powerproxy_admission_queue_wait_seconds",
+    "Time requests waited for admission, by queue and outcome (admitted or rejected).",
+    ["queue", "outcome"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+
+FAIR_SHARE_SPILLED_REQUESTS = Counter(
+    "powerproxy_fair_share_spilled_requests",
+    "Requests which skipped the first priority tier of a virtual deployment because their client was above its share.",
+    ["virtual_deployment", "client"],
+)
+
+STARTUP_DURATION_SECONDS = Gauge(
+    "powerproxy_startup_duration_seconds",
+    "Time the last startup of this worker took, by phase (startup or tokenizer_warm_up).",
+    ["phase"],
+)
+
+PROMPT_TOKEN_ESTIMATIONS = Counter(
+    "powerproxy_prompt_token_estimations",
+    "Prompt token estimations done asynchronously, by where the prompt was encoded (inline, thread or process) or if "
+    "it was estimated heuristically because the tokenizer process pool was saturated (heuristic).",
+    ["mode"],
+)
@@ -0,0 +1,99 @@
+"""Several methods around parsing the bodies of requests and responses."""
+
+import json
+import re
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+# bodies from this size on are not parsed to get single fields if the fields can be extracted without parsing
+MIN_BODY_SIZE_FOR_FIELD_EXTRACTION = 16 * 1024
+
+# matches JSON scalar values which can be extracted without parsing the body: strings, booleans and null
+SCALAR_VALUE_PATTERN = re.compile(rb'\s*("(?:[^"\\]|\\.)*"|true|false|null)')
+COLON_PATTERN = re.compile(rb"\s*:")
+KEY_PREFIXES = frozenset({b"{", b",", b" ", b"\t", b"\n", b"\r"})
+# matches JSON strings and the brackets of objects and arrays, to find the nesting depth of a position in a body
+STRING_OR_BRACKET_PATTERN = re.compile(rb'"[^"\\]*(?:\\.[^"\\]*)*"|[{}\[\]]')
+# max. number of strings and brackets scanned to find the nesting depth of a field, bodies with more (e.g. many short
+# messages) are parsed faster than scanned
+MAX_TOKENS_FOR_DEPTH = 1_000
+
+
+def loads(data):
+    """Return the object deserialized from the given JSON data (bytes or str), using orjson if available."""
+    return orjson.loads(data) if orjson else json.loads(data)
+
+
+def dumps(obj):
+    """Return the given object serialized to JSON (bytes), using orjson if available."""
+    return orjson.dumps(obj) if orjson else json.dumps(obj).encode()
+
+
+def parse_body(body):
+    """Return the dict for the given JSON body, or None if the body is empty, not JSON or not a JSON object."""
+    if not body:
+        return None
+    try:
+        body_dict = loads(body)
+    except ValueError:
+        return None
+    return body_dict if isinstance(body_dict, dict) else None
+
+
+def extract_field_from_body(body, field_name):
+    """
+    Try to return the scalar value of the given field from the JSON body without parsing the whole body.
+
+    Returns a tuple (found, value). 'found' is True if the field is missing from the top-level object of the body or
+    the top-level object contains the field with a scalar value, False if the body needs to be parsed to get the
+    field's value. Fields with the same name in nested objects are ignored.
+    """
+    key_ends = list(find_key_ends(body, field_name))
+    if None in key_ends:
+        return False, None
+    if not key_ends:
+        return True, None
+    if len(key_ends) > 1:
+        return False, None
+    value_match = SCALAR_VALUE_PATTERN.match(body, key_ends[0])
+    if not value_match:
+        return False, None
+    try:
+        return True, loads(value_match.group(1))
+    except ValueError:
+        return False, None
+
+
+def find_key_ends(body, field_name):
+    """
+    Yield the positions directly after the given field name used as key in the top-level JSON object, ie. after the
+    colon. Yields None if the nesting depth of a key cannot be found cheaply.
+    """
+    key = json.dumps(field_name).encode()
+    position = body.find(key)
+    depth = 0
+    depth_position = 0
+    scanned_tokens = 0
+    while position != -1:
+        # note: keys follow '{', ',' or whitespace, while quotes within strings are always escaped by a backslash
+        if position > 0 and body[position - 1 : position] in KEY_PREFIXES:
+            colon_match = COLON_PATTERN.match(body, position + len(key))
+            if colon_match:
+                # note: the nesting depth is tracked incrementally, skipping strings, so the body is scanned only once
+                for match in STRING_OR_BRACKET_PATTERN.finditer(body, depth_position, position):
+                    scanned_tokens += 1
+                    if scanned_tokens > MAX_TOKENS_FOR_DEPTH:
+                        yield None
+                        return
+                    bracket = match.group()
+                    if bracket in (b"{", b"["):
+                        depth += 1
+                    elif bracket in (b"}", b"]"):
+                        depth -= 1
+                depth_position = position
+                if depth == 1:
+                    yield colon_match.end()
+        position = body.find(key, position + len(key))
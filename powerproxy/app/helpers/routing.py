@@ -0,0 +1,109 @@
+"""Several methods and classes around routing requests to AOAI targets."""
+
+from types import MappingProxyType
+
+from helpers.balancing import LoadBalancer
+from helpers.request_body import MIN_BODY_SIZE_FOR_FIELD_EXTRACTION, extract_field_from_body, parse_body
+
+
+class RoutingIndex:
+    """
+    Immutable index mapping virtual deployments to the ordered list of targets which can serve them.
+
+    The index is built once from the configured targets, so a request only needs a dictionary lookup to get its
+    candidate targets instead of walking all targets. To apply a changed configuration, build a new index and replace
+    the reference to the old one (a single assignment, hence atomic). Requests which are already in flight keep using
+    the index they started with.
+    """
+
+    def __init__(self, targets, default_load_balancing_strategy=None, load_balancing_strategies=None):
+        """
+        Constructor.
+
+        The load balancing strategy for a virtual deployment is taken from load_balancing_strategies (mapping virtual
+        deployment names to strategy names), falling back to the given default strategy.
+        """
+        self.targets = tuple(targets)
+        self.virtual_deployment_names = frozenset(
+            target["virtual_deployment"] for target in self.targets if target["type"] == "virtual_deployment_standin"
+        )
+        # targets which are plain endpoints serve any deployment, while standins only serve their virtual deployment
+        self.targets_without_virtual_deployment = tuple(
+            target for target in self.targets if target["type"] != "virtual_deployment_standin"
+        )
+        self.targets_by_virtual_deployment = MappingProxyType(
+            {
+                virtual_deployment_name: tuple(
+                    target
+                    for target in self.targets
+                    if target["type"] != "virtual_deployment_standin"
+                    or target["virtual_deployment"] == virtual_deployment_name
+                )
+                for virtual_deployment_name in self.virtual_deployment_names
+            }
+        )
+        load_balancing_strategies = load_balancing_strategies or {}
+        self.load_balancer_without_virtual_deployment = LoadBalancer.get_load_balancer(
+            default_load_balancing_strategy, self.targets_without_virtual_deployment
+        )
+        self.load_balancers_by_virtual_deployment = MappingProxyType(
+            {
+                virtual_deployment_name: LoadBalancer.get_load_balancer(
+                    load_balancing_strategies.get(virtual_deployment_name, default_load_balancing_strategy),
+                    targets,
+                )
+                for virtual_deployment_name, targets in self.targets_by_virtual_deployment.items()
+            }
+        )
+
+    def has_virtual_deployments(self):
+        """Return True if any virtual deployments are configured."""
+        return bool(self.virtual_deployment_names)
+
+    def is_virtual_deployment_available(self, virtual_deployment_name):
+        """Return True if the given virtual deployment is configured."""
+        return virtual_deployment_name in self.virtual_deployment_names
+
+    def get_targets(self, virtual_deployment_name):
+        """Return the ordered targets which can serve requests for the given virtual deployment."""
+        return self.targets_by_virtual_deployment.get(virtual_deployment_name, self.targets_without_virtual_deployment)
+
+    def get_load_balancer(self, virtual_deployment_name):
+        """Return the load balancer ordering the targets for the given virtual deployment."""
+        return self.load_balancers_by_virtual_deployment.get(
+            virtual_deployment_name, self.load_balancer_without_virtual_deployment
+        )
+
+
+class RoutingSlip(dict):
+    """
+    Routing slip of a request, ie. a dict with all infos about the request passed on to the plugins.
+
+    The incoming request's body is only parsed when 'incoming_request_body_dict' is accessed for the first time, and at
+    most once. Until then, "incoming_request_body_dict" in routing_slip is False. Single fields of large bodies are
+    extracted without parsing, so the body is not parsed at all if no plugin needs the dict.
+    """
+
+    def __missing__(self, key):
+        """Dunder method to parse the incoming request's body on first access."""
+        if key == "incoming_request_body_dict":
+            body_dict = self[key] = parse_body(self["incoming_request_body"])
+            return body_dict
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        """Return the value for the given key if it exists, else the default value."""
+        return self[key] if key == "incoming_request_body_dict" or key in self else default
+
+    def get_incoming_request_body_field(self, field_name):
+        """Return the value of the given top-level field in the incoming request's body, or None if missing."""
+        if "incoming_request_body_dict" not in self and (
+            len(self["incoming_request_body"]) >= MIN_BODY_SIZE_FOR_FIELD_EXTRACTION
+        ):
+            # note: the extraction only reports a field found if the body's top-level object contains it at most once,
+            #       with a scalar value. otherwise, the body is parsed.
+            found, value = extract_field_from_body(self["incoming_request_body"], field_name)
+            if found:
+                return value
+        body_dict = self["incoming_request_body_dict"]
+        return body_dict.get(field_name) if body_dict else None
@@ -0,0 +1,279 @@
+"""Several methods and classes around state shared by the worker processes of PowerProxy."""
+
+import fcntl
+import hashlib
+import os
+import tempfile
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+
+# fields stored per target and worker
+BLOCKED_UNTIL_TIMESTAMP_MS = 0
+OUTSTANDING_REQUESTS = 1
+PROBES_IN_FLIGHT = 2
+BREAKER_OPENED_GENERATION = 3
+BREAKER_CLOSED_GENERATION = 4
+FIELD_COUNT = 5
+
+# fields stored per virtual deployment, client and worker, for sharing the capacity of targets fairly among clients
+FAIR_SHARE_REQUESTS_IN_FLIGHT = 0
+FAIR_SHARE_LAST_REQUEST_TIMESTAMP_MS = 1
+FAIR_SHARE_FIELD_COUNT = 2
+
+
+class TargetStates:
+    """
+    Availability state of the AOAI targets, shared by all worker processes on the same host.
+
+    When PowerProxy runs with several workers (e.g. 'uvicorn --workers 4'), each worker has its own targets. To have
+    all workers back off once one worker finds a target throttled, the time until which a target is blocked, the number
+    of requests in flight, whether the target's circuit breaker is open and the number of probes sent by half-open
+    circuit breakers are stored in shared memory. So are the requests in flight and the time of the last request per
+    virtual deployment and client, which the fair share scheduler (if enabled) needs to apply the shares to all workers.
+
+    Each worker owns a slot per target and field and is the only one writing to it, so no locks are needed: readers
+    combine the values of all slots, ie. the latest blocked-until timestamp and the totals of requests and probes in
+    flight. Locks are only taken when a worker claims or releases its slots, at startup and shutdown.
+    If shared memory is not available, the state is kept in the worker process only.
+    """
+
+    def __init__(self, target_names, max_workers=1, shared_memory_name=None, fair_share_keys=()):
+        """
+        Constructor.
+
+        With a shared memory name, the state is shared with all workers using the same name, target names and fair
+        share keys. Otherwise, the state is local to the process. The fair share keys are the (virtual deployment,
+        client) tuples to keep fair share states for.
+        """
+        self.target_indexes = {target_name: index for index, target_name in enumerate(sorted(target_names))}
+        self.fair_share_key_indexes = {
+            fair_share_key: index for index, fair_share_key in enumerate(sorted(fair_share_keys, key=repr))
+        }
+        self.max_workers = max_workers
+        self.fair_share_start_index = max_workers + len(self.target_indexes) * FIELD_COUNT * max_workers
+        self.size = (
+            self.fair_share_start_index + len(self.fair_share_key_indexes) * FAIR_SHARE_FIELD_COUNT * max_workers
+        ) * 8
+        self.shared_memory = None
+        self.lock_file_path = None
+        self.worker_slot = 0
+        if shared_memory_name:
+            self.lock_file_path = os.path.join(tempfile.gettempdir(), f"{shared_memory_name}.lock")
+            with self._lock():
+                try:
+                    self.shared_memory = shared_memory.SharedMemory(shared_memory_name, create=True, size=self.size)
+                except FileExistsError:
+                    self.shared_memory = shared_memory.SharedMemory(shared_memory_name)
+                # note: the segment outlives single workers, so Python must not remove it when a worker exits
+                resource_tracker.unregister(self.shared_memory._name, "shared_memory")  # pylint: disable=protected-access
+                self.buffer = self.shared_memory.buf[: self.size]
+                self.values = self.buffer.cast("q")
+                self.worker_slot = self._claim_worker_slot()
+        else:
+            self.values = memoryview(bytearray(self.size)).cast("q")
+            self.values[0] = os.getpid()
+
+    @staticmethod
+    def from_config(target_names, shared_state_config, fair_share_keys=()):
+        """
+        Return the target states for the given targets, shared state config and fair share keys.
+
+        Falls back to state local to the process if sharing is disabled or shared memory is not available.
+        """
+        shared_state_config = shared_state_config or {}
+        if not shared_state_config.get("enabled", True):
+            return TargetStates(target_names, fair_share_keys=fair_share_keys)
+        # note: workers started by the same uvicorn process with the same targets and clients share the state
+        shared_memory_name = "powerproxy_" + hashlib.sha1(
+            f"{os.getppid()}|{'|'.join(sorted(target_names))}|{sorted(fair_share_keys, key=repr)!r}".encode()
+        ).hexdigest()[:16]
+        try:
+            return TargetStates(
+                target_names,
+                int(shared_state_config.get("max_workers", 16)),
+                shared_memory_name,
+                fair_share_keys,
+            )
+        except (OSError, RuntimeError) as exception:
+            print(f"Could not share target states between workers, keeping them per worker: {exception}")
+            return TargetStates(target_names, fair_share_keys=fair_share_keys)
+
+    def is_shared(self):
+        """Return True if the state is shared with other worker processes."""
+        return self.shared_memory is not None
+
+    def get_target_state(self, target_name):
+        """Return the state of the target with the given name."""
+        return TargetState(self, self.target_indexes[target_name])
+
+    def get_fair_share_state(self, virtual_deployment, client):
+        """Return the fair share state of the given client at the given virtual deployment, or None if not kept."""
+        fair_share_key_index = self.fair_share_key_indexes.get((virtual_deployment, client))
+        return FairShareState(self, fair_share_key_index) if fair_share_key_index is not None else None
+
+    def get_slots_start_index(self, target_index, field):
+        """Return the index of the first worker's value for the given target and field."""
+        return self.max_workers + (target_index * FIELD_COUNT + field) * self.max_workers
+
+    def get_own_slot_index(self, target_index, field):
+        """Return the index of this worker's value for the given target and field."""
+        return self.get_slots_start_index(target_index, field) + self.worker_slot
+
+    def get_fair_share_slots_start_index(self, fair_share_key_index, field):
+        """Return the index of the first worker's value for the given fair share key and field."""
+        return self.fair_share_start_index + (fair_share_key_index * FAIR_SHARE_FIELD_COUNT + field) * self.max_workers
+
+    def close(self):
+        """Release this worker's slots and remove the shared memory once the last worker has released its slots."""
+        if self.shared_memory is None:
+            return
+        with self._lock():
+            self._clear_worker_slot(self.worker_slot)
+            is_unused = not any(self.values[: self.max_workers])
+            # note: the shared memory can only be closed once there are no more views on it
+            self.values.release()
+            self.buffer.release()
+            self.shared_memory.close()
+            if is_unused:
+                # note: unlink also unregisters the segment from the resource tracker, so it needs to be registered again
+                resource_tracker.register(self.shared_memory._name, "shared_memory")  # pylint: disable=protected-access
+                self.shared_memory.unlink()
+                os.remove(self.lock_file_path)
+        self.shared_memory = None
+
+    def _claim_worker_slot(self):
+        """Claim a free slot for this worker, taking over slots of workers which are not running anymore."""
+        for worker_slot in range(self.max_workers):
+            pid = self.values[worker_slot]
+            if pid == 0 or not is_process_running(pid):
+                self._clear_worker_slot(worker_slot)
+                self.values[worker_slot] = os.getpid()
+                return worker_slot
+        raise RuntimeError(f"All {self.max_workers} worker slots are taken, increase max_workers.")
+
+    def _clear_worker_slot(self, worker_slot):
+        """Reset all values of the given worker slot."""
+        self.values[worker_slot] = 0
+        for target_index in range(len(self.target_indexes)):
+            for field in range(FIELD_COUNT):
+                self.values[self.get_slots_start_index(target_index, field) + worker_slot] = 0
+        for fair_share_key_index in range(len(self.fair_share_key_indexes)):
+            for field in range(FAIR_SHARE_FIELD_COUNT):
+                self.values[self.get_fair_share_slots_start_index(fair_share_key_index, field) + worker_slot] = 0
+
+    @contextmanager
+    def _lock(self):
+        """Lock the shared memory against other workers claiming or releasing slots at the same time."""
+        with open(self.lock_file_path, "a", encoding="utf-8") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+class TargetState:
+    """Availability state of a single target, combining the values of all workers."""
+
+    def __init__(self, target_states, target_index):
+        """Constructor."""
+        self.target_states = target_states
+        # note: only indexes are kept here, views on the values are created per read and released right away
+        self.slots_start_indexes = [
+            target_states.get_slots_start_index(target_index, field) for field in range(FIELD_COUNT)
+        ]
+        self.own_slot_indexes = [target_states.get_own_slot_index(target_index, field) for field in range(FIELD_COUNT)]
+
+    def get_blocked_until_timestamp_ms(self):
+        """Return the latest time until which any worker has blocked the target."""
+        return max(self._get_slots(BLOCKED_UNTIL_TIMESTAMP_MS))
+
+    def set_blocked_until_timestamp_ms(self, timestamp_ms):
+        """Set the time until which this worker blocks the target (0 if not blocked)."""
+        self.target_states.values[self.own_slot_indexes[BLOCKED_UNTIL_TIMESTAMP_MS]] = int(timestamp_ms)
+
+    def get_outstanding_requests(self):
+        """Return the number of requests in flight at the target, over all workers."""
+        return sum(self._get_slots(OUTSTANDING_REQUESTS))
+
+    def add_outstanding_requests(self, count):
+        """Add the given number to the requests in flight at the target from this worker."""
+        self.target_states.values[self.own_slot_indexes[OUTSTANDING_REQUESTS]] += count
+
+    def get_probes_in_flight(self):
+        """Return the number of circuit breaker probes in flight at the target, over all workers."""
+        return sum(self._get_slots(PROBES_IN_FLIGHT))
+
+    def set_probes_in_flight(self, count):
+        """Set the number of circuit breaker probes in flight at the target from this worker."""
+        self.target_states.values[self.own_slot_indexes[PROBES_IN_FLIGHT]] = count
+
+    def is_breaker_open(self):
+        """Return True if any worker has opened the target's circuit breaker and no probe has closed it since."""
+        return max(self._get_slots(BREAKER_OPENED_GENERATION)) > max(self._get_slots(BREAKER_CLOSED_GENERATION))
+
+    def mark_breaker_opened(self):
+        """Mark the target's circuit breaker as opened by this worker, until a probe of any worker closes it."""
+        # note: each opening gets a generation newer than any opening or closing before, so the latest one wins
+        latest_generation = max(
+            max(self._get_slots(BREAKER_OPENED_GENERATION)), max(self._get_slots(BREAKER_CLOSED_GENERATION))
+        )
+        self.target_states.values[self.own_slot_indexes[BREAKER_OPENED_GENERATION]] = latest_generation + 1
+
+    def mark_breaker_closed(self):
+        """Mark the target's circuit breaker as closed by this worker, closing all openings so far."""
+        self.target_states.values[self.own_slot_indexes[BREAKER_CLOSED_GENERATION]] = max(
+            self._get_slots(BREAKER_OPENED_GENERATION)
+        )
+
+    def _get_slots(self, field):
+        """Return the values of all workers for the given field."""
+        start = self.slots_start_indexes[field]
+        return self.target_states.values[start : start + self.target_states.max_workers]
+
+
+class FairShareState:
+    """Fair share state of a single client at a virtual deployment, combining the values of all workers."""
+
+    def __init__(self, target_states, fair_share_key_index):
+        """Constructor."""
+        self.target_states = target_states
+        self.slots_start_indexes = [
+            target_states.get_fair_share_slots_start_index(fair_share_key_index, field)
+            for field in range(FAIR_SHARE_FIELD_COUNT)
+        ]
+        self.own_slot_indexes = [
+            slots_start_index + target_states.worker_slot for slots_start_index in self.slots_start_indexes
+        ]
+
+    def get_requests_in_flight(self):
+        """Return the number of requests of the client in flight, over all workers."""
+        return sum(self._get_slots(FAIR_SHARE_REQUESTS_IN_FLIGHT))
+
+    def add_requests_in_flight(self, count):
+        """Add the given number to the requests of the client in flight from this worker."""
+        self.target_states.values[self.own_slot_indexes[FAIR_SHARE_REQUESTS_IN_FLIGHT]] += count
+
+    def get_last_request_timestamp_ms(self):
+        """Return the time of the client's last request to any worker (0 if none)."""
+        return max(self._get_slots(FAIR_SHARE_LAST_REQUEST_TIMESTAMP_MS))
+
+    def set_last_request_timestamp_ms(self, timestamp_ms):
+        """Set the time of the client's last request to this worker."""
+        self.target_states.values[self.own_slot_indexes[FAIR_SHARE_LAST_REQUEST_TIMESTAMP_MS]] = int(timestamp_ms)
+
+    def _get_slots(self, field):
+        """Return the values of all workers for the given field."""
+        start = self.slots_start_indexes[field]
+        return self.target_states.values[start : start + self.target_states.max_workers]
+
+
+def is_process_running(pid):
+    """Return True if a process with the given ID is running."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
@@ -0,0 +1,89 @@
+"""Several methods and classes around server-sent events (SSE)."""
+
+import re
+
+from helpers.request_body import loads
+
+# matches a usage object (not null) in the data of an event, so only events with usage need to be parsed
+USAGE_PATTERN = re.compile(rb'"usage"\s*:\s*\{')
+
+
+class ServerSentEventScanner:
+    """
+    Incrementally extracts the data of server-sent events from the raw byte chunks of an event stream.
+
+    The chunks themselves are not modified, so they can be forwarded as they are. Only the data of complete events is
+    returned, events split across chunks are returned once the chunk completing them has been fed. Multiple data lines
+    of an event are joined by newlines, as defined by the SSE specification.
+
+    Alternatively, feed_events also returns the raw bytes of the events, e.g. to forward some of them unchanged.
+    """
+
+    def __init__(self):
+        """Constructor."""
+        self.buffer = b""
+        self.data_lines = []
+        self.raw_lines = []
+
+    def feed(self, chunk):
+        """Feed the next chunk of the stream and return the data of all events completed by it (as bytes)."""
+        return self._scan(chunk, None)
+
+    def feed_events(self, chunk):
+        """
+        Feed the next chunk of the stream and return all events completed by it, as tuples of the raw event (bytes as
+        received, including comments and fields other than data) and its data (bytes, or None if it has no data).
+        """
+        raw_events = []
+        self._scan(chunk, raw_events)
+        return raw_events
+
+    def flush(self):
+        """Return the data of the last event if the stream ended without a terminating blank line."""
+        events_data = self.feed(b"\n\n") if self.buffer or self.data_lines else []
+        self.buffer = b""
+        return events_data
+
+    def flush_events(self):
+        """Return the last event (see feed_events) if the stream ended without a terminating blank line."""
+        raw_event = b"".join(line + b"\n" for line in self.raw_lines) + self.buffer
+        self.raw_lines.clear()
+        events_data = self.flush()
+        return [(raw_event, events_data[0] if events_data else None)] if raw_event else []
+
+    def _scan(self, chunk, raw_events):
+        """Scan the given chunk, returning the data of all completed events and adding them to raw_events if given."""
+        lines = (self.buffer + chunk if self.buffer else chunk).split(b"\n")
+        # note: the last element is an incomplete line (or empty), kept until the next chunk completes it
+        self.buffer = lines.pop()
+        events_data = []
+        data_lines = self.data_lines
+        raw_lines = self.raw_lines
+        for line in lines:
+            if raw_events is not None:
+                raw_lines.append(line)
+            if line.startswith(b"data:"):
+                data_lines.append(line[6:].rstrip(b"\r") if line.startswith(b"data: ") else line[5:].rstrip(b"\r"))
+            elif not line or line == b"\r":
+                # a blank line terminates the event
+                data = None
+                if data_lines:
+                    data = data_lines[0] if len(data_lines) == 1 else b"\n".join(data_lines)
+                    events_data.append(data)
+                    data_lines.clear()
+                if raw_events is not None:
+                    raw_events.append((b"\n".join(raw_lines) + b"\n", data))
+                    raw_lines.clear()
+        return events_data
+
+
+def get_usage_from_event_data(data):
+    """Return the usage (dict) from the data of an event (e.g. the last chunk of a chat completion), or None if none."""
+    if not USAGE_PATTERN.search(data):
+        return None
+    try:
+        event_dict = loads(data)
+    except ValueError:
+        return None
+    return event_dict.get("usage") if isinstance(event_dict, dict) else None
+
@@ -3,65 +3,442 @@
 # notes:
 # - for non-streaming responses, usage info is provided in Azure OpenAI's response. Try to use these
 #   infos wherever possible.
-# - for streaming responses, (Azure) OpenAI do not provide accurate usage infos, unfortunately.
-#   hence, tokens need to be estimated. since there is no proper documentation, these estimations
-#   might not be accurate but still more useful than no estimations. as of now, functions are not
-#   taken into account. for exact numbers, disable the streaming mode.
+# - for streaming responses, (Azure) OpenAI only provide usage infos if requested in 'stream_options'
+#   (see 'aoai/stream_usage' in the config). otherwise, tokens need to be estimated: completion tokens
+#   from the streamed text, prompt tokens from the request. since there is no proper documentation,
+#   the prompt estimations might not be accurate but still more useful than no estimations. images
+#   are estimated from their size and detail, tools and functions from their definitions.
 # - code here is based on infos provided at
 #   https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
 # - code will need update as new models come out and more documentation or usage infos are available
 
+import asyncio
+import math
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+
 import tiktoken
 
+from helpers.images import estimate_image_tokens
+from helpers.metrics import PROMPT_TOKEN_ESTIMATIONS
+from helpers.request_body import dumps, loads
+
+# encoding used for models whose encoding is not known, e.g. if only a custom deployment name is known
+DEFAULT_ENCODING_NAME = "cl100k_base"
+
+# prefixes of models using encoding o200k_base, including models not known to the installed tiktoken version yet
+O200K_BASE_MODEL_PREFIXES = ("gpt-4o", "gpt-4.1", "gpt-4.5", "gpt-5", "o1", "o3", "o4")
+
+# minimum total length of the strings in a request from which they are encoded in a batch, using tiktoken's threads
+# note: for smaller requests, starting the threads costs more than it saves
+MIN_CHARACTERS_FOR_BATCH_ENCODING = 100_000
+
+# length of the text streamed in completions from which it is encoded off the event loop, in batches of this length,
+# and length of the text in prompts from which it is encoded off the event loop when estimated asynchronously
+# note: shorter texts are encoded faster than they could be handed over to another thread
+MIN_CHARACTERS_FOR_OFF_LOOP_ENCODING = 4_096
+
+# tokens added per tool (or function) definition and once for all definitions, approximating how they are rendered
+TOKENS_PER_TOOL = 7
+TOKENS_FOR_TOOLS = 12
+
+# average number of characters per token, used to estimate prompts heuristically if they cannot be encoded in time
+CHARACTERS_PER_TOKEN = 4
+
+# pool of processes encoding very large prompts (if configured), see configure_tokenizer_process_pool
+tokenizer_process_pool = None
+
+
+def estimate_prompt_tokens_from_request_body_dict(request_body_dict, model=None):
+    """
+    Return the estimated number of tokes in the given request body string.
 
-def estimate_prompt_tokens_from_request_body_dict(request_body_dict):
-    """Return the estimated number of tokes in the given request body string."""
+    The encoding is chosen by the given model (or deployment) name, falling back to the 'model' field of the body.
+    """
     if request_body_dict is None or "messages" not in request_body_dict:
         return 0
-    return estimate_tokens_from_messages(request_body_dict["messages"])
+    model = model or request_body_dict.get("model")
+    tokens, texts = get_prompt_texts_from_request_body_dict(request_body_dict, model)
+    return tokens + count_tokens_of_texts(texts, model)
+
+
+async def estimate_prompt_tokens_from_request_body_dict_async(request_body_dict, model=None):
+    """
+    Return the estimated number of tokes in the given request body string, encoding large prompts off the event loop.
+
+    See estimate_prompt_tokens_from_request_body_dict.
+    """
+    if request_body_dict is None or "messages" not in request_body_dict:
+        return 0
+    model = model or request_body_dict.get("model")
+    tokens, texts = get_prompt_texts_from_request_body_dict(request_body_dict, model)
+    characters = sum(len(text) for text in texts)
+    if characters < MIN_CHARACTERS_FOR_OFF_LOOP_ENCODING:
+        PROMPT_TOKEN_ESTIMATIONS.labels("inline").inc()
+        return tokens + count_tokens_of_texts(texts, model)
+    if tokenizer_process_pool is None or characters < tokenizer_process_pool.min_characters:
+        PROMPT_TOKEN_ESTIMATIONS.labels("thread").inc()
+        return tokens + await asyncio.to_thread(count_tokens_of_texts, texts, model)
+    texts_tokens = await tokenizer_process_pool.count_tokens_of_texts(texts, model)
+    if texts_tokens is None:
+        PROMPT_TOKEN_ESTIMATIONS.labels("heuristic").inc()
+        return tokens + math.ceil(characters / CHARACTERS_PER_TOKEN)
+    PROMPT_TOKEN_ESTIMATIONS.labels("process").inc()
+    return tokens + texts_tokens
+
+
+async def estimate_prompt_tokens_of_routing_slip(routing_slip):
+    """
+    Return the estimated number of tokens in the request of the given routing slip, estimating them once per request.
+
+    The estimation is kept in the routing slip ('estimated_prompt_tokens'), so it can be shared by PowerProxy and the
+    plugins, e.g. the estimation made when the request is admitted and the one made when the response has been streamed.
+    """
+    if "estimated_prompt_tokens" not in routing_slip:
+        routing_slip["estimated_prompt_tokens"] = await estimate_prompt_tokens_from_request_body_dict_async(
+            routing_slip["incoming_request_body_dict"], routing_slip["virtual_deployment"]
+        )
+    return routing_slip["estimated_prompt_tokens"]
+
 
+def get_prompt_texts_from_request_body_dict(request_body_dict, model=None):
+    """
+    Return the tokens of the prompt in the given request body which do not need encoding, and the texts to encode.
 
-def estimate_tokens_from_string(string, encoding_name="cl100k_base"):
+    The tokens which do not need encoding are those for formatting the messages and tools and those for images.
+    """
+    tokens, texts = get_texts_from_messages(request_body_dict["messages"], model)
+    tools = list(request_body_dict.get("tools") or ()) + list(request_body_dict.get("functions") or ())
+    if tools:
+        tools_tokens, tools_texts = get_texts_from_tools(tools)
+        tokens += tools_tokens
+        texts.extend(tools_texts)
+    return tokens, texts
+
+
+def estimate_tokens_from_string(string, encoding_name=DEFAULT_ENCODING_NAME):
     """Return the estimated number of tokens in a text string."""
-    encoding = tiktoken.get_encoding(encoding_name)
-    num_tokens = len(encoding.encode(string))
-    return num_tokens
+    return len(tiktoken.get_encoding(encoding_name).encode_ordinary(string))
 
 
-def estimate_tokens_from_messages(messages, model="gpt-3.5-turbo-0613"):
-    """Return the estimated number of tokens used by a list of messages."""
+@lru_cache(maxsize=1024)
+def get_encoding_for_model(model):
+    """Return the encoding for the given model or deployment name, resolved once per name."""
+    return tiktoken.get_encoding(get_encoding_name_for_model(model))
+
+
+def get_encoding_name_for_model(model):
+    """Return the name of the encoding for the given model or deployment name (default encoding if not known)."""
+    if not isinstance(model, str) or not model:
+        return DEFAULT_ENCODING_NAME
+    model = model.lower()
+    if model.startswith(O200K_BASE_MODEL_PREFIXES):
+        return "o200k_base"
     try:
-        encoding = tiktoken.encoding_for_model(model)
+        # note: tiktoken also knows Azure's model names (e.g. gpt-35-turbo) and prefixes like 'gpt-4o-'
+        return tiktoken.encoding_name_for_model(model)
     except KeyError:
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model in {
-        "gpt-3.5-turbo",
-        "gpt-3.5-turbo-0613",
-        "gpt-3.5-turbo-16k-0613",
-        "gpt-4-0314",
-        "gpt-4-32k-0314",
-        "gpt-4",
-        "gpt-4-0613",
-        "gpt-4-32k-0613",
-    }:
-        tokens_per_message = 3
-        tokens_per_name = 1
-    elif model == "gpt-3.5-turbo-0301":
+        return DEFAULT_ENCODING_NAME
+
+
+def get_encoding_names_for_models(models):
+    """Return the names of the encodings used for the given model or deployment names, including the default one."""
+    return sorted({DEFAULT_ENCODING_NAME} | {get_encoding_name_for_model(model) for model in models})
+
+
+def warm_up_encoding(encoding_name):
+    """
+    Load the given encoding and encode a short text with it, so the first request using it does not need to wait.
+
+    Returns the seconds it took. Raises if the encoding can neither be read from tiktoken's cache directory (environment
+    variable TIKTOKEN_CACHE_DIR) nor be downloaded.
+    """
+    start_time = time.perf_counter()
+    tiktoken.get_encoding(encoding_name).encode_ordinary("PowerProxy warm-up")
+    return time.perf_counter() - start_time
+
+
+def warm_up_encodings(encoding_names):
+    """Load the given encodings, see warm_up_encoding. Encodings which cannot be loaded are loaded on first use."""
+    for encoding_name in encoding_names:
+        try:
+            warm_up_encoding(encoding_name)
+        except Exception:  # pylint: disable=broad-exception-caught
+            pass
+
+
+def estimate_tokens_from_messages(messages, model=None):
+    """Return the estimated number of tokens used by a list of messages."""
+    tokens, texts = get_texts_from_messages(messages, model)
+    return tokens + count_tokens_of_texts(texts, model)
+
+
+def get_texts_from_messages(messages, model=None):
+    """
+    Return the tokens of the given messages which do not need encoding, and the texts to encode.
+
+    Content parts are walked instead of being encoded as a whole, so images only count with the tokens estimated for
+    them (see estimate_image_tokens) and their data is never encoded. Of tool (or function) calls, the names and
+    arguments are encoded.
+    """
+    if model == "gpt-3.5-turbo-0301":
         tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
         tokens_per_name = -1  # if there's a name, the role is omitted
     else:
-        raise NotImplementedError(
-            f"Method is not implemented for model {model}. See "
-            "https://github.com/openai/openai-python/blob/main/chatml.md for information on how "
-            "messages are converted to tokens."
-        )
-    num_tokens = 0
+        tokens_per_message = 3
+        tokens_per_name = 1
+    num_tokens = 3  # every reply is primed with <|start|>assistant<|message|>
+    texts = []
     for message in messages:
         num_tokens += tokens_per_message
         for key, value in message.items():
-            num_tokens += len(encoding.encode(f"{value}"))
+            if isinstance(value, str):
+                texts.append(value)
+            elif key == "content" and isinstance(value, list):
+                for part in value:
+                    num_tokens += add_texts_from_content_part(part, texts)
+            elif key == "tool_calls" and isinstance(value, list):
+                for tool_call in value:
+                    if isinstance(tool_call, dict):
+                        add_texts_from_function_call(tool_call.get("function"), texts)
+            elif key == "function_call":
+                add_texts_from_function_call(value, texts)
+            elif value is not None:
+                texts.append(f"{value}")
             if key == "name":
                 num_tokens += tokens_per_name
+    return num_tokens, texts
+
+
+def add_texts_from_content_part(part, texts):
+    """Add the texts to encode from the given content part to the texts and return the tokens without encoding."""
+    if isinstance(part, str):
+        texts.append(part)
+        return 0
+    if not isinstance(part, dict):
+        return 0
+    part_type = part.get("type")
+    if part_type == "image_url":
+        return estimate_image_tokens(part.get("image_url"))
+    # note: parts of type 'text' and 'refusal' have their text in the field named like the type. other parts, e.g.
+    #       audio, are not taken into account.
+    text = part.get(part_type) if isinstance(part_type, str) else None
+    if isinstance(text, str):
+        texts.append(text)
+    return 0
+
+
+def add_texts_from_function_call(function_call, texts):
+    """Add the name and arguments of the given function call to the texts to encode."""
+    if not isinstance(function_call, dict):
+        return
+    for key in ("name", "arguments"):
+        text = function_call.get(key)
+        if isinstance(text, str):
+            texts.append(text)
+
+
+def get_texts_from_tools(tools):
+    """
+    Return the tokens of the given tool (or function) definitions which do not need encoding, and the texts to encode.
+
+    The names, descriptions and parameter schemas (as JSON) are encoded, which approximates the text they are rendered
+    to for the model.
+    """
+    num_tokens = TOKENS_FOR_TOOLS
+    texts = []
+    for tool in tools:
+        if not isinstance(tool, dict):
+            continue
+        function = tool.get("function", tool)
+        if not isinstance(function, dict):
+            continue
+        num_tokens += TOKENS_PER_TOOL
+        for key in ("name", "description"):
+            if isinstance(function.get(key), str):
+                texts.append(function[key])
+        if function.get("parameters"):
+            texts.append(dumps(function["parameters"]).decode())
+    return num_tokens, texts
+
+
+def count_tokens_of_texts(texts, model=None):
+    """Return the number of tokens of the given texts, encoded one by one with the encoding for the given model."""
+    encoding = get_encoding_for_model(model)
+    # note: special tokens sent by clients are counted as ordinary text instead of failing the estimation
+    if len(texts) > 1 and sum(len(text) for text in texts) >= MIN_CHARACTERS_FOR_BATCH_ENCODING:
+        return sum(len(tokens) for tokens in encoding.encode_ordinary_batch(texts))
+    return sum(len(encoding.encode_ordinary(text)) for text in texts)
+
+
+class StreamedCompletionTokenCounter:
+    """
+    Counts the tokens of a streamed (chat) completion from the text in the events' deltas.
+
+    Counts the tokens of the content, the refusal and the names and arguments of tool (or function) calls, as streamed
+    in the choices' deltas (or the choices' text for completions). The text is collected as events are fed and encoded
+    in batches of MIN_CHARACTERS_FOR_OFF_LOOP_ENCODING characters on the event loop's default executor, so streams
+    are neither slowed down nor is the event loop blocked. Texts shorter than that are encoded directly at the end.
+
+    The encoding is chosen by the model the target reports in the events ('model' field), as deployment names are
+    chosen freely. Until an event reports the model, the encoding of the given model or deployment name is used.
+
+    Note: Tokens are counted from the concatenated text, so the count is close to the actual completion tokens but may
+          differ slightly, e.g. for tool calls. Prefer the usage sent by the target if available.
+    """
+
+    def __init__(self, model=None):
+        """Constructor."""
+        self.encoding = get_encoding_for_model(model)
+        self.is_model_reported = False
+        self.texts = []
+        self.characters = 0
+        self.futures = []
+
+    def feed(self, data):
+        """Collect the text from the data of an event received (bytes or str, except '[DONE]')."""
+        try:
+            event_dict = loads(data)
+        except ValueError:
+            return
+        if not isinstance(event_dict, dict):
+            return
+        # note: the first events may report no model yet (e.g. the one with the prompt filter results)
+        if not self.is_model_reported and event_dict.get("model"):
+            self.encoding = get_encoding_for_model(event_dict["model"])
+            self.is_model_reported = True
+        texts = self.texts
+        characters = self.characters
+        for choice in event_dict.get("choices") or ():
+            delta = choice.get("delta")
+            text = choice.get("text") if delta is None else delta.get("content")
+            if text:
+                texts.append(text)
+                characters += len(text)
+            # note: most deltas only contain the content, so the other fields are only looked for if there are any
+            if delta and (len(delta) > 1 or "content" not in delta):
+                for text in self.get_other_texts_from_delta(delta):
+                    texts.append(text)
+                    characters += len(text)
+        self.characters = characters
+        if characters >= MIN_CHARACTERS_FOR_OFF_LOOP_ENCODING:
+            self.futures.append(asyncio.get_running_loop().run_in_executor(None, self.count_tokens, self.texts))
+            self.texts = []
+            self.characters = 0
+
+    @staticmethod
+    def get_other_texts_from_delta(delta):
+        """Return the texts in the given delta except the content, ie. the refusal and the tool (or function) calls."""
+        texts = [delta.get("refusal")]
+        function_calls = [tool_call.get("function") or {} for tool_call in delta.get("tool_calls") or ()]
+        if delta.get("function_call"):
+            function_calls.append(delta["function_call"])
+        for function_call in function_calls:
+            texts.append(function_call.get("name"))
+            texts.append(function_call.get("arguments"))
+        return [text for text in texts if text]
+
+    async def get_tokens(self):
+        """Return the number of tokens of all text fed, waiting for the batches still being encoded."""
+        tokens = sum(await asyncio.gather(*self.futures)) if self.futures else 0
+        if self.texts:
+            tokens += self.count_tokens(self.texts)
+        return tokens
+
+    def count_tokens(self, texts):
+        """Return the number of tokens of the given texts, concatenated."""
+        return len(self.encoding.encode_ordinary("".join(texts)))
+
+
+class TokenizerProcessPool:
+    """
+    Pool of worker processes encoding very large prompts, with the encodings loaded when the processes start.
+
+    Encoding prompts with 100k+ tokens takes tens of milliseconds, holding the GIL of the PowerProxy worker for most of
+    that time, even if encoded on a thread. Prompts of at least 'min_characters' are therefore encoded in the pool's
+    processes. At most 'max_queued_requests' prompts are handed over to the pool at the same time. If the pool is
+    saturated or fails, None is returned, so the caller can fall back to a heuristic estimation.
+
+    Note: The processes are forked, so they do not re-run the PowerProxy app. Forking is not available on Windows. The
+    processes need to be started before the PowerProxy worker starts any threads (see start).
+    """
+
+    def __init__(self, encoding_names, max_workers=2, min_characters=100_000, max_queued_requests=16):
+        """Constructor."""
+        self.max_workers = max_workers
+        self.min_characters = min_characters
+        self.max_queued_requests = max_queued_requests
+        self.queued_requests = 0
+        self.warm_up_futures = None
+        self.executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context("fork"),
+            initializer=warm_up_encodings,
+            initargs=(tuple(encoding_names),),
+        )
+
+    def start(self):
+        """
+        Start the processes, which then load the encodings.
+
+        Needs to be called before any threads are started: a process forked while other threads run only gets a copy
+        of the forking thread and may deadlock on locks held by the other threads at that time.
+        """
+        # note: processes of forking pools are all started with the first submit, before the pool's management thread
+        if self.warm_up_futures is None:
+            self.warm_up_futures = [self.executor.submit(time.sleep, 0) for _ in range(self.max_workers)]
+
+    async def warm_up(self):
+        """Wait until the processes have loaded the encodings, starting them if not done yet."""
+        self.start()
+        await asyncio.gather(*(asyncio.wrap_future(future) for future in self.warm_up_futures))
+
+    async def count_tokens_of_texts(self, texts, model=None):
+        """Return the number of tokens of the given texts (see count_tokens_of_texts), or None if not possible now."""
+        if self.queued_requests >= self.max_queued_requests:
+            return None
+        self.queued_requests += 1
+        try:
+            return await asyncio.wrap_future(self.executor.submit(count_tokens_of_texts, texts, model))
+        except Exception as exception:  # pylint: disable=broad-exception-caught
+            print(f"Could not encode prompt in tokenizer process pool, estimating it heuristically: {exception}")
+            return None
+        finally:
+            self.queued_requests -= 1
+
+    def shutdown(self):
+        """Shut down the pool, cancelling prompts not being encoded yet."""
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    @staticmethod
+    def from_config(process_pool_config, encoding_names):
+        """Return a tokenizer process pool for the given config, or None if the config does not enable it."""
+        if not process_pool_config or not process_pool_config.get("enabled", True):
+            return None
+        if "fork" not in multiprocessing.get_all_start_methods():
+            print("Tokenizer process pool is not available on this platform, encoding large prompts on threads.")
+            return None
+        return TokenizerProcessPool(
+            encoding_names,
+            max_workers=int(process_pool_config.get("max_workers", 2)),
+            min_characters=int(process_pool_config.get("min_characters", 100_000)),
+            max_queued_requests=int(process_pool_config.get("max_queued_requests", 16)),
+        )
+
+
+def configure_tokenizer_process_pool(process_pool_config, encoding_names):
+    """Create the process pool for encoding very large prompts (if enabled), returning it."""
+    global tokenizer_process_pool  # pylint: disable=global-statement
+    shutdown_tokenizer_process_pool()
+    tokenizer_process_pool = TokenizerProcessPool.from_config(process_pool_config, encoding_names)
+    return tokenizer_process_pool
+
 
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
+def shutdown_tokenizer_process_pool():
+    """Shut down the process pool for encoding very large prompts (if any)."""
+    global tokenizer_process_pool  # pylint: disable=global-statement
+    if tokenizer_process_pool is not None:
+        tokenizer_process_pool.shutdown()
+        tokenizer_process_pool = None
@@ -1,23 +1,65 @@
 """Declares a plugin which limits the usage rate for clients."""
 
 import json
+import math
 import time
+import uuid
 
-import redis
+import redis.asyncio
 from fastapi import status
 from fastapi.responses import Response
+from helpers.admission_queue import AdmissionQueue
 from helpers.config import Configuration
+from helpers.metrics import LIMIT_USAGE_STORAGE_FAILURES
+from helpers.tokens import estimate_prompt_tokens_of_routing_slip
 from plugins.base import ImmediateResponseException, TokenCountingPlugin
+from plugins.LimitUsage.UsageLeases import UsageLeases
+from plugins.LimitUsage.UsageStorage import LocalUsageStorage, RedisUsageStorage
+from redis.exceptions import RedisError
+
+FIXED_WINDOW = "fixed_window"
+GCRA = "gcra"
+
+# time after which a client rejected because of its concurrency limit is told to retry
+CONCURRENCY_RETRY_AFTER_MS = 1_000
 
 
 class LimitUsage(TokenCountingPlugin):
-    """Limits the usage rate for clients."""
+    """
+    Limits the usage rate for clients.
+
+    In mode 'fixed_window' (default), each client has a budget of tokens per minute which is available again once the
+    next minute starts. In mode 'gcra', the budget refills continuously at the allowed rate (generic cell rate
+    algorithm), so clients cannot use their budget twice around the turn of a minute.
+
+    When a request is admitted, the tokens it is expected to use (estimated prompt tokens plus the requested max
+    tokens) are reserved. Once the actual usage is known, the reservation is corrected by the difference. If the
+    request fails before, the reservation is released.
+
+    Optionally, clients can also be limited in the number of requests per minute (counted like tokens, in the same
+    mode) and in the number of requests in flight at the same time. Each request in flight holds a slot, which is
+    released once the request is finished, also if it failed or the client disconnected.
+
+    If an admission queue is configured, requests exceeding a limit wait until the limit allows them (up to a deadline)
+    instead of being rejected right away.
+    """
 
     configured_max_tpms = {}
-    local_cache = {}
-    redis_cache = None
+    configured_limits = {}
+    mode = FIXED_WINDOW
+    reserve_tokens = True
+    burst_tolerance_ms = 60_000
+    usage_storage = None
+    usage_leases = None
+    admission_queue = None
     redis_host = None
     redis_password = None
+    redis_port = None
+    redis_ssl = None
+    redis_max_connections = None
+    redis_timeout = None
+    fail_open = True
+    concurrency_slot_timeout_ms = 600_000
 
     plugin_config_jsonschema = {
         "$schema": "http://json-schema.org/draft/2019-09/schema#",
@@ -25,13 +67,46 @@ class LimitUsage(TokenCountingPlugin):
         "definitions": {
             "PluginConfiguration": {
                 "type": "object",
-                "properties": {"redis": {"$ref": "#/definitions/Redis"}},
+                "properties": {
+                    "mode": {"type": "string", "enum": [FIXED_WINDOW, GCRA]},
+                    "burst_fraction": {"type": "number", "exclusiveMinimum": 0, "maximum": 1},
+                    "reserve_tokens": {"type": "boolean"},
+                    "queue": {"$ref": "#/definitions/Queue"},
+                    "redis": {"$ref": "#/definitions/Redis"},
+                },
+            },
+            "Queue": {
+                "type": "object",
+                "properties": {
+                    "enabled": {"type": "boolean"},
+                    "max_wait_ms": {"type": "number", "minimum": 0},
+                    "max_depth": {"type": "integer", "minimum": 0},
+                    "poll_interval_ms": {"type": "number", "exclusiveMinimum": 0},
+                },
             },
             "Redis": {
                 "type": "object",
-                "properties": {"redis_host": {"type": "string"}, "redis_password": {"type": "string"}},
+                "properties": {
+                    "redis_host": {"type": "string"},
+                    "redis_password": {"type": "string"},
+                    "redis_port": {"type": "integer"},
+                    "redis_ssl": {"type": "boolean"},
+                    "max_connections": {"type": "integer", "minimum": 1},
+                    "timeout": {"type": "number", "exclusiveMinimum": 0},
+                    "fail_open": {"type": "boolean"},
+                    "concurrency_slot_timeout": {"type": "number", "exclusiveMinimum": 0},
+                    "leasing": {"$ref": "#/definitions/Leasing"},
+                },
                 "required": ["redis_host", "redis_password"],
             },
+            "Leasing": {
+                "type": "object",
+                "properties": {
+                    "lease_seconds": {"type": "number", "exclusiveMinimum": 0},
+                    "min_lease_tokens": {"type": "integer", "minimum": 1},
+                    "max_lease_fraction": {"type": "number", "exclusiveMinimum": 0, "maximum": 1},
+                },
+            },
         },
     }
 
@@ -41,96 +116,340 @@ class LimitUsage(TokenCountingPlugin):
         "definitions": {
             "ClientConfiguration": {
                 "type": "object",
-                "properties": {"max_tokens_per_minute_in_k": {"$ref": "#/definitions/MaxTokensPerMinute"}},
+                "properties": {
+                    "max_tokens_per_minute_in_k": {"$ref": "#/definitions/MaxTokensPerMinute"},
+                    "max_requests_per_minute": {"$ref": "#/definitions/MaxRequests"},
+                    "max_concurrent_requests": {"$ref": "#/definitions/MaxRequests"},
+                },
                 "required": ["max_tokens_per_minute_in_k"],
             },
             "MaxTokensPerMinute": {
                 "anyOf": [{"$ref": "#/definitions/MaxTokensPerMinuteByClient"}, {"type": "number"}],
             },
             "MaxTokensPerMinuteByClient": {"type": "object", "additionalProperties": {"type": "number"}},
+            "MaxRequests": {
+                "anyOf": [{"$ref": "#/definitions/MaxRequestsByClient"}, {"type": "integer", "minimum": 0}],
+            },
+            "MaxRequestsByClient": {"type": "object", "additionalProperties": {"type": "integer", "minimum": 0}},
         },
     }
 
     def on_plugin_instantiated(self):
         """Run directly after the new plugin instance has been instantiated."""
+        self.mode = self.plugin_configuration.get("mode", FIXED_WINDOW)
+        # note: with GCRA, a client may use up to this fraction of its minute budget at once
+        self.burst_tolerance_ms = int(float(self.plugin_configuration.get("burst_fraction", 1.0)) * 60_000)
+        self.reserve_tokens = bool(self.plugin_configuration.get("reserve_tokens", True))
+        self.admission_queue = AdmissionQueue.from_config("limit_usage", self.plugin_configuration.get("queue"))
+        self.usage_storage = LocalUsageStorage()
         if "redis" in self.plugin_configuration:
             self.redis_host = self.plugin_configuration["redis/redis_host"]
             self.redis_password = self.plugin_configuration["redis/redis_password"]
-            self.redis_cache = redis.StrictRedis(
-                host=self.redis_host,
-                port=6380,
-                db=0,
-                password=self.redis_password,
-                ssl=True,
+            self.redis_port = int(self.plugin_configuration.get("redis/redis_port", 6380))
+            self.redis_ssl = bool(self.plugin_configuration.get("redis/redis_ssl", True))
+            self.redis_max_connections = int(self.plugin_configuration.get("redis/max_connections", 50))
+            self.redis_timeout = float(self.plugin_configuration.get("redis/timeout", 0.5))
+            self.fail_open = bool(self.plugin_configuration.get("redis/fail_open", True))
+            self.concurrency_slot_timeout_ms = int(
+                float(self.plugin_configuration.get("redis/concurrency_slot_timeout", 600)) * 1000
+            )
+            self.usage_storage = RedisUsageStorage(
+                redis.asyncio.Redis(
+                    host=self.redis_host,
+                    port=self.redis_port,
+                    db=0,
+                    password=self.redis_password,
+                    ssl=self.redis_ssl,
+                    socket_timeout=self.redis_timeout,
+                    socket_connect_timeout=self.redis_timeout,
+                    max_connections=self.redis_max_connections,
+                )
             )
+            if "leasing" in self.plugin_configuration["redis"]:
+                if self.mode == FIXED_WINDOW:
+                    self.usage_leases = UsageLeases(
+                        self.usage_storage,
+                        lease_seconds=float(self.plugin_configuration.get("redis/leasing/lease_seconds", 1.0)),
+                        min_lease_tokens=int(self.plugin_configuration.get("redis/leasing/min_lease_tokens", 1_000)),
+                        max_lease_fraction=float(
+                            self.plugin_configuration.get("redis/leasing/max_lease_fraction", 0.1)
+                        ),
+                    )
+                else:
+                    print(f"Budget leasing is only supported in mode '{FIXED_WINDOW}', ignoring leasing settings.")
 
     def on_print_configuration(self):
         """Print plugin-specific configuration."""
         super().on_print_configuration()
+        Configuration.print_setting("Mode", self.mode, 1)
+        if self.mode == GCRA:
+            Configuration.print_setting("Burst Fraction", self.burst_tolerance_ms / 60_000, 1)
+        Configuration.print_setting("Reserve Tokens", self.reserve_tokens, 1)
+        Configuration.print_setting("Admission Queue", "enabled" if self.admission_queue else "disabled", 1)
+        if self.admission_queue:
+            Configuration.print_setting("Max. Wait (ms)", self.admission_queue.max_wait_ms, 2)
+            Configuration.print_setting("Max. Depth", self.admission_queue.max_depth, 2)
+            Configuration.print_setting("Poll Interval (ms)", self.admission_queue.poll_interval_ms, 2)
         Configuration.print_setting("Redis Host", self.redis_host or "(none)", 1)
+        if self.redis_host:
+            Configuration.print_setting("Redis Port", self.redis_port, 1)
+            Configuration.print_setting("Redis SSL", self.redis_ssl, 1)
+            Configuration.print_setting("Redis Max Connections", self.redis_max_connections, 1)
+            Configuration.print_setting("Redis Timeout (s)", self.redis_timeout, 1)
+            Configuration.print_setting("If Redis Fails", "allow requests" if self.fail_open else "reject requests", 1)
+            Configuration.print_setting("Concurrency Slot Timeout (s)", self.concurrency_slot_timeout_ms / 1000, 1)
+            Configuration.print_setting("Budget Leasing", "enabled" if self.usage_leases else "disabled", 1)
+            if self.usage_leases:
+                Configuration.print_setting("Lease Seconds", self.usage_leases.lease_seconds, 2)
+                Configuration.print_setting("Min Lease Tokens", self.usage_leases.min_lease_tokens, 2)
+                Configuration.print_setting("Max Lease Fraction", self.usage_leases.max_lease_fraction, 2)
+
+    def on_new_request_received(self, routing_slip):
+        """Run when a new request is received."""
+        super().on_new_request_received(routing_slip)
+
+        request_state = self.get_request_state(routing_slip)
+        request_state.reserved_tokens = 0
+        request_state.reservation_timestamp_ms = None
+        request_state.slot_id = None
 
-    def on_client_identified(self, routing_slip):
+    async def on_client_identified(self, routing_slip):
         """Run when the client has been identified."""
         super().on_client_identified(routing_slip)
         client = routing_slip["client"]
         virtual_deployment = routing_slip["virtual_deployment"]
 
-        # ensure there is a budget for the current client and minute, leaving budget as is if it
-        # pre-exists for the current minute
-        current_minute = int(time.time() / 60)
-        current_minute_from_cache = int(
-            self._get_cache_setting(f"LimitUsage-{client}-{virtual_deployment}-minute") or 0
-        )
-        if not current_minute_from_cache or current_minute_from_cache != current_minute:
-            self._set_cache_setting(f"LimitUsage-{client}-{virtual_deployment}-minute", current_minute)
-            self._set_cache_setting(
-                f"LimitUsage-{client}-{virtual_deployment}-budget",
-                self._get_max_tokens_per_minute_in_k_for_client(client, virtual_deployment),
-            )
+        # ensure that the client is within its limits and return a 429 response telling when to retry if not
+        # note: the tokens the request is expected to use are reserved right away, so concurrent requests of the client
+        #       cannot use the same budget. the reservation is reconciled with the actual usage later.
+        request_state = self.get_request_state(routing_slip)
+        tokens_to_reserve = await self._estimate_tokens(routing_slip) if self.reserve_tokens else 0
+        now_timestamp_ms = None
+        retry_after_ms = None
+        exceeded_limit = None
+
+        async def try_admit():
+            nonlocal now_timestamp_ms, retry_after_ms, exceeded_limit
+            now_timestamp_ms = int(time.time() * 1000)
+            retry_after_ms, exceeded_limit = await self._try_admit(routing_slip, now_timestamp_ms, tokens_to_reserve)
+            # note: if it is not known when the request can be admitted, the queue checks again after its poll interval
+            return retry_after_ms if retry_after_ms is not None else self.admission_queue.poll_interval_ms
 
-        # ensure that the client has enough budget left for the current minute and return a 429
-        # response if not
-        current_minute_from_cache = int(self._get_cache_setting(f"LimitUsage-{client}-{virtual_deployment}-minute"))
-        current_budget_from_cache = int(self._get_cache_setting(f"LimitUsage-{client}-{virtual_deployment}-budget"))
-        if current_minute_from_cache == current_minute and current_budget_from_cache <= 0:
+        try:
+            if self.admission_queue:
+                await self.admission_queue.wait_for_admission(f"{client}-{virtual_deployment}", try_admit)
+            else:
+                now_timestamp_ms = int(time.time() * 1000)
+                retry_after_ms, exceeded_limit = await self._try_admit(
+                    routing_slip, now_timestamp_ms, tokens_to_reserve
+                )
+        except (RedisError, OSError) as exception:
+            LIMIT_USAGE_STORAGE_FAILURES.labels("read").inc()
+            if self.fail_open:
+                print(f"Could not get usage of client '{client}' from Redis, allowing request: {exception}")
+                return
+            print(f"Could not get usage of client '{client}' from Redis, rejecting request: {exception}")
+            raise ImmediateResponseException(
+                Response(
+                    content=json.dumps({"message": "Usage limits cannot be checked at the moment. Try again later."}),
+                    media_type="application/json",
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                )
+            ) from exception
+        if retry_after_ms is None:
+            retry_after_ms = CONCURRENCY_RETRY_AFTER_MS
+        if retry_after_ms > 0:
             raise ImmediateResponseException(
                 Response(
                     content=json.dumps(
                         {
                             "message": (
-                                f"Too many requests for client '{client}' / virtual deployment '{virtual_deployment}'. "
-                                "Try again later."
+                                f"Too many requests for client '{client}' / virtual deployment '{virtual_deployment}' "
+                                f"({exceeded_limit}). Try again in {retry_after_ms} ms."
                             )
                         }
                     ),
+                    headers={
+                        "retry-after-ms": f"{retry_after_ms}",
+                        "retry-after": f"{math.ceil(retry_after_ms / 1000)}",
+                    },
                     media_type="application/json",
                     status_code=status.HTTP_429_TOO_MANY_REQUESTS,
                 )
             )
+        request_state.reserved_tokens = tokens_to_reserve
+        request_state.reservation_timestamp_ms = now_timestamp_ms
 
-    def on_token_counts_for_request_available(self, routing_slip):
-        """Is invoked when token counts are available for the request."""
+    async def on_token_counts_for_request_available(self, routing_slip):
+        """Is invoked when token counts are available for the request (see the plugin's request state)."""
         super().on_token_counts_for_request_available(routing_slip)
+        await self._add_used_tokens(routing_slip)
+
+    async def on_request_finished(self, routing_slip):
+        """Run when the request has been finished, successfully or not."""
+        super().on_request_finished(routing_slip)
+
+        # release the reservation if it has not been reconciled with the actual usage and no target has responded, e.g.
+        # because no target was available. once a target has responded, it may have used the tokens, so they are kept.
+        request_state = self.get_request_state(routing_slip)
+        if request_state.reserved_tokens and "headers_from_target" not in routing_slip:
+            await self._add_tokens_to_usage(routing_slip, -request_state.reserved_tokens)
+            request_state.reserved_tokens = 0
+
+        # release the concurrency slot
+        if request_state.slot_id is not None:
+            slot_id, request_state.slot_id = request_state.slot_id, None
+            client = routing_slip["client"]
+            try:
+                await self.usage_storage.release_slot(f"{client}-{routing_slip['virtual_deployment']}", slot_id)
+            except (RedisError, OSError) as exception:
+                LIMIT_USAGE_STORAGE_FAILURES.labels("update").inc()
+                print(f"Could not release concurrency slot of client '{client}' in Redis (will time out): {exception}")
+
+    async def _estimate_tokens(self, routing_slip):
+        """Return the tokens the request is expected to use, ie. the estimated prompt tokens plus the max tokens."""
+        request_body_dict = routing_slip["incoming_request_body_dict"]
+        if request_body_dict is None:
+            return 0
+        max_tokens = request_body_dict.get("max_tokens", request_body_dict.get("max_completion_tokens"))
+        prompt_tokens = await estimate_prompt_tokens_of_routing_slip(routing_slip)
+        return prompt_tokens + (max_tokens if isinstance(max_tokens, int) and max_tokens > 0 else 0)
 
-        # decrement the client's budget by the total tokens
+    async def _try_admit(self, routing_slip, now_timestamp_ms, tokens):
+        """
+        Acquire a concurrency slot, count the request and reserve the given tokens if the client is within its limits,
+        returning 0 and None.
+
+        Otherwise, the request is neither counted nor are tokens reserved, and the time in ms until the client may send
+        the next request (None if not known) is returned together with a description of the exceeded limit.
+        """
         client = routing_slip["client"]
         virtual_deployment = routing_slip["virtual_deployment"]
-        old_budget = int(self._get_cache_setting(f"LimitUsage-{client}-{virtual_deployment}-budget"))
-        new_budget = old_budget - self.total_tokens
-        self._set_cache_setting(f"LimitUsage-{client}-{virtual_deployment}-budget", new_budget)
-
-    def _get_cache_setting(self, key, default=None):
-        """Return the setting with the given key from the cache."""
-        if self.redis_cache:
-            return self.redis_cache.get(key)
-        return self.local_cache.get(key, default)
-
-    def _set_cache_setting(self, key, value):
-        """Return the setting with the given key from the cache."""
-        if self.redis_cache:
-            self.redis_cache.set(key, value)
-        else:
-            self.local_cache[key] = value
+        key = f"{client}-{virtual_deployment}"
+        request_state = self.get_request_state(routing_slip)
+
+        # note: an acquired slot is released by on_request_finished, also if the request is rejected below. a request
+        #       retrying to get admitted keeps the slot it has acquired already.
+        max_concurrent_requests = self._get_limit_for_client(client, virtual_deployment, "max_concurrent_requests")
+        if max_concurrent_requests is not None and request_state.slot_id is None:
+            slot_id = uuid.uuid4().hex
+            if not await self.usage_storage.try_acquire_slot(
+                key, slot_id, max_concurrent_requests, now_timestamp_ms, self.concurrency_slot_timeout_ms
+            ):
+                return None, f"max. {max_concurrent_requests} concurrent requests"
+            request_state.slot_id = slot_id
+
+        # note: requests are counted directly in the usage storage, leases are for tokens only
+        max_requests_per_minute = self._get_limit_for_client(client, virtual_deployment, "max_requests_per_minute")
+        if max_requests_per_minute is not None:
+            retry_after_ms = await self._try_reserve(
+                f"{key}-requests", max_requests_per_minute, now_timestamp_ms, 1, None
+            )
+            if retry_after_ms > 0:
+                return retry_after_ms, f"max. {max_requests_per_minute} requests per minute"
+
+        max_tokens_per_minute = self._get_max_tokens_per_minute_in_k_for_client(client, virtual_deployment)
+        retry_after_ms = await self._try_reserve(
+            key, max_tokens_per_minute, now_timestamp_ms, tokens, self.usage_leases
+        )
+        if retry_after_ms > 0:
+            if max_requests_per_minute is not None:
+                await self._add_to_usage(f"{key}-requests", max_requests_per_minute, now_timestamp_ms, -1, None)
+            return retry_after_ms, f"max. {max_tokens_per_minute} tokens per minute"
+        return 0, None
+
+    async def _try_reserve(self, key, max_per_minute, now_timestamp_ms, amount, usage_leases):
+        """
+        Reserve the given amount (tokens or requests) for the given key if it is within its limit per minute, returning
+        0. Uses the given leases in mode 'fixed_window' if not None.
+
+        If the key has reached its limit, nothing is reserved and the time in ms until the key's limit allows the next
+        request is returned.
+        """
+        if self.mode == GCRA:
+            if max_per_minute <= 0:
+                return 60_000
+            # note: the key may be ahead of the allowed rate by the burst tolerance
+            if not amount:
+                theoretical_arrival_timestamp_ms = await self.usage_storage.get_theoretical_arrival_timestamp_ms(key)
+                return max(0, theoretical_arrival_timestamp_ms - now_timestamp_ms - self.burst_tolerance_ms)
+            increment_ms = math.ceil(amount * 60_000 / max_per_minute)
+            theoretical_arrival_timestamp_ms = (
+                await self.usage_storage.advance_theoretical_arrival_timestamp_ms(key, now_timestamp_ms, increment_ms)
+                - increment_ms
+            )
+            retry_after_ms = max(0, theoretical_arrival_timestamp_ms - now_timestamp_ms - self.burst_tolerance_ms)
+            if retry_after_ms > 0:
+                await self.usage_storage.advance_theoretical_arrival_timestamp_ms(key, now_timestamp_ms, -increment_ms)
+            return retry_after_ms
+        current_minute = now_timestamp_ms // 60_000
+        retry_after_ms = (current_minute + 1) * 60_000 - now_timestamp_ms
+        if usage_leases:
+            if not await usage_leases.try_admit(key, current_minute, max_per_minute):
+                return retry_after_ms
+            await usage_leases.add_used_tokens(key, current_minute, amount)
+            return 0
+        if not amount:
+            used_amount = await self.usage_storage.get_used_tokens(key, current_minute)
+            return retry_after_ms if used_amount >= max_per_minute else 0
+        if await self.usage_storage.add_used_tokens(key, current_minute, amount) - amount >= max_per_minute:
+            await self.usage_storage.add_used_tokens(key, current_minute, -amount)
+            return retry_after_ms
+        return 0
+
+    async def _add_used_tokens(self, routing_slip):
+        """Add the total tokens of the request to the client's usage, reconciling them with the reserved tokens."""
+        request_state = self.get_request_state(routing_slip)
+        total_tokens = request_state.total_tokens
+        reserved_tokens, request_state.reserved_tokens = request_state.reserved_tokens, 0
+        # note: if the tokens could not be counted, the reserved tokens are kept as usage
+        if total_tokens is None or total_tokens == reserved_tokens:
+            return
+        await self._add_tokens_to_usage(routing_slip, total_tokens - reserved_tokens)
+
+    async def _add_tokens_to_usage(self, routing_slip, tokens):
+        """Add the given (possibly negative) tokens to the client's usage."""
+        client = routing_slip["client"]
+        virtual_deployment = routing_slip["virtual_deployment"]
+        if client is None:
+            return
+        # note: with fixed windows, tokens are added to the minute in which the request was admitted
+        await self._add_to_usage(
+            f"{client}-{virtual_deployment}",
+            self._get_max_tokens_per_minute_in_k_for_client(client, virtual_deployment),
+            self.get_request_state(routing_slip).reservation_timestamp_ms or int(time.time() * 1000),
+            tokens,
+            self.usage_leases,
+        )
+
+    async def _add_to_usage(self, key, max_per_minute, timestamp_ms, amount, usage_leases):
+        """
+        Add the given (possibly negative) amount to the usage of the given key, in the minute of the given timestamp in
+        mode 'fixed_window'. Uses the given leases in mode 'fixed_window' if not None.
+        """
+        try:
+            if self.mode == GCRA:
+                if max_per_minute > 0:
+                    await self.usage_storage.advance_theoretical_arrival_timestamp_ms(
+                        key, int(time.time() * 1000), math.ceil(amount * 60_000 / max_per_minute)
+                    )
+            elif usage_leases:
+                await usage_leases.add_used_tokens(key, timestamp_ms // 60_000, amount)
+            else:
+                await self.usage_storage.add_used_tokens(key, timestamp_ms // 60_000, amount)
+        except (RedisError, OSError) as exception:
+            # note: the usage cannot be corrected later, so it is lost regardless of the failure policy
+            LIMIT_USAGE_STORAGE_FAILURES.labels("update").inc()
+            print(f"Could not add {amount} to usage '{key}' in Redis: {exception}")
+
+    def _get_limit_for_client(self, client, virtual_deployment, setting_name):
+        """Return the given optional limit for the given client and virtual deployment (None if not set)."""
+        if (client, virtual_deployment, setting_name) not in self.configured_limits:
+            limit = self.app_configuration.get_client_settings(client).get(setting_name)
+            if isinstance(limit, dict):
+                limit = limit.get(virtual_deployment)
+            self.configured_limits[(client, virtual_deployment, setting_name)] = None if limit is None else int(limit)
+        return self.configured_limits[(client, virtual_deployment, setting_name)]
 
     def _get_max_tokens_per_minute_in_k_for_client(self, client, virtual_deployment):
         """Return the number of maximum tokens per minute in thousands for the given client."""
@@ -0,0 +1,159 @@
+"""Declares leases of client budgets, so workers do not need to ask the usage storage for every request."""
+
+import asyncio
+import time
+
+from helpers.metrics import LIMIT_USAGE_LEASE_OPERATIONS, LIMIT_USAGE_OVERSHOOT_TOKENS, LIMIT_USAGE_STORAGE_FAILURES
+from redis.exceptions import RedisError
+
+
+class UsageLease:
+    """Slice of a key's budget for a minute, claimed by this worker."""
+
+    def __init__(self, minute):
+        """Constructor."""
+        self.minute = minute
+        self.claimed_tokens = 0
+        self.granted_tokens = 0
+        self.used_tokens = 0
+        self.is_budget_exhausted = False
+
+
+class UsageRate:
+    """Rate at which the requests of this worker use a key's tokens, observed between claims of leases."""
+
+    def __init__(self):
+        """Constructor."""
+        self.last_claim_time = time.monotonic()
+        self.used_tokens_since_last_claim = 0
+        self.tokens_per_second = 0.0
+
+
+class UsageLeases:
+    """
+    Leases of the budgets of keys (client and virtual deployment) per minute, held by a single worker.
+
+    Instead of reading the usage from the storage for each request, the worker claims a slice of the key's budget in
+    one operation (adding the slice to the key's usage in the storage) and admits requests as long as its requests have
+    not used up the slice. Only then, a new slice is claimed. Once the key's budget is exhausted, requests are rejected
+    without asking the storage again until the next minute. When a minute has passed, the unused tokens of all slices
+    are returned to the storage in one operation, so the usage in the storage matches the actual usage again. This is
+    done at the end of the minute, also if the worker receives no more requests.
+
+    The size of the slices adapts to the rate at which the worker uses the key's tokens, so a slice lasts about
+    lease_seconds. Slices are at least min_lease_tokens and at most max_lease_fraction of the key's budget. Slices held
+    by other workers may make a worker reject requests before the budget is fully used. Tokens used beyond the claimed
+    slices, e.g. by requests in flight when the budget is exhausted, overshoot the budget. They are counted in metric
+    'powerproxy_limit_usage_overshoot_tokens'.
+    """
+
+    def __init__(self, usage_storage, lease_seconds=1.0, min_lease_tokens=1_000, max_lease_fraction=0.1):
+        """Constructor."""
+        self.usage_storage = usage_storage
+        self.lease_seconds = lease_seconds
+        self.min_lease_tokens = min_lease_tokens
+        self.max_lease_fraction = max_lease_fraction
+        self.minute = None
+        self.leases = {}
+        self.usage_rates = {}
+        self.claim_locks = {}
+        self.return_minute = None
+        self.return_tasks = set()
+
+    async def try_admit(self, key, minute, max_tokens):
+        """Return True if a request for the given key may be sent in the given minute, claiming a slice if needed."""
+        await self._start_minute(minute)
+        lease = self._get_lease(key, minute)
+        if lease.used_tokens < lease.granted_tokens:
+            return True
+        if lease.is_budget_exhausted:
+            return False
+        # note: concurrent requests for the same key wait for a single claim instead of claiming one slice each
+        async with self.claim_locks.setdefault(key, asyncio.Lock()):
+            lease = self._get_lease(key, minute)
+            if lease.used_tokens >= lease.granted_tokens and not lease.is_budget_exhausted:
+                await self._claim_lease(key, max_tokens, lease)
+            return lease.used_tokens < lease.granted_tokens
+
+    async def add_used_tokens(self, key, minute, tokens):
+        """Add the given (possibly negative) tokens to the tokens used for the given key in the given minute."""
+        await self._start_minute(minute)
+        if minute < self.minute:
+            # note: the slices of past minutes have been returned already, so the tokens go to the storage directly
+            await self.usage_storage.add_used_tokens(key, minute, tokens)
+            return
+        self._get_lease(key, minute).used_tokens += tokens
+        self.usage_rates.setdefault(key, UsageRate()).used_tokens_since_last_claim += tokens
+
+    async def return_leases(self):
+        """Return the unused tokens of all slices to the usage storage, adding the tokens used beyond them."""
+        leases, self.leases = self.leases, {}
+        # note: the locks of keys not being claimed right now are dropped with the leases, so they do not pile up. a
+        #       claim racing with this at worst claims one more slice.
+        self.claim_locks = {key: claim_lock for key, claim_lock in self.claim_locks.items() if claim_lock.locked()}
+        returned_tokens = []
+        for key, lease in leases.items():
+            LIMIT_USAGE_OVERSHOOT_TOKENS.inc(max(0, lease.used_tokens - lease.granted_tokens))
+            if lease.used_tokens != lease.claimed_tokens:
+                returned_tokens.append((key, lease.minute, lease.used_tokens - lease.claimed_tokens))
+        if not returned_tokens:
+            return
+        try:
+            await self.usage_storage.add_used_tokens_for_keys(returned_tokens)
+            LIMIT_USAGE_LEASE_OPERATIONS.labels("return").inc()
+        except (RedisError, OSError) as exception:
+            LIMIT_USAGE_STORAGE_FAILURES.labels("update").inc()
+            print(f"Could not return unused leases to Redis: {exception}")
+
+    async def _start_minute(self, minute):
+        """Return the slices of past minutes if the given minute is a new one."""
+        if self.minute is not None and minute <= self.minute:
+            return
+        self.minute = minute
+        await self.return_leases()
+
+    def _get_lease(self, key, minute):
+        """Return the slice of the given key for the current minute, creating an empty one if there is none yet."""
+        lease = self.leases.get(key)
+        if lease is None:
+            lease = self.leases[key] = UsageLease(minute)
+        return lease
+
+    async def _claim_lease(self, key, max_tokens, lease):
+        """Claim a new slice of the key's budget, covering the tokens used beyond the previous slices."""
+        lease_tokens = self._get_lease_size(key, max_tokens) + max(0, lease.used_tokens - lease.granted_tokens)
+        used_tokens = await self.usage_storage.add_used_tokens(key, lease.minute, lease_tokens)
+        LIMIT_USAGE_LEASE_OPERATIONS.labels("claim").inc()
+        # note: only the part of the slice within the budget is granted, the rest is returned with the other slices
+        granted_tokens = max(0, min(lease_tokens, max_tokens - (used_tokens - lease_tokens)))
+        lease.claimed_tokens += lease_tokens
+        lease.granted_tokens += granted_tokens
+        lease.is_budget_exhausted = granted_tokens < lease_tokens
+        # note: an idle worker would otherwise keep its slices until it receives the next request
+        if self.return_minute != lease.minute:
+            self.return_minute = lease.minute
+            return_task = asyncio.create_task(self._return_leases_at_end_of_minute(lease.minute))
+            self.return_tasks.add(return_task)
+            return_task.add_done_callback(self.return_tasks.discard)
+
+    async def _return_leases_at_end_of_minute(self, minute):
+        """Wait until the given minute has passed and return its slices, unless a newer minute has already started."""
+        await asyncio.sleep(max(0.0, (minute + 1) * 60 - time.time()))
+        await self._start_minute(minute + 1)
+
+    def _get_lease_size(self, key, max_tokens):
+        """Return the size of the next slice for the given key, based on the key's recent usage rate."""
+        usage_rate = self.usage_rates.setdefault(key, UsageRate())
+        now = time.monotonic()
+        seconds_since_last_claim = now - usage_rate.last_claim_time
+        if seconds_since_last_claim > 0:
+            observed_tokens_per_second = usage_rate.used_tokens_since_last_claim / seconds_since_last_claim
+            usage_rate.tokens_per_second = (
+                (usage_rate.tokens_per_second + observed_tokens_per_second) / 2
+                if usage_rate.tokens_per_second
+                else observed_tokens_per_second
+            )
+        usage_rate.last_claim_time = now
+        usage_rate.used_tokens_since_last_claim = 0
+        lease_size = max(self.min_lease_tokens, usage_rate.tokens_per_second * self.lease_seconds)
+        return max(1, int(min(lease_size, self.max_lease_fraction * max_tokens)))
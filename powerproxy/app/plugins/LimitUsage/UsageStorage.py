@@ -0,0 +1,221 @@
+"""Declares the storages keeping track of the tokens used by clients."""
+
+# time after which the usage of a minute is removed from the storage
+USAGE_EXPIRY_SECONDS = 120
+
+# time after which a theoretical arrival time in the past is removed from the storage (it is equivalent to none)
+THEORETICAL_ARRIVAL_TIME_EXPIRY_MARGIN_MS = 1_000
+
+# advances a theoretical arrival time (see UsageStorage) in a single round-trip. KEYS[1]: key of the theoretical
+# arrival time, ARGV[1]: current timestamp in ms, ARGV[2]: increment in ms (negative to release reserved tokens),
+# ARGV[3]: expiry margin in ms. returns the new theoretical arrival time.
+ADVANCE_THEORETICAL_ARRIVAL_TIME_SCRIPT = """
+local now_timestamp_ms = tonumber(ARGV[1])
+local theoretical_arrival_timestamp_ms = math.max(tonumber(redis.call("GET", KEYS[1]) or 0), now_timestamp_ms)
+theoretical_arrival_timestamp_ms = theoretical_arrival_timestamp_ms + tonumber(ARGV[2])
+redis.call(
+    "SET", KEYS[1], string.format("%d", theoretical_arrival_timestamp_ms),
+    "PX", math.max(theoretical_arrival_timestamp_ms - now_timestamp_ms, 0) + tonumber(ARGV[3])
+)
+return theoretical_arrival_timestamp_ms
+"""
+
+# acquires a concurrency slot (see UsageStorage) in a single round-trip. KEYS[1]: key of the slots, ARGV[1]: current
+# timestamp in ms, ARGV[2]: maximum number of slots, ARGV[3]: slot timeout in ms, ARGV[4]: id of the slot. returns 1 if
+# the slot was acquired, 0 if all slots are taken.
+ACQUIRE_SLOT_SCRIPT = """
+local now_timestamp_ms = tonumber(ARGV[1])
+redis.call("ZREMRANGEBYSCORE", KEYS[1], "-inf", now_timestamp_ms - tonumber(ARGV[3]))
+if redis.call("ZCARD", KEYS[1]) >= tonumber(ARGV[2]) then
+    return 0
+end
+redis.call("ZADD", KEYS[1], now_timestamp_ms, ARGV[4])
+redis.call("PEXPIRE", KEYS[1], ARGV[3])
+return 1
+"""
+
+
+class UsageStorage:
+    """
+    Keeps track of the tokens used per key (client and virtual deployment).
+
+    For fixed windows, the usage of each minute is a separate counter, so a new minute starts at zero without anyone
+    resetting budgets.
+
+    For the generic cell rate algorithm (GCRA), the usage is a single timestamp per key, the "theoretical arrival
+    time": the time at which the key would have used up all tokens if it had used them at the allowed rate. Each
+    request advances it by its tokens times the time per token, but never starts earlier than the current time.
+
+    For concurrency limits, each request in flight holds a slot identified by a unique id until it is finished. Slots
+    older than the slot timeout are dropped, so slots of requests whose PowerProxy replica died are not held forever.
+    """
+
+    async def get_used_tokens(self, key, minute):
+        """Return the tokens used for the given key in the given minute."""
+        raise NotImplementedError()
+
+    async def add_used_tokens(self, key, minute, tokens):
+        """Add the given tokens to the tokens used for the given key in the given minute, returning the new total."""
+        raise NotImplementedError()
+
+    async def add_used_tokens_for_keys(self, keys_minutes_and_tokens):
+        """Add tokens to the tokens used for several keys and minutes, returning the new totals."""
+        return [await self.add_used_tokens(key, minute, tokens) for key, minute, tokens in keys_minutes_and_tokens]
+
+    async def get_theoretical_arrival_timestamp_ms(self, key):
+        """Return the theoretical arrival time of the given key (0 if none)."""
+        raise NotImplementedError()
+
+    async def advance_theoretical_arrival_timestamp_ms(self, key, now_timestamp_ms, increment_ms):
+        """Advance the theoretical arrival time of the given key by the given increment, from now if it has passed."""
+        raise NotImplementedError()
+
+    async def try_acquire_slot(self, key, slot_id, max_slots, now_timestamp_ms, slot_timeout_ms):
+        """Acquire a slot with the given id for the given key if less than max_slots are held, returning True if so."""
+        raise NotImplementedError()
+
+    async def release_slot(self, key, slot_id):
+        """Release the slot with the given id for the given key."""
+        raise NotImplementedError()
+
+    @staticmethod
+    def get_usage_key(key, minute):
+        """Return the storage key for the usage of the given key in the given minute."""
+        return f"LimitUsage-{key}-{minute}-used"
+
+    @staticmethod
+    def get_theoretical_arrival_time_key(key):
+        """Return the storage key for the theoretical arrival time of the given key."""
+        return f"LimitUsage-{key}-tat"
+
+    @staticmethod
+    def get_slots_key(key):
+        """Return the storage key for the concurrency slots of the given key."""
+        return f"LimitUsage-{key}-slots"
+
+
+class LocalUsageStorage(UsageStorage):
+    """Keeps the usage in memory, ie. per PowerProxy process."""
+
+    def __init__(self):
+        """Constructor."""
+        self.used_tokens = {}
+        self.minute = None
+        self.theoretical_arrival_timestamps_ms = {}
+        self.slots = {}
+
+    async def get_used_tokens(self, key, minute):
+        """Return the tokens used for the given key in the given minute."""
+        return self.used_tokens.get((key, minute), 0)
+
+    async def add_used_tokens(self, key, minute, tokens):
+        """Add the given tokens to the tokens used for the given key in the given minute, returning the new total."""
+        if minute != self.minute:
+            # forget the usage of minutes which are over
+            self.used_tokens = {
+                (used_key, used_minute): used_tokens
+                for (used_key, used_minute), used_tokens in self.used_tokens.items()
+                if used_minute >= minute - 1
+            }
+            self.minute = minute
+        self.used_tokens[(key, minute)] = self.used_tokens.get((key, minute), 0) + tokens
+        return self.used_tokens[(key, minute)]
+
+    async def get_theoretical_arrival_timestamp_ms(self, key):
+        """Return the theoretical arrival time of the given key (0 if none)."""
+        return self.theoretical_arrival_timestamps_ms.get(key, 0)
+
+    async def advance_theoretical_arrival_timestamp_ms(self, key, now_timestamp_ms, increment_ms):
+        """Advance the theoretical arrival time of the given key by the given increment, from now if it has passed."""
+        minute = int(now_timestamp_ms / 60_000)
+        if minute != self.minute:
+            # forget theoretical arrival times which have passed
+            self.theoretical_arrival_timestamps_ms = {
+                tat_key: theoretical_arrival_timestamp_ms
+                for tat_key, theoretical_arrival_timestamp_ms in self.theoretical_arrival_timestamps_ms.items()
+                if theoretical_arrival_timestamp_ms > now_timestamp_ms
+            }
+            self.minute = minute
+        theoretical_arrival_timestamp_ms = (
+            max(self.theoretical_arrival_timestamps_ms.get(key, 0), now_timestamp_ms) + increment_ms
+        )
+        self.theoretical_arrival_timestamps_ms[key] = theoretical_arrival_timestamp_ms
+        return theoretical_arrival_timestamp_ms
+
+    async def try_acquire_slot(self, key, slot_id, max_slots, now_timestamp_ms, slot_timeout_ms):
+        """Acquire a slot with the given id for the given key if less than max_slots are held, returning True if so."""
+        # note: requests of this process always release their slots, so slots do not need to time out here
+        slots = self.slots.setdefault(key, set())
+        if len(slots) >= max_slots:
+            return False
+        slots.add(slot_id)
+        return True
+
+    async def release_slot(self, key, slot_id):
+        """Release the slot with the given id for the given key."""
+        slots = self.slots.get(key)
+        if slots is not None:
+            slots.discard(slot_id)
+            if not slots:
+                del self.slots[key]
+
+
+class RedisUsageStorage(UsageStorage):
+    """
+    Keeps the usage in Redis, so it is shared by all PowerProxy replicas. Expects an asyncio Redis client.
+
+    Reading the usage is a single GET, adding usage is an INCRBY and EXPIRE sent in one transaction (fixed windows)
+    or a Lua script (GCRA), so both take one round-trip and concurrent replicas never lose each other's updates.
+    Concurrency slots are members of a sorted set, scored by the time they were acquired.
+    """
+
+    def __init__(self, redis_client):
+        """Constructor."""
+        self.redis_client = redis_client
+        self.advance_theoretical_arrival_time_script = redis_client.register_script(
+            ADVANCE_THEORETICAL_ARRIVAL_TIME_SCRIPT
+        )
+        self.acquire_slot_script = redis_client.register_script(ACQUIRE_SLOT_SCRIPT)
+
+    async def get_used_tokens(self, key, minute):
+        """Return the tokens used for the given key in the given minute."""
+        return int(await self.redis_client.get(UsageStorage.get_usage_key(key, minute)) or 0)
+
+    async def add_used_tokens(self, key, minute, tokens):
+        """Add the given tokens to the tokens used for the given key in the given minute, returning the new total."""
+        return (await self.add_used_tokens_for_keys([(key, minute, tokens)]))[0]
+
+    async def add_used_tokens_for_keys(self, keys_minutes_and_tokens):
+        """Add tokens to the tokens used for several keys and minutes in one round-trip, returning the new totals."""
+        pipeline = self.redis_client.pipeline(transaction=True)
+        for key, minute, tokens in keys_minutes_and_tokens:
+            usage_key = UsageStorage.get_usage_key(key, minute)
+            pipeline.incrby(usage_key, tokens)
+            pipeline.expire(usage_key, USAGE_EXPIRY_SECONDS)
+        return (await pipeline.execute())[::2]
+
+    async def get_theoretical_arrival_timestamp_ms(self, key):
+        """Return the theoretical arrival time of the given key (0 if none)."""
+        return int(await self.redis_client.get(UsageStorage.get_theoretical_arrival_time_key(key)) or 0)
+
+    async def advance_theoretical_arrival_timestamp_ms(self, key, now_timestamp_ms, increment_ms):
+        """Advance the theoretical arrival time of the given key by the given increment, from now if it has passed."""
+        return int(
+            await self.advance_theoretical_arrival_time_script(
+                keys=[UsageStorage.get_theoretical_arrival_time_key(key)],
+                args=[int(now_timestamp_ms), int(increment_ms), THEORETICAL_ARRIVAL_TIME_EXPIRY_MARGIN_MS],
+            )
+        )
+
+    async def try_acquire_slot(self, key, slot_id, max_slots, now_timestamp_ms, slot_timeout_ms):
+        """Acquire a slot with the given id for the given key if less than max_slots are held, returning True if so."""
+        return bool(
+            await self.acquire_slot_script(
+                keys=[UsageStorage.get_slots_key(key)],
+                args=[int(now_timestamp_ms), int(max_slots), int(slot_timeout_ms), slot_id],
+            )
+        )
+
+    async def release_slot(self, key, slot_id):
+        """Release the slot with the given id for the given key."""
+        await self.redis_client.zrem(UsageStorage.get_slots_key(key), slot_id)
@@ -9,6 +9,9 @@ from plugins.LogUsage.LogUsageBase import LogUsageBase
 class LogUsageToCsvFile(LogUsageBase):
     """Logs Azure OpenAI usage info to CSV file."""
 
+    # note: appending a line opens and writes the log file, so the hooks doing that run on the blocking hook executor
+    blocking_hooks = frozenset({"on_body_dict_from_target_available", "on_end_of_target_response_stream_reached"})
+
     log_dir = None
     log_file_name = None
     log_file_path = None
@@ -1,8 +1,9 @@
 """Declares a plugin to log usage infos to a CSV file."""
 
-from azure.identity import ClientSecretCredential, DefaultAzureCredential, ManagedIdentityCredential
+from azure.identity import ClientSecretCredential, ManagedIdentityCredential
 from azure.monitor.ingestion import LogsIngestionClient
 from helpers.config import Configuration
+from helpers.credentials import CachedTokenProvider, get_default_token_provider
 from helpers.dicts import QueryDict
 from plugins.LogUsage.LogUsageBase import LogUsageBase
 
@@ -10,6 +11,9 @@ from plugins.LogUsage.LogUsageBase import LogUsageBase
 class LogUsageToLogAnalytics(LogUsageBase):
     """Logs Azure OpenAI usage info to a Log Analytics table."""
 
+    # note: uploading a line is a network call, so the hooks doing that run on the blocking hook executor
+    blocking_hooks = frozenset({"on_body_dict_from_target_available", "on_end_of_target_response_stream_reached"})
+
     log_ingestion_endpoint = None
     credential_tenant_id = None
     credential_client_id = None
@@ -64,18 +68,23 @@ class LogUsageToLogAnalytics(LogUsageBase):
         super().on_plugin_instantiated()
 
         # get credentials for Log Analytics client
+        # note: tokens are cached by the token provider, DefaultAzureCredential shares its provider with PowerProxy
         credential = None
         match self.auth_mechanism:
             case "ClientSecretCredential":
-                credential = ClientSecretCredential(
-                    tenant_id=self.credential_tenant_id,
-                    client_id=self.credential_client_id,
-                    client_secret=self.credential_client_secret,
+                credential = CachedTokenProvider(
+                    ClientSecretCredential(
+                        tenant_id=self.credential_tenant_id,
+                        client_id=self.credential_client_id,
+                        client_secret=self.credential_client_secret,
+                    )
                 )
             case "UserAssignedManagedIdentityCredential":
-                credential = ManagedIdentityCredential(client_id=self.user_assigned_managed_identity_client_id)
+                credential = CachedTokenProvider(
+                    ManagedIdentityCredential(client_id=self.user_assigned_managed_identity_client_id)
+                )
             case _:
-                credential = DefaultAzureCredential()
+                credential = get_default_token_provider()
 
         # get Log Analytics client
         self.log_analytics_client = LogsIngestionClient(
@@ -8,23 +8,23 @@ from plugins.base import TokenCountingPlugin
 class LogUsageCustomBase(TokenCountingPlugin):
     """Base class for a plugin that logs usage."""
 
-    aoai_region = None
     deployment_id_pattern = r'.*/deployments/([a-zA-Z0-9_-]+)/.*'
 
     def on_new_request_received(self, routing_slip):
         """Run when a new request is received."""
         super().on_new_request_received(routing_slip)
 
-        self.aoai_region = None
+        self.get_request_state(routing_slip).aoai_region = None
 
     def on_headers_from_target_received(self, routing_slip):
         """Run when headers from target have been received."""
         super().on_headers_from_target_received(routing_slip)
 
+        request_state = self.get_request_state(routing_slip)
         headers_from_target = routing_slip["headers_from_target"]
         for header, value in headers_from_target.items():
             if header == "x-ms-region":
-                self.aoai_region = value
+                request_state.aoai_region = value
 
     def on_body_dict_from_target_available(self, routing_slip):
         """Run when the body was received from AOAI (only for one-time, non-streaming requests)."""
@@ -34,15 +34,16 @@ class LogUsageCustomBase(TokenCountingPlugin):
         re_match = re.match(self.deployment_id_pattern, routing_slip["path"])
         deployment_id = re_match.group(1) if re_match else None
 
+        request_state = self.get_request_state(routing_slip)
         self._append_line(
             request_received_utc=routing_slip["request_received_utc"],
             client=routing_slip["client"],
             is_streaming=False,
-            prompt_tokens=self.prompt_tokens,
-            completion_tokens=self.completion_tokens,
-            total_tokens=self.total_tokens,
+            prompt_tokens=request_state.prompt_tokens,
+            completion_tokens=request_state.completion_tokens,
+            total_tokens=request_state.total_tokens,
             aoai_roundtrip_time_ms=routing_slip["aoai_roundtrip_time_ms"],
-            aoai_region=self.aoai_region,
+            aoai_region=request_state.aoai_region,
             aoai_endpoint=routing_slip["aoai_endpoint"],
             aoai_deployment_id=deployment_id,
             aoai_time_to_response_ms=routing_slip["aoai_time_to_response_ms"]
@@ -56,15 +57,16 @@ class LogUsageCustomBase(TokenCountingPlugin):
         re_match = re.match(self.deployment_id_pattern, routing_slip["path"])
         deployment_id = re_match.group(1) if re_match else None
 
+        request_state = self.get_request_state(routing_slip)
         self._append_line(
             request_received_utc=routing_slip["request_received_utc"],
             client=routing_slip["client"],
             is_streaming=True,
-            prompt_tokens=self.prompt_tokens,
-            completion_tokens=self.completion_tokens,
-            total_tokens=self.total_tokens,
+            prompt_tokens=request_state.prompt_tokens,
+            completion_tokens=request_state.completion_tokens,
+            total_tokens=request_state.total_tokens,
             aoai_roundtrip_time_ms=routing_slip["aoai_roundtrip_time_ms"],
-            aoai_region=self.aoai_region,
+            aoai_region=request_state.aoai_region,
             aoai_endpoint=routing_slip["aoai_endpoint"],
             aoai_deployment_id=deployment_id,
             aoai_time_to_response_ms=routing_slip["aoai_time_to_response_ms"],
@@ -1,20 +1,103 @@
 """Defines the foundation for PowerProxy plugins."""
 
+import asyncio
 import importlib
+import inspect
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from types import SimpleNamespace
 
-from helpers.tokens import estimate_prompt_tokens_from_request_body_dict
+from helpers.metrics import PLUGIN_HOOK_DURATION_SECONDS
+
+# executor running the hooks which plugins have declared as blocking
+# note: bounded, so slow plugins cannot spawn an unlimited number of threads. see configure_blocking_hook_executor.
+blocking_hook_executor = None
 
 
 def foreach_plugin(plugins, method_name, *args):
-    """Have each plugin run the method with the given name and arguments."""
+    """
+    Have each plugin run the method with the given name and arguments.
+
+    Only use this outside of the event loop, ie. for hooks like on_plugin_instantiated or on_print_configuration.
+    While requests are served, use foreach_plugin_async instead.
+    """
+    for plugin in plugins:
+        _get_plugin_hook(plugin, method_name)(*args)
+
+
+async def foreach_plugin_async(plugins, method_name, *args):
+    """Have each plugin run the method with the given name and arguments, without blocking the event loop."""
     for plugin in plugins:
-        if hasattr(plugin, method_name):
-            getattr(plugin, method_name)(*args)
+        await invoke_plugin_hook(plugin, method_name, *args)
+
+
+async def invoke_plugin_hook(plugin, method_name, *args):
+    """
+    Have the given plugin run the method with the given name and arguments.
+
+    Hooks defined with 'async def' are awaited. Synchronous hooks listed in the plugin's blocking_hooks are run on the
+    blocking hook executor, all other synchronous hooks are run directly on the event loop. The time spent in each
+    hook is recorded in metric 'powerproxy_plugin_hook_duration_seconds'.
+    """
+    hook = _get_plugin_hook(plugin, method_name)
+    mode = "sync"
+    start_time = time.perf_counter()
+    try:
+        if inspect.iscoroutinefunction(hook):
+            mode = "async"
+            await hook(*args)
+        elif method_name in plugin.blocking_hooks:
+            mode = "blocking"
+            await asyncio.get_running_loop().run_in_executor(get_blocking_hook_executor(), partial(hook, *args))
         else:
-            raise ValueError(
-                (f"Plugin class '{plugin.__class__.__name__}' does not have a method named " f"'{method_name}'.")
-            )
+            hook(*args)
+    finally:
+        PLUGIN_HOOK_DURATION_SECONDS.labels(plugin.__class__.__name__, method_name, mode).observe(
+            time.perf_counter() - start_time
+        )
+
+
+def get_plugins_implementing(plugins, method_name, base_class=None):
+    """
+    Return the plugins which override the method with the given name, ie. whose hook is not a no-op.
+
+    The method is looked up in the given base class, which defaults to PowerProxyPlugin.
+    """
+    base_method = getattr(base_class or PowerProxyPlugin, method_name)
+    return [plugin for plugin in plugins if getattr(plugin.__class__, method_name, base_method) is not base_method]
+
+
+def configure_blocking_hook_executor(max_workers):
+    """Create the executor for blocking hooks, using the given maximum number of threads."""
+    global blocking_hook_executor  # pylint: disable=global-statement
+    shutdown_blocking_hook_executor()
+    blocking_hook_executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="blocking-plugin-hook")
+
+
+def get_blocking_hook_executor():
+    """Return the executor for blocking hooks, creating one with default settings if not configured yet."""
+    if blocking_hook_executor is None:
+        configure_blocking_hook_executor(max_workers=32)
+    return blocking_hook_executor
+
+
+def shutdown_blocking_hook_executor():
+    """Shut down the executor for blocking hooks, waiting for running hooks to complete."""
+    global blocking_hook_executor  # pylint: disable=global-statement
+    if blocking_hook_executor is not None:
+        blocking_hook_executor.shutdown(wait=True)
+        blocking_hook_executor = None
+
+
+def _get_plugin_hook(plugin, method_name):
+    """Return the bound method with the given name from the plugin, or raise an error if it does not exist."""
+    if not hasattr(plugin, method_name):
+        raise ValueError(
+            (f"Plugin class '{plugin.__class__.__name__}' does not have a method named " f"'{method_name}'.")
+        )
+    return getattr(plugin, method_name)
 
 
 class PowerProxyPlugin:
@@ -23,11 +106,24 @@ class PowerProxyPlugin:
     plugin_config_jsonschema = None
     client_config_jsonschema = None
 
+    # names of synchronous hooks doing blocking I/O (files, network etc.). these hooks are run on a bounded thread pool
+    # so they do not stall other requests. prefer 'async def' hooks where an async client is available.
+    blocking_hooks = frozenset()
+
     def __init__(self, app_configuration, plugin_configuration):
         """Constructor."""
         self.app_configuration = app_configuration
         self.plugin_configuration = plugin_configuration
 
+    def get_request_state(self, routing_slip):
+        """
+        Return this plugin's state for the request of the given routing slip.
+
+        Plugin instances are shared by all requests served concurrently, so anything specific to a request must be
+        stored in the request state and not in the plugin instance.
+        """
+        return routing_slip["plugin_context"].get_state(self)
+
     def on_plugin_instantiated(self):
         """Run directly after the new plugin instance has been instantiated."""
 
@@ -53,6 +149,14 @@ class PowerProxyPlugin:
     def on_end_of_target_response_stream_reached(self, routing_slip):
         """Run when the end of the target's response stream has been reached (only on streaming)."""
 
+    def on_request_finished(self, routing_slip):
+        """
+        Run when the request has been finished, ie. the response has been sent completely or the request has failed.
+
+        Runs once for each request for which on_new_request_received has run, also if the client disconnected or an
+        exception was raised, so plugins can release anything held for the request.
+        """
+
     @staticmethod
     def get_plugin_class(plugin_name):
         """Return the class for the given plugin name."""
@@ -67,60 +171,64 @@ class PowerProxyPlugin:
 
 
 class TokenCountingPlugin(PowerProxyPlugin):
-    """A plugin which counts tokens."""
+    """
+    A plugin which counts tokens.
 
-    prompt_tokens = None
-    streaming_prompt_tokens = None
-    completion_tokens = None
-    streaming_completion_tokens = None
-    total_tokens = None
+    The token counts are computed once per request by PowerProxy for all plugins counting tokens (see
+    routing_slip["token_counts"]) and copied to the plugin's request state before on_body_dict_from_target_available
+    and on_end_of_target_response_stream_reached run. Afterwards, on_token_counts_for_request_available is invoked.
+    """
 
     def on_new_request_received(self, routing_slip):
         """Run when a new request is received."""
         super().on_new_request_received(routing_slip)
 
-        self.prompt_tokens = None
-        self.completion_tokens = None
-        self.streaming_prompt_tokens = None
-        self.streaming_completion_tokens = None
-        self.total_tokens = None
+        request_state = self.get_request_state(routing_slip)
+        request_state.prompt_tokens = None
+        request_state.completion_tokens = None
+        request_state.total_tokens = None
 
     def on_body_dict_from_target_available(self, routing_slip):
         """Run when the body was received from AOAI (only for one-time, non-streaming requests)."""
         super().on_body_dict_from_target_available(routing_slip)
+        self._set_token_counts(routing_slip)
 
-        usage = (
-            routing_slip["body_dict_from_target"]["usage"] if "usage" in routing_slip["body_dict_from_target"] else None
-        )
-        self.completion_tokens = usage.get("completion_tokens", 0) if usage else 0
-        self.prompt_tokens = usage["prompt_tokens"] if usage else 0
-        self.total_tokens = usage["total_tokens"] if usage else 0
+    def on_end_of_target_response_stream_reached(self, routing_slip):
+        """Process the end of a stream (needs streaming requested)."""
+        super().on_end_of_target_response_stream_reached(routing_slip)
+        self._set_token_counts(routing_slip)
 
-        self.on_token_counts_for_request_available(routing_slip)
+    def on_token_counts_for_request_available(self, routing_slip):
+        """Is invoked when token counts are available for the request (see the plugin's request state)."""
 
-    def on_data_event_from_target_received(self, routing_slip):
-        """Run when a data event has been received by AOAI (needs streaming requested)."""
-        super().on_data_event_from_target_received(routing_slip)
+    def _set_token_counts(self, routing_slip):
+        """Copy the token counts of the request to the plugin's request state."""
+        token_counts = routing_slip.get("token_counts")
+        if token_counts is None:
+            return
+        request_state = self.get_request_state(routing_slip)
+        request_state.prompt_tokens = token_counts["prompt_tokens"]
+        request_state.completion_tokens = token_counts["completion_tokens"]
+        request_state.total_tokens = token_counts["total_tokens"]
 
-        self.streaming_completion_tokens = (
-            self.streaming_completion_tokens + 1 if self.streaming_completion_tokens else 1
-        )
 
-    def on_end_of_target_response_stream_reached(self, routing_slip):
-        """Process the end of a stream (needs streaming requested)."""
-        super().on_end_of_target_response_stream_reached(routing_slip)
+class PluginContext:
+    """
+    Per-request context for plugins, created once per routing slip.
 
-        self.prompt_tokens = estimate_prompt_tokens_from_request_body_dict(routing_slip["incoming_request_body_dict"])
-        self.completion_tokens = self.streaming_completion_tokens
-        self.total_tokens = (
-            self.prompt_tokens + self.completion_tokens
-            if self.prompt_tokens is not None and self.completion_tokens is not None
-            else None
-        )
-        self.on_token_counts_for_request_available(routing_slip)
+    Holds a separate state object for each plugin, so concurrent requests never overwrite each other's state.
+    """
 
-    def on_token_counts_for_request_available(self, routing_slip):
-        """Is invoked when token counts are available for the request."""
+    def __init__(self):
+        """Constructor."""
+        self.states = {}
+
+    def get_state(self, plugin):
+        """Return the state of the given plugin for this request, creating an empty state if there is none yet."""
+        state = self.states.get(id(plugin))
+        if state is None:
+            state = self.states[id(plugin)] = SimpleNamespace()
+        return state
 
 
 class ImmediateResponseException(Exception):
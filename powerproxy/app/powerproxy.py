@@ -7,9 +7,8 @@ PowerProxy for AOAI - reverse proxy to process requests and responses to/from Az
 
 import argparse
 import asyncio
-import io
 import json
-import random
+import os
 import re
 import time
 from contextlib import asynccontextmanager
@@ -18,15 +17,42 @@ from datetime import datetime, timezone
 from utils import is_time_within_range
 import httpx
 import uvicorn
-from azure.identity import DefaultAzureCredential
 from fastapi import FastAPI, Request, status
 from fastapi.responses import Response, StreamingResponse
 from prometheus_fastapi_instrumentator import Instrumentator, metrics
 
 from helpers.config import Configuration
+from helpers.credentials import COGNITIVE_SERVICES_SCOPE, get_default_token_provider
+from helpers.fair_share import FairShareScheduler
 from helpers.dicts import QueryDict
+from helpers.admission_queue import AdmissionQueue
+from helpers.balancing import acquire_target, get_ms_until_target_available, is_target_available, release_target
+from helpers.circuit_breaker import CircuitBreaker, CircuitBreakerSettings
 from helpers.header import print_header
-from plugins.base import ImmediateResponseException, foreach_plugin
+from helpers.hedging import HedgingPolicy
+from helpers.metrics import HEDGED_REQUESTS_FIRED, HEDGED_REQUESTS_WON, STARTUP_DURATION_SECONDS
+from helpers.request_body import dumps, loads
+from helpers.routing import RoutingIndex, RoutingSlip
+from helpers.shared_state import TargetStates
+from helpers.sse import ServerSentEventScanner, get_usage_from_event_data
+from helpers.tokens import (
+    StreamedCompletionTokenCounter,
+    configure_tokenizer_process_pool,
+    estimate_prompt_tokens_of_routing_slip,
+    get_encoding_names_for_models,
+    shutdown_tokenizer_process_pool,
+    warm_up_encoding,
+)
+from plugins.base import (
+    ImmediateResponseException,
+    PluginContext,
+    TokenCountingPlugin,
+    configure_blocking_hook_executor,
+    foreach_plugin,
+    foreach_plugin_async,
+    get_plugins_implementing,
+    shutdown_blocking_hook_executor,
+)
 from version import VERSION
 
 ## define script arguments
@@ -62,16 +88,32 @@ async def lifespan(app: FastAPI):
     """Lifespan function for FastAPI."""
 
     # startup
+    startup_start_time = time.perf_counter()
+    app.state.is_ready = False
+
     # print header and config values
     print_header(f"PowerProxy for Azure OpenAI - v{VERSION}")
     Configuration.print_setting("Proxy runs at port", args.port)
     config.print()
     foreach_plugin(config.plugins, "on_print_configuration")
 
+    # collect plugins processing data events, streams only need to be scanned for events if there are any (or if tokens
+    # are counted, see process_aoai_response)
+    app.state.data_event_plugins = get_plugins_implementing(config.plugins, "on_data_event_from_target_received")
+    app.state.request_finished_plugins = get_plugins_implementing(config.plugins, "on_request_finished")
+    # note: plugins counting tokens get the token counts computed once per request, see count_tokens_of_request
+    app.state.token_counting_plugins = [plugin for plugin in config.plugins if isinstance(plugin, TokenCountingPlugin)]
+    app.state.token_counts_plugins = get_plugins_implementing(
+        app.state.token_counting_plugins, "on_token_counts_for_request_available", TokenCountingPlugin
+    )
+
+    # get settings for the circuit breakers blocking failing targets
+    circuit_breaker_settings = CircuitBreakerSettings.from_config(config.get("aoai/circuit_breaker"))
+    Configuration.print_setting("Circuit breaker", config.get("aoai/circuit_breaker") or "(defaults)")
+
     # collect AOAI targets (endpoints or deployments) and corresponding clients
     app.state.aoai_endpoint_clients = {}
     app.state.aoai_targets = {}
-    app.state.virtual_deployment_names = []
     if config.get("aoai/mock_response"):
 
         async def get_mock_response(request):
@@ -86,14 +128,14 @@ async def lifespan(app: FastAPI):
             transport=httpx.MockTransport(get_mock_response),
         )
         app.state.aoai_targets["mock"] = {
-            "Mock client": {
-                "url": "",
-                "key": "",
-                "client": app.state.aoai_endpoint_clients["mock"],
-                "next_request_not_before_timestamp_ms": 0,
-                "non_streaming_fraction": 1,
-            }
-        }
+            "name": "mock",
+            "type": "endpoint",
+            "endpoint": "mock",
+            "url": "",
+            "endpoint_key": "",
+            "endpoint_client": app.state.aoai_endpoint_clients["mock"],
+            "non_streaming_fraction": 1,
+        } | get_load_balancing_settings({})
     else:
         for endpoint in config["aoai/endpoints"]:
             endpoint_qd = QueryDict(endpoint)
@@ -127,7 +169,6 @@ async def lifespan(app: FastAPI):
             )
             if "virtual_deployments" in endpoint:
                 for virtual_deployment in endpoint["virtual_deployments"]:
-                    app.state.virtual_deployment_names.append(virtual_deployment["name"])
                     for standin in virtual_deployment["standins"]:
                         target_name = f"{standin['name']}@{virtual_deployment['name']}@{endpoint['name']}"
                         app.state.aoai_targets[target_name] = {
@@ -138,11 +179,12 @@ async def lifespan(app: FastAPI):
                             "standin": standin["name"],
                             "url": endpoint["url"],
                             "endpoint_client": app.state.aoai_endpoint_clients[endpoint["name"]],
-                            "next_request_not_before_timestamp_ms": 0,
                             "non_streaming_fraction": float(
                                 standin["non_streaming_fraction"] if "non_streaming_fraction" in standin else 1
                             ),
-                        } | ({"endpoint_key": endpoint["key"]} if "key" in endpoint else {})
+                        } | get_load_balancing_settings(standin) | (
+                            {"endpoint_key": endpoint["key"]} if "key" in endpoint else {}
+                        )
             else:
                 app.state.aoai_targets[endpoint["name"]] = {
                     "name": endpoint["name"],
@@ -150,16 +192,116 @@ async def lifespan(app: FastAPI):
                     "endpoint": endpoint["name"],
                     "url": endpoint["url"],
                     "endpoint_client": app.state.aoai_endpoint_clients[endpoint["name"]],
-                    "next_request_not_before_timestamp_ms": 0,
                     "non_streaming_fraction": float(
                         endpoint["non_streaming_fraction"] if "non_streaming_fraction" in endpoint else 1
                     ),
-                } | ({"endpoint_key": endpoint["key"]} if "key" in endpoint else {})
+                } | get_load_balancing_settings(endpoint) | (
+                    {"endpoint_key": endpoint["key"]} if "key" in endpoint else {}
+                )
+
+    # share the targets' availability and the clients' fair shares with the other worker processes and add circuit
+    # breakers
+    fair_share_keys = FairShareScheduler.get_fair_share_keys(
+        config.get("aoai/fair_share"),
+        config["clients"],
+        {
+            aoai_target["virtual_deployment"]
+            for aoai_target in app.state.aoai_targets.values()
+            if aoai_target["type"] == "virtual_deployment_standin"
+        },
+    )
+    app.state.target_states = TargetStates.from_config(
+        app.state.aoai_targets.keys(), config.get("shared_state"), fair_share_keys
+    )
+    Configuration.print_setting(
+        "Target states", "shared between workers" if app.state.target_states.is_shared() else "per worker"
+    )
+    for aoai_target in app.state.aoai_targets.values():
+        aoai_target["state"] = app.state.target_states.get_target_state(aoai_target["name"])
+        aoai_target["circuit_breaker"] = CircuitBreaker(
+            aoai_target["name"], circuit_breaker_settings, aoai_target["state"]
+        )
+
+    # index the targets by virtual deployment, so requests do not need to walk all targets
+    # note: to apply configuration changes at runtime, build a new index and assign it here
+    load_balancing_strategies = {}
+    for endpoint in config.get("aoai/endpoints") or []:
+        for virtual_deployment in endpoint.get("virtual_deployments", []):
+            if "load_balancing" in virtual_deployment:
+                load_balancing_strategies.setdefault(virtual_deployment["name"], virtual_deployment["load_balancing"])
+    app.state.routing_index = RoutingIndex(
+        app.state.aoai_targets.values(), config.get("aoai/load_balancing"), load_balancing_strategies
+    )
+
+    # get policy for hedging slow non-streaming requests (if enabled)
+    app.state.hedging_policy = HedgingPolicy.from_config(config.get("aoai/hedging"))
+    Configuration.print_setting("Hedging", config.get("aoai/hedging") or "(disabled)")
+
+    # get queue for requests waiting for a target to become available (if enabled)
+    app.state.admission_queue = AdmissionQueue.from_config("targets", config.get("aoai/admission_queue"))
+    Configuration.print_setting("Admission queue", config.get("aoai/admission_queue") or "(disabled)")
+
+    # get scheduler sharing the first priority tier of virtual deployments fairly among clients (if enabled)
+    app.state.fair_share_scheduler = FairShareScheduler.from_config(
+        config.get("aoai/fair_share"), config["clients"], app.state.target_states
+    )
+    Configuration.print_setting("Fair share", config.get("aoai/fair_share") or "(disabled)")
+
+    # get setting for requesting the exact token usage in streams, only needed if plugins count tokens (if enabled)
+    stream_usage_config = config.get("aoai/stream_usage")
+    app.state.is_stream_usage_requested = bool(
+        app.state.token_counting_plugins and stream_usage_config and stream_usage_config.get("enabled", True)
+    )
+    Configuration.print_setting("Stream usage", stream_usage_config or "(disabled)")
+
+    # load the tokenizer encodings needed by plugins counting tokens in the background, so the first requests do not
+    # need to wait for them. the proxy is reported as ready once they are loaded.
+    # note: the processes of the tokenizer process pool are forked here, before any of the following steps (blocking
+    #       plugin hooks, token provider, loading the encodings) starts a thread
+    tokenizer_cache_dir = config.get("tokenizer/cache_dir")
+    if tokenizer_cache_dir:
+        os.environ["TIKTOKEN_CACHE_DIR"] = tokenizer_cache_dir
+    Configuration.print_setting("Tokenizer cache dir", os.environ.get("TIKTOKEN_CACHE_DIR") or "(default)")
+    app.state.tokenizer_warm_up_task = None
+    if app.state.token_counting_plugins:
+        encoding_names = sorted(
+            set(
+                get_encoding_names_for_models(
+                    app.state.routing_index.virtual_deployment_names | config.opensource_deployments
+                )
+            )
+            | set(config.get("tokenizer/encodings") or [])
+        )
+        Configuration.print_setting("Tokenizer encodings", ", ".join(encoding_names))
+        tokenizer_process_pool = configure_tokenizer_process_pool(config.get("tokenizer/process_pool"), encoding_names)
+        Configuration.print_setting(
+            "Tokenizer process pool", config.get("tokenizer/process_pool") if tokenizer_process_pool else "(disabled)"
+        )
+        if tokenizer_process_pool:
+            tokenizer_process_pool.start()
+        app.state.tokenizer_warm_up_task = asyncio.create_task(
+            warm_up_tokenizer(encoding_names, tokenizer_process_pool)
+        )
+    else:
+        app.state.is_ready = True
 
-    # get DefaultAzureCredential
-    app.state.default_azure_credential = DefaultAzureCredential()
+    # create executor for plugin hooks doing blocking I/O
+    max_blocking_plugin_hook_workers = int(config.get("plugin_hooks/max_blocking_workers", 32))
+    configure_blocking_hook_executor(max_blocking_plugin_hook_workers)
+    Configuration.print_setting("Max. blocking plugin hook workers", max_blocking_plugin_hook_workers)
+
+    # get token provider for targets without key, getting the first token already now so requests do not wait for it
+    app.state.token_provider = get_default_token_provider()
+    if any("endpoint_key" not in aoai_target for aoai_target in app.state.aoai_targets.values()):
+        try:
+            await app.state.token_provider.get_token_async(COGNITIVE_SERVICES_SCOPE)
+        except Exception as exception:  # pylint: disable=broad-exception-caught
+            print(f"Could not get access token for AOAI yet, retrying on first request: {exception}")
 
     # print serve notification
+    startup_duration_seconds = time.perf_counter() - startup_start_time
+    STARTUP_DURATION_SECONDS.labels("startup").set(startup_duration_seconds)
+    Configuration.print_setting("Startup took", f"{startup_duration_seconds:.2f}s")
     print()
     print("Serving incoming requests...")
     print()
@@ -168,9 +310,55 @@ async def lifespan(app: FastAPI):
     yield
 
     # shutdown
+    # stop loading tokenizer encodings if still running
+    if app.state.tokenizer_warm_up_task:
+        app.state.tokenizer_warm_up_task.cancel()
+    # stop the processes encoding large prompts
+    shutdown_tokenizer_process_pool()
     # close AOAI endpoint connections
     for aoai_endpoint_client_name in app.state.aoai_endpoint_clients:
         await app.state.aoai_endpoint_clients[aoai_endpoint_client_name].aclose()
+    # wait for blocking plugin hooks still running
+    shutdown_blocking_hook_executor()
+    # release this worker's share of the target states
+    app.state.target_states.close()
+    # close credentials
+    app.state.token_provider.close()
+
+
+async def warm_up_tokenizer(encoding_names, tokenizer_process_pool=None):
+    """
+    Load the given tokenizer encodings off the event loop, also in the given process pool (if any), and mark the proxy
+    as ready once all encodings are loaded.
+    """
+    start_time = time.perf_counter()
+    # note: the pool's processes have already been started in lifespan, this only waits until they are warmed up
+    if tokenizer_process_pool:
+        try:
+            await tokenizer_process_pool.warm_up()
+            print(f"Started tokenizer process pool in {time.perf_counter() - start_time:.2f}s.")
+        except Exception as exception:  # pylint: disable=broad-exception-caught
+            print(f"Could not start tokenizer process pool: {exception}")
+    # note: the proxy stays not ready until all encodings are loaded, encodings failing to load (e.g. because they
+    #       cannot be downloaded) are retried with a delay doubling from 1s up to 60s
+    for encoding_name in encoding_names:
+        retry_delay_seconds = 1
+        while True:
+            try:
+                seconds = await asyncio.to_thread(warm_up_encoding, encoding_name)
+                print(f"Loaded tokenizer encoding '{encoding_name}' in {seconds:.2f}s.")
+                break
+            except Exception as exception:  # pylint: disable=broad-exception-caught
+                print(
+                    f"Could not load tokenizer encoding '{encoding_name}', retrying in {retry_delay_seconds}s: "
+                    f"{exception}"
+                )
+                await asyncio.sleep(retry_delay_seconds)
+                retry_delay_seconds = min(retry_delay_seconds * 2, 60)
+    tokenizer_warm_up_seconds = time.perf_counter() - start_time
+    STARTUP_DURATION_SECONDS.labels("tokenizer_warm_up").set(tokenizer_warm_up_seconds)
+    print(f"Tokenizer warm-up took {tokenizer_warm_up_seconds:.2f}s, ready to serve requests.")
+    app.state.is_ready = True
 
 
 ## define and run proxy app
@@ -199,40 +387,74 @@ async def liveness_probe():
     return None
 
 
+# readiness probe
+@app.get(
+    "/powerproxy/health/readiness",
+    status_code=status.HTTP_204_NO_CONTENT,
+    description="Readiness probe for the PowerProxy",
+)
+async def readiness_probe():
+    """
+    Return a 204/No Content if the container is ready to serve requests, otherwise a 503/Service Unavailable.
+    Note: The container is not ready before the tokenizer encodings needed by plugins counting tokens are loaded.
+    """
+    if not app.state.is_ready:
+        return Response(
+            content=json.dumps({"error": "PowerProxy is still starting up (loading tokenizer encodings)."}),
+            media_type="application/json",
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        )
+    return None
+
+
 # all other GETs and POSTs
 @app.get("/{path:path}")
 @app.post("/{path:path}")
 async def handle_request(request: Request, path: str):
     """Handle any incoming request."""
     # create a new routing slip, populate it with some variables and tell plugins about new request
-    routing_slip = {
-        "request_received_utc": datetime.now(timezone.utc),
-        "incoming_request": request,
-        "incoming_request_body": await request.body(),
-        "path": path,
-    }
+    routing_slip = RoutingSlip(
+        {
+            "request_received_utc": datetime.now(timezone.utc),
+            "incoming_request": request,
+            "incoming_request_body": await request.body(),
+            "path": path,
+            "plugin_context": PluginContext(),
+        }
+    )
     routing_slip["virtual_deployment"] = None
 
-    try:
-        routing_slip["incoming_request_body_dict"] = await request.json()
-    except:
-        pass
-
+    # note: the body is only parsed if needed, see RoutingSlip
     deployment_match = re.search(r"(?<=deployments\/)[^\/]+", path)
-
     if deployment_match:
         routing_slip["virtual_deployment"] = deployment_match.group(0)
-    elif routing_slip["incoming_request_body_dict"]["model"] in config.opensource_deployments:
-        routing_slip["virtual_deployment"] = routing_slip["incoming_request_body_dict"]["model"]
-    routing_slip["incoming_request_body_dict"] = None
+    elif config.opensource_deployments:
+        model = routing_slip.get_incoming_request_body_field("model")
+        if model in config.opensource_deployments:
+            routing_slip["virtual_deployment"] = model
 
-    routing_slip["is_non_streaming_response_requested"] = not (
-        hasattr(routing_slip["incoming_request_body_dict"], "stream")
-        and str(routing_slip["incoming_request_body_dict"]["stream"]).lower() == "true"
+    routing_slip["is_non_streaming_response_requested"] = (
+        str(routing_slip.get_incoming_request_body_field("stream")).lower() != "true"
     )
     routing_slip["api_version"] = request.query_params["api-version"] if "api-version" in request.query_params else ""
-    foreach_plugin(config.plugins, "on_new_request_received", routing_slip)
+    if app.state.is_stream_usage_requested and not routing_slip["is_non_streaming_response_requested"]:
+        request_usage_in_stream(routing_slip)
+    await foreach_plugin_async(config.plugins, "on_new_request_received", routing_slip)
+
+    # process the request and tell plugins when it is finished
+    # note: for event streams, the request is finished only once the stream has ended, see process_aoai_response
+    try:
+        response = await forward_request(request, routing_slip)
+    except BaseException:
+        await finish_request(routing_slip)
+        raise
+    if not isinstance(response, StreamingResponse):
+        await finish_request(routing_slip)
+    return response
 
+
+async def forward_request(request, routing_slip):
+    """Identify the client, forward the request to a suitable target and return the response for the client."""
     # identify client
     # notes: - When API authentication is used, we get an API key in header 'api-key'. This would usually be the API key
     #          for Azure Open AI, but we configure and use client-specific keys here for the proxy to identify the
@@ -282,12 +504,14 @@ async def handle_request(request: Request, path: str):
             )
     routing_slip["client"] = client
     if client:
-        foreach_plugin(config.plugins, "on_client_identified", routing_slip)
+        await foreach_plugin_async(config.plugins, "on_client_identified", routing_slip)
 
     # if virtual deployments are used, make sure the requested deployment is configured
-    if (
-        app.state.virtual_deployment_names
-        and routing_slip["virtual_deployment"] not in app.state.virtual_deployment_names
+    # note: the routing index is read once, so the request sees a consistent set of targets even if the index is
+    #       replaced while the request is processed
+    routing_index = app.state.routing_index
+    if routing_index.has_virtual_deployments() and not routing_index.is_virtual_deployment_available(
+        routing_slip["virtual_deployment"]
     ):
         raise ImmediateResponseException(
             Response(
@@ -303,121 +527,279 @@ async def handle_request(request: Request, path: str):
         )
 
     # get response from AOAI by iterating through the configured targets (endpoints or deployments)
+    # note: the load balancer only returns targets which are neither blocked nor at their limit of outstanding
+    #       requests, in the order given by the configured load balancing strategy. the targets' circuit breakers are
+    #       asked for permission only right before a target is tried, so half-open breakers only let probes through.
+    load_balancer = routing_index.get_load_balancer(routing_slip["virtual_deployment"])
+    if app.state.admission_queue:
+        # note: if no target is available right now, wait for one instead of returning a 429 right away
+        await app.state.admission_queue.wait_for_admission(
+            routing_slip["virtual_deployment"], lambda: get_ms_until_any_target_available(load_balancer)
+        )
+    skipped_target_names = get_target_names_skipped_for_fair_share(routing_slip, load_balancer)
+    aoai_targets = acquire_circuit_breaker_permissions(
+        aoai_target
+        for aoai_target in load_balancer.get_ordered_targets(get_current_timestamp_in_ms())
+        if aoai_target["name"] not in skipped_target_names
+        and passes_non_streaming_filter(routing_slip["is_non_streaming_response_requested"], aoai_target)
+    )
+    attempt = await get_response_from_targets(
+        request,
+        routing_slip,
+        headers,
+        aoai_targets,
+        app.state.hedging_policy if routing_slip["is_non_streaming_response_requested"] else None,
+    )
     aoai_response: httpx.Response = None
-    for aoai_target_name in app.state.aoai_targets:
-        aoai_target = app.state.aoai_targets[aoai_target_name]
-
-        # try next target if this target is blocked
-        if aoai_target["next_request_not_before_timestamp_ms"] > get_current_timestamp_in_ms():
-            continue
-
-        # try next target if target is virtual_deployment_standin and target's deployment does not match requested
-        # deployment
-        if (
-            aoai_target["type"] == "virtual_deployment_standin"
-            and "virtual_deployment" in routing_slip
-            and routing_slip["virtual_deployment"] != aoai_target["virtual_deployment"]
-        ):
-            continue
-
-        # try next target if the non-streaming filter is not passed
-        if not passes_non_streaming_filter(
-            routing_slip["is_non_streaming_response_requested"], aoai_target["non_streaming_fraction"]
-        ):
-            continue
-
-        # update auth headers against real API key from AOAI/Entra ID bearer token for AOAI, but only if the request has
-        # a (previously successfully verified) API key
-        # note: intentionally not raising an exception here if an API key is missing to support requests using
-        #       Azure AD/Entra ID authentication. Entra ID requests miss an api-key header but have an Authorization
-        #       header, and we pass that as is, so AOAI will do the authentication then for us.
-        if "api-key" in headers:
-            if "endpoint_key" in aoai_target:
-                headers["api-key"] = aoai_target["endpoint_key"] or ""
-            else:
-                del headers["api-key"]
-                if "authorization" in headers:
-                    del headers["authorization"]
-                if "Authorization" in headers:
-                    del headers["Authorization"]
-                token = app.state.default_azure_credential.get_token(
-                    "https://cognitiveservices.azure.com/.default"
-                ).token
-                headers["Authorization"] = f"Bearer {token}"
-
-        # replace deployment against standin in path if target is deployment standin
-        if aoai_target["type"] == "virtual_deployment_standin":
-            routing_slip["path"] = re.sub(
-                r"/deployments/[^/]+", f"/deployments/{aoai_target['standin']}", routing_slip["path"]
-            )
-
+    if attempt:
         # remember target and request start time
+        aoai_target = attempt["aoai_target"]
+        aoai_response = attempt["aoai_response"]
+        routing_slip["path"] = attempt["path"]
         routing_slip["aoai_endpoint"] = aoai_target["endpoint"]
         routing_slip["aoai_virtual_deployment"] = (
             aoai_target["virtual_deployment"] if "virtual_deployment" in aoai_target else None
         )
         routing_slip["aoai_standin_deployment"] = aoai_target["standin"] if "standin" in aoai_target else None
-        routing_slip["aoai_request_start_time"] = get_current_timestamp_in_ms()
-
-        # send request
-        aoai_request = aoai_target["endpoint_client"].build_request(
-            request.method,
-            routing_slip["path"],
-            params=request.query_params,
-            headers=headers,
-            content=routing_slip["incoming_request_body"],
-        )
-        aoai_response = await aoai_target["endpoint_client"].send(
-            aoai_request,
-            stream=(not routing_slip["is_non_streaming_response_requested"]),
-        )
-        # got http code other than 200 or 401
-        if aoai_response.status_code not in [200, 401]:
-            # print infos to console
-            if not routing_slip["is_non_streaming_response_requested"]:
-                await aoai_response.aread()
-            print(
-                (
-                    f"Unexpected HTTP Code {aoai_response.status_code} while using target '{aoai_target['name']}'. "
-                    f"Path: {routing_slip['path']} "
-                    f"Target Url: {aoai_target['url']}"
-                    f"Response: {aoai_response.text}"
-                )
-            )
-        # got 408/Request Timeout, 429/Too Many Requests, or 500/Internal Server Error
-        if aoai_response.status_code in [408, 429, 500]:
-            # block endpoint for some time, either according to the time given by AOAI or, if not
-            # available, for 10 seconds
-            waiting_time_ms_until_next_request = (
-                int(aoai_response.headers["retry-after-ms"]) if "retry-after-ms" in aoai_response.headers else 10_000
-            )
-            aoai_target["next_request_not_before_timestamp_ms"] = (
-                get_current_timestamp_in_ms() + waiting_time_ms_until_next_request
-            )
-
-            # try next target
-            continue
-
-        # if we reached here, we found a target which is able to serve our request
-        # -> go ahead
-        break
+        routing_slip["aoai_request_start_time"] = attempt["aoai_request_start_time"]
+        # note: the request counts as outstanding at the target until the target's response has been consumed
+        if not is_retriable_response(aoai_response):
+            routing_slip["aoai_target_in_flight"] = aoai_target
+    # note: the request only counts for the client's fair share while it is served by the first tier
+    aoai_target_in_flight = routing_slip.get("aoai_target_in_flight")
+    if aoai_target_in_flight is None or aoai_target_in_flight["name"] not in routing_slip.get(
+        "fair_share_tier_target_names", ()
+    ):
+        release_fair_share_of_request(routing_slip)
 
     # raise 429 if we could not find any suitable target
     if aoai_response is None:
+        retry_after_ms = get_ms_until_target_available(load_balancer.targets, get_current_timestamp_in_ms())
         raise ImmediateResponseException(
             Response(
                 content=json.dumps(
                     {"message": "Could not find any endpoint or deployment with remaining capacity. Try again later."}
                 ),
-                headers={"retry-after-ms": f"{10_000}"},
+                headers={"retry-after-ms": f"{retry_after_ms if retry_after_ms is not None else 10_000}"},
                 media_type="application/json",
                 status_code=status.HTTP_429_TOO_MANY_REQUESTS,
             )
         )
 
+    # process the response
+    # note: if anything fails before the response is handed over, the target must not keep the request as outstanding
+    try:
+        return await process_aoai_response(routing_slip, aoai_response)
+    except BaseException:
+        release_target_of_request(routing_slip)
+        raise
+
+
+async def get_response_from_targets(request, routing_slip, headers, aoai_targets, hedging_policy):
+    """
+    Send the request to the given targets, one after another, until a target returns a non-retriable response.
+
+    The targets are given as pairs of target and whether the request is a probe for the target's circuit breaker.
+
+    If a hedging policy is given and the target does not respond within the policy's delay, the request is also sent to
+    the next target ("hedged"). The first non-retriable response wins and the other attempt is cancelled.
+
+    Returns the attempt of the target which served the request. If no target could serve the request, the last attempt
+    with a retriable response is returned, or None if no target could be tried at all.
+    """
+    virtual_deployment = routing_slip["virtual_deployment"]
+    hedge_delay_seconds = hedging_policy.get_delay_seconds(virtual_deployment) if hedging_policy else None
+    last_attempt = None
+
+    # without hedging, simply try the targets one after another
+    if hedge_delay_seconds is None:
+        for aoai_target, is_probe in aoai_targets:
+            last_attempt = await send_request_to_target(request, routing_slip, headers, aoai_target, is_probe)
+            if not is_retriable_response(last_attempt["aoai_response"]):
+                break
+        return last_attempt
+
+    # with hedging, run the attempts as tasks so a second attempt can be started while the first is still pending
+    pending_attempts = {}
+    is_hedge_allowed = True
+    try:
+        while True:
+            if not pending_attempts:
+                aoai_target, is_probe = next(aoai_targets, (None, False))
+                if aoai_target is None:
+                    return last_attempt
+                pending_attempts[
+                    asyncio.create_task(send_request_to_target(request, routing_slip, headers, aoai_target, is_probe))
+                ] = False
+            done_attempts, _ = await asyncio.wait(
+                pending_attempts,
+                timeout=hedge_delay_seconds if is_hedge_allowed else None,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+
+            # no response within the hedging delay -> send the request to the next target as well (budget permitting)
+            if not done_attempts:
+                is_hedge_allowed = False
+                if hedging_policy.try_consume_budget(virtual_deployment):
+                    aoai_target, is_probe = next(aoai_targets, (None, False))
+                    if aoai_target is not None:
+                        pending_attempts[
+                            asyncio.create_task(
+                                send_request_to_target(request, routing_slip, headers, aoai_target, is_probe)
+                            )
+                        ] = True
+                        HEDGED_REQUESTS_FIRED.labels(virtual_deployment or "").inc()
+                continue
+
+            # pick the first non-retriable response
+            # note: exceptions are only raised if there is no other attempt left which could still succeed
+            winning_attempt = None
+            attempt_exception = None
+            for done_attempt in done_attempts:
+                is_hedge = pending_attempts.pop(done_attempt)
+                if done_attempt.exception() is not None:
+                    attempt_exception = done_attempt.exception()
+                    continue
+                attempt = done_attempt.result()
+                if is_retriable_response(attempt["aoai_response"]):
+                    last_attempt = attempt
+                elif winning_attempt is None:
+                    winning_attempt = attempt
+                    if is_hedge:
+                        HEDGED_REQUESTS_WON.labels(virtual_deployment or "").inc()
+                else:
+                    # a second good response arriving at the same time is discarded
+                    await discard_attempt(attempt)
+            if winning_attempt:
+                return winning_attempt
+            if attempt_exception is not None and not pending_attempts:
+                raise attempt_exception
+    finally:
+        for pending_attempt in pending_attempts:
+            pending_attempt.cancel()
+        # note: attempts may have completed before they could be cancelled, e.g. while a discarded response was closed.
+        #       their targets and responses need to be released as well.
+        for attempt in await asyncio.gather(*pending_attempts, return_exceptions=True):
+            if isinstance(attempt, dict):
+                await discard_attempt(attempt)
+
+
+async def discard_attempt(attempt):
+    """Release the target of the given attempt which is not used to serve the request and close its response."""
+    # note: targets returning retriable responses have already been released, see send_request_to_target
+    if not is_retriable_response(attempt["aoai_response"]):
+        release_target(attempt["aoai_target"])
+    await attempt["aoai_response"].aclose()
+
+
+async def send_request_to_target(request, routing_slip, headers, aoai_target, is_probe=False):
+    """
+    Send the incoming request to the given target and return the attempt.
+
+    The attempt is a dict with the target, the target's response, the path used, the request start time and whether
+    the request is a probe for the target's circuit breaker. If the target returns a retriable response, the target is
+    blocked for some time and not counted as outstanding anymore.
+    """
+    # update auth headers against real API key from AOAI/Entra ID bearer token for AOAI, but only if the request has
+    # a (previously successfully verified) API key
+    # note: intentionally not raising an exception here if an API key is missing to support requests using
+    #       Azure AD/Entra ID authentication. Entra ID requests miss an api-key header but have an Authorization
+    #       header, and we pass that as is, so AOAI will do the authentication then for us.
+    # note: headers and path are copied per attempt because hedged attempts to different targets run concurrently
+    headers = dict(headers)
+    if "api-key" in headers:
+        if "endpoint_key" in aoai_target:
+            headers["api-key"] = aoai_target["endpoint_key"] or ""
+        else:
+            del headers["api-key"]
+            if "authorization" in headers:
+                del headers["authorization"]
+            if "Authorization" in headers:
+                del headers["Authorization"]
+            # note: the circuit breaker's permission must be released if no request is sent, e.g. if cancelled
+            try:
+                token = (await app.state.token_provider.get_token_async(COGNITIVE_SERVICES_SCOPE)).token
+            except BaseException:
+                aoai_target["circuit_breaker"].release_permission(is_probe)
+                raise
+            headers["Authorization"] = f"Bearer {token}"
+
+    # replace deployment against standin in path if target is deployment standin
+    path = routing_slip["path"]
+    if aoai_target["type"] == "virtual_deployment_standin":
+        path = re.sub(r"/deployments/[^/]+", f"/deployments/{aoai_target['standin']}", path)
+
+    # send request
+    aoai_request_start_time = get_current_timestamp_in_ms()
+    aoai_request = aoai_target["endpoint_client"].build_request(
+        request.method,
+        path,
+        params=request.query_params,
+        headers=headers,
+        content=routing_slip.get("request_body_to_target", routing_slip["incoming_request_body"]),
+    )
+    acquire_target(aoai_target)
+    circuit_breaker = aoai_target["circuit_breaker"]
+    try:
+        aoai_response = await aoai_target["endpoint_client"].send(
+            aoai_request,
+            stream=(not routing_slip["is_non_streaming_response_requested"]),
+        )
+    except httpx.TransportError as exception:
+        # target could not be reached or timed out -> answer like a gateway, so the next target is tried
+        aoai_response = httpx.Response(
+            status.HTTP_504_GATEWAY_TIMEOUT
+            if isinstance(exception, httpx.TimeoutException)
+            else status.HTTP_502_BAD_GATEWAY,
+            json={"error": f"Azure OpenAI could not be reached: {exception.__class__.__name__} {exception}".strip()},
+            request=aoai_request,
+        )
+    except BaseException:
+        release_target(aoai_target)
+        circuit_breaker.release_permission(is_probe)
+        raise
+    # got http code other than 200 or 401
+    if aoai_response.status_code not in [200, 401]:
+        # print infos to console
+        if not routing_slip["is_non_streaming_response_requested"]:
+            await aoai_response.aread()
+        print(
+            (
+                f"Unexpected HTTP Code {aoai_response.status_code} while using target '{aoai_target['name']}'. "
+                f"Path: {path} "
+                f"Target Url: {aoai_target['url']}"
+                f"Response: {aoai_response.text}"
+            )
+        )
+    # got 408/Request Timeout, 429/Too Many Requests, 5xx/Server Error or the target could not be reached
+    now = get_current_timestamp_in_ms()
+    if is_retriable_response(aoai_response):
+        # block target, either for the time given by AOAI or, if not available, as decided by the circuit breaker
+        circuit_breaker.record_failure(
+            now,
+            int(aoai_response.headers["retry-after-ms"]) if "retry-after-ms" in aoai_response.headers else None,
+            is_probe=is_probe,
+        )
+        release_target(aoai_target)
+    elif aoai_response.status_code >= 500:
+        circuit_breaker.record_failure(now, is_retriable=False, is_probe=is_probe)
+    else:
+        circuit_breaker.record_success(now, now - aoai_request_start_time, is_probe)
+
+    return {
+        "aoai_target": aoai_target,
+        "aoai_response": aoai_response,
+        "path": path,
+        "aoai_request_start_time": aoai_request_start_time,
+        "is_probe": is_probe,
+    }
+
+
+async def process_aoai_response(routing_slip, aoai_response):
+    """Process the response from AOAI and return the response for the client."""
     # process received headers
     routing_slip["headers_from_target"] = aoai_response.headers
-    foreach_plugin(config.plugins, "on_headers_from_target_received", routing_slip)
+    await foreach_plugin_async(config.plugins, "on_headers_from_target_received", routing_slip)
 
     # determine if it's actually an event stream or not
     routing_slip["is_event_stream"] = (
@@ -431,15 +813,29 @@ async def handle_request(request: Request, path: str):
     match routing_slip["is_event_stream"]:
         case False:
             # non-streamed response
-            body = await aoai_response.aread()
+            try:
+                body = await aoai_response.aread()
+            finally:
+                release_target_of_request(routing_slip)
             measure_aoai_roundtrip_time_ms(routing_slip)
             routing_slip['aoai_time_to_response_ms'] = routing_slip['aoai_roundtrip_time_ms']
+            if app.state.hedging_policy and aoai_response.status_code == 200:
+                app.state.hedging_policy.record_latency(
+                    routing_slip["virtual_deployment"], routing_slip["aoai_roundtrip_time_ms"]
+                )
+            # note: only a response which cannot be parsed is skipped, errors of the plugins are not swallowed
             try:
-                routing_slip["body_dict_from_target"] = json.load(io.BytesIO(body))
-                foreach_plugin(config.plugins, "on_body_dict_from_target_available", routing_slip)
-            except:
-                # eat any exception in case the response cannot be parsed
-                pass
+                body_dict = loads(body)
+            except ValueError:
+                body_dict = None
+            if body_dict is not None:
+                routing_slip["body_dict_from_target"] = body_dict
+                if app.state.token_counting_plugins:
+                    routing_slip["token_counts"] = await count_tokens_of_request(routing_slip)
+                await foreach_plugin_async(config.plugins, "on_body_dict_from_target_available", routing_slip)
+                await foreach_plugin_async(
+                    app.state.token_counts_plugins, "on_token_counts_for_request_available", routing_slip
+                )
             response = Response(
                 content=body,
                 status_code=aoai_response.status_code,
@@ -452,30 +848,129 @@ async def handle_request(request: Request, path: str):
             # event stream
             # forward and process events as they come in
             # note: see https://learn.microsoft.com/de-de/azure/ai-services/openai/reference
+            # note: the chunks received from AOAI are forwarded unchanged. they are only scanned for data events if
+            #       plugins need them. raw chunks can only be forwarded and scanned if they are not content-encoded.
+            if "content-encoding" in aoai_response.headers or aoai_response.is_stream_consumed:
+                chunks = aoai_response.aiter_bytes()
+                routing_slip["response_headers_from_target"] = {
+                    key: value
+                    for key, value in routing_slip["response_headers_from_target"].items()
+                    if key.lower() not in ("content-encoding", "content-length")
+                }
+            else:
+                chunks = aoai_response.aiter_raw()
+            data_event_plugins = app.state.data_event_plugins
+            # note: if PowerProxy requested the usage, the event containing it is not forwarded to the client. in that
+            #       case, the raw events are forwarded instead of the raw chunks, all except the usage event unchanged.
+            is_usage_to_be_withheld = routing_slip.get("is_stream_usage_injected", False)
+            # note: the completion tokens are counted from the streamed text for plugins counting tokens, in case the
+            #       target does not send the usage (e.g. because it ignores the requested stream options). the encoding
+            #       is chosen by the model reported in the stream, else by the deployment the request was sent to.
+            token_counter = (
+                StreamedCompletionTokenCounter(
+                    routing_slip["aoai_standin_deployment"] or routing_slip["virtual_deployment"]
+                )
+                if app.state.token_counting_plugins
+                else None
+            )
+
             async def yield_data_events():
                 """Stream response while invoking plugins."""
-                async for line in aoai_response.aiter_lines():
-                    yield f"{line}\r\n"
-                    routing_slip["data_from_target"] = None
-                    if line.startswith("data: "):
-                        if "aoai_time_to_response_ms" not in routing_slip:
-                            routing_slip["aoai_time_to_response_ms"] = get_current_timestamp_in_ms() - routing_slip[
-                                "aoai_request_start_time"
-                            ]
-                        data = line[6:]
-                        if data != "[DONE]":
-                            routing_slip["data_from_target"] = data
-                            foreach_plugin(
-                                config.plugins,
-                                "on_data_event_from_target_received",
-                                routing_slip,
-                            )
-                measure_aoai_roundtrip_time_ms(routing_slip)
-                foreach_plugin(
-                    config.plugins,
-                    "on_end_of_target_response_stream_reached",
-                    routing_slip,
+                sse_scanner = (
+                    ServerSentEventScanner() if data_event_plugins or is_usage_to_be_withheld or token_counter else None
                 )
+                # note: the finally blocks also run when the client disconnects and the stream is closed early
+                is_stream_processed = False
+                try:
+                    try:
+                        async for chunk in chunks:
+                            if "aoai_time_to_response_ms" not in routing_slip:
+                                routing_slip["aoai_time_to_response_ms"] = (
+                                    get_current_timestamp_in_ms() - routing_slip["aoai_request_start_time"]
+                                )
+                            if is_usage_to_be_withheld:
+                                raw_events = await process_events(sse_scanner.feed_events(chunk))
+                                if raw_events:
+                                    yield raw_events
+                            else:
+                                yield chunk
+                                if sse_scanner:
+                                    for data in sse_scanner.feed(chunk):
+                                        await process_data_event(data, data_event_plugins)
+                        if is_usage_to_be_withheld:
+                            raw_events = await process_events(sse_scanner.flush_events())
+                            if raw_events:
+                                yield raw_events
+                        elif sse_scanner:
+                            for data in sse_scanner.flush():
+                                await process_data_event(data, data_event_plugins)
+                    finally:
+                        release_target_of_request(routing_slip)
+                        await aoai_response.aclose()
+                    measure_aoai_roundtrip_time_ms(routing_slip)
+                    if app.state.token_counting_plugins:
+                        routing_slip["token_counts"] = await count_tokens_of_request(routing_slip, token_counter)
+                    await foreach_plugin_async(
+                        config.plugins,
+                        "on_end_of_target_response_stream_reached",
+                        routing_slip,
+                    )
+                    is_stream_processed = True
+                    await foreach_plugin_async(
+                        app.state.token_counts_plugins, "on_token_counts_for_request_available", routing_slip
+                    )
+                finally:
+                    # note: when the client disconnects, the stream is cancelled and so would be any awaits here, so
+                    #       the request is finished in a shielded task
+                    await asyncio.shield(finish_stream(is_stream_processed))
+
+            async def finish_stream(is_stream_processed):
+                """Finish the request of the stream, also if the stream ended early."""
+                try:
+                    # note: if the stream ended early, e.g. because the client disconnected, the target has used tokens
+                    #       nevertheless. plugins counting tokens get the prompt tokens and the completion tokens
+                    #       streamed so far, so clients cannot avoid being charged by disconnecting.
+                    if not is_stream_processed and app.state.token_counting_plugins:
+                        routing_slip["token_counts"] = await count_tokens_of_request(routing_slip, token_counter)
+                        await foreach_plugin_async(
+                            app.state.token_counts_plugins, "on_token_counts_for_request_available", routing_slip
+                        )
+                finally:
+                    await finish_request(routing_slip)
+
+            async def process_events(events):
+                """
+                Process the data of the given events (tuples of raw event and data, see ServerSentEventScanner), and
+                return the raw events to be forwarded to the client, joined.
+                """
+                raw_events = []
+                for raw_event, data in events:
+                    if data is None or await process_data_event(data, data_event_plugins):
+                        raw_events.append(raw_event)
+                return b"".join(raw_events)
+
+            async def process_data_event(data, data_event_plugins):
+                """
+                Have the given plugins process the data of an event received from AOAI.
+
+                Returns False if the event is not to be forwarded to the client, ie. if it contains the usage which was
+                requested by PowerProxy only.
+                """
+                if data == b"[DONE]":
+                    return True
+                if token_counter:
+                    token_counter.feed(data)
+                usage = get_usage_from_event_data(data)
+                if usage is not None:
+                    routing_slip["usage_from_target"] = usage
+                    if is_usage_to_be_withheld:
+                        return False
+                if not data_event_plugins:
+                    return True
+                routing_slip["data_from_target"] = data.decode()
+                await foreach_plugin_async(data_event_plugins, "on_data_event_from_target_received", routing_slip)
+                routing_slip["data_from_target"] = None
+                return True
 
             return StreamingResponse(
                 yield_data_events(),
@@ -484,6 +979,128 @@ async def handle_request(request: Request, path: str):
             )
 
 
+async def finish_request(routing_slip):
+    """Tell the plugins that the request of the given routing slip has been finished (only once per request)."""
+    if routing_slip.get("is_request_finished"):
+        return
+    routing_slip["is_request_finished"] = True
+    release_fair_share_of_request(routing_slip)
+    await foreach_plugin_async(app.state.request_finished_plugins, "on_request_finished", routing_slip)
+
+
+async def count_tokens_of_request(routing_slip, token_counter=None):
+    """
+    Return the token counts of the request, computed once for all plugins counting tokens.
+
+    The token counts are a dict with the prompt, completion and total tokens and if they are estimated. They are taken
+    from the usage sent by the target, in the body of non-streamed responses or at the end of streams if requested (see
+    request_usage_in_stream). Otherwise, the prompt tokens are estimated from the request and the completion tokens are
+    counted from the streamed text by the given token counter (if any).
+    """
+    if routing_slip["is_event_stream"]:
+        usage = routing_slip.get("usage_from_target")
+    else:
+        body_dict = routing_slip["body_dict_from_target"]
+        usage = (body_dict.get("usage") if isinstance(body_dict, dict) else None) or {}
+    if usage is not None:
+        prompt_tokens = usage.get("prompt_tokens", 0)
+        completion_tokens = usage.get("completion_tokens", 0)
+        return {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": usage.get("total_tokens", prompt_tokens + completion_tokens),
+            "is_estimated": False,
+        }
+    prompt_tokens = await estimate_prompt_tokens_of_routing_slip(routing_slip)
+    completion_tokens = await token_counter.get_tokens() if token_counter else None
+    return {
+        "prompt_tokens": prompt_tokens,
+        "completion_tokens": completion_tokens,
+        "total_tokens": prompt_tokens + completion_tokens if completion_tokens is not None else None,
+        "is_estimated": True,
+    }
+
+
+def request_usage_in_stream(routing_slip):
+    """
+    Have the target send the exact token usage at the end of the requested stream (chat) completion.
+
+    Sets 'stream_options/include_usage' in a copy of the body to be sent to the targets ('request_body_to_target'), the
+    body seen by the plugins stays as sent by the client. If the client has not requested the usage itself, the event
+    containing it is withheld from the client later, see process_aoai_response.
+    """
+    if not routing_slip["path"].endswith("completions"):
+        return
+    # note: the stream flag is checked again on the parsed body, so non-streaming requests are never changed
+    body_dict = routing_slip["incoming_request_body_dict"]
+    if not body_dict or body_dict.get("stream") is not True:
+        return
+    stream_options = body_dict.get("stream_options")
+    if stream_options is None:
+        stream_options = {}
+    elif not isinstance(stream_options, dict):
+        return
+    if stream_options.get("include_usage") is True:
+        return
+    routing_slip["request_body_to_target"] = dumps(
+        body_dict | {"stream_options": stream_options | {"include_usage": True}}
+    )
+    routing_slip["is_stream_usage_injected"] = True
+
+
+def acquire_circuit_breaker_permissions(aoai_targets):
+    """
+    Yield the given targets whose circuit breakers permit a request, each with whether the request is a probe.
+
+    The permission of a target is only acquired when the next target is requested, ie. right before it is tried.
+    """
+    for aoai_target in aoai_targets:
+        is_permitted, is_probe = aoai_target["circuit_breaker"].try_acquire_permission(get_current_timestamp_in_ms())
+        if is_permitted:
+            yield aoai_target, is_probe
+
+
+def get_target_names_skipped_for_fair_share(routing_slip, load_balancer):
+    """
+    Return the names of the targets the request of the given routing slip must not use because its client has reached
+    its fair share of the first priority tier. Counts the request for the client's fair share if it may use the tier.
+    """
+    fair_share_scheduler = app.state.fair_share_scheduler
+    if not fair_share_scheduler or not routing_slip["client"] or not load_balancer.tiers:
+        return frozenset()
+    first_tier_target_names = frozenset(aoai_target["name"] for aoai_target in load_balancer.tiers[0])
+    if not fair_share_scheduler.is_tier_permitted(
+        routing_slip["virtual_deployment"],
+        routing_slip["client"],
+        load_balancer.tiers[0],
+        get_current_timestamp_in_ms(),
+    ):
+        return first_tier_target_names
+    fair_share_scheduler.acquire(routing_slip["virtual_deployment"], routing_slip["client"])
+    routing_slip["fair_share_tier_target_names"] = first_tier_target_names
+    return frozenset()
+
+
+def release_fair_share_of_request(routing_slip):
+    """Stop counting the request of the given routing slip for its client's fair share, if not done yet."""
+    if routing_slip.pop("fair_share_tier_target_names", None) is not None:
+        app.state.fair_share_scheduler.release(routing_slip["virtual_deployment"], routing_slip["client"])
+
+
+async def get_ms_until_any_target_available(load_balancer):
+    """Return the time in ms until any target of the given load balancer is available (0 if one is available now)."""
+    now = get_current_timestamp_in_ms()
+    if any(is_target_available(aoai_target, now) for aoai_target in load_balancer.targets):
+        return 0
+    # note: if it is not known when a target becomes available, it is checked again after the poll interval
+    ms_until_target_available = get_ms_until_target_available(load_balancer.targets, now)
+    return (
+        ms_until_target_available
+        if ms_until_target_available is not None
+        else app.state.admission_queue.poll_interval_ms
+    )
+
+
 def get_current_timestamp_in_ms():
     """Return the current timestamp in millisecond resolution."""
     return time.time_ns() // 1_000_000
@@ -497,15 +1114,48 @@ def measure_aoai_roundtrip_time_ms(routing_slip):
     )
 
 
-def passes_non_streaming_filter(is_non_streaming_response_requested, non_streaming_fraction):
-    """Determines by chance if a request should be processed or not."""
-    return (
-        True
-        if not is_non_streaming_response_requested
-        else not (
-            non_streaming_fraction != 1 and (non_streaming_fraction == 0 or random.random() > non_streaming_fraction)
-        )
-    )
+def passes_non_streaming_filter(is_non_streaming_response_requested, aoai_target):
+    """
+    Determine if a request should be processed by the given target or not.
+
+    Streaming requests always pass. Of the non-streaming requests, the target accepts exactly its non_streaming_fraction
+    by accumulating the fraction as credit and accepting a request whenever a full credit is available.
+    """
+    if not is_non_streaming_response_requested or aoai_target["non_streaming_fraction"] == 1:
+        return True
+    aoai_target["non_streaming_credit"] += aoai_target["non_streaming_fraction"]
+    if aoai_target["non_streaming_credit"] >= 1:
+        aoai_target["non_streaming_credit"] -= 1
+        return True
+    return False
+
+
+def is_retriable_response(aoai_response):
+    """
+    Return True if the response is a 408/Request Timeout, 429/Too Many Requests, 500/Internal Server Error,
+    502/Bad Gateway, 503/Service Unavailable or 504/Gateway Timeout.
+    """
+    return aoai_response.status_code in [408, 429, 500, 502, 503, 504]
+
+
+def get_load_balancing_settings(target_config):
+    """Return the load balancing-related fields for a target, given the target's (endpoint or standin) config."""
+    return {
+        "priority": int(target_config.get("priority", 0)),
+        "weight": float(target_config.get("weight", 1)),
+        "max_outstanding_requests": (
+            int(target_config["max_outstanding_requests"]) if "max_outstanding_requests" in target_config else None
+        ),
+        "non_streaming_credit": 0.0,
+    }
+
+
+def release_target_of_request(routing_slip):
+    """Release the target serving the request of the given routing slip, if not released yet."""
+    aoai_target = routing_slip.pop("aoai_target_in_flight", None)
+    if aoai_target is not None:
+        release_target(aoai_target)
+    release_fair_share_of_request(routing_slip)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,213 @@
+"""
+Benchmarks the Redis round-trips and correctness of the LimitUsage plugin's usage accounting.
+
+Compares the previous implementation (reading and resetting '-minute' and '-budget' keys on admission, then reading
+and writing back the budget after the request) against the current one (one GET on admission, one transaction with
+INCRBY and EXPIRE after the request) and the current one with budget leasing (claiming slices of the budget, returning
+unused tokens at the end). Several asyncio tasks, standing in for PowerProxy replicas, admit and debit requests
+concurrently; the benchmark reports the round-trips per request, how many tokens got lost by racing updates and, with
+--max-tokens-per-minute, how far the budget was overshot.
+
+Uses an in-process fakeredis server with a simulated network latency by default (pip install fakeredis), or a real
+Redis server if --redis-host is given. Run from the powerproxy folder:
+
+    python test/benchmark/benchmark_limit_usage.py
+"""
+
+import argparse
+import asyncio
+import sys
+import time
+
+import redis.asyncio
+
+sys.path.append("app")
+
+from plugins.LimitUsage.UsageLeases import UsageLeases  # pylint: disable=wrong-import-position
+from plugins.LimitUsage.UsageStorage import RedisUsageStorage  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--replicas", type=int, default=8, help="Number of concurrent replicas (tasks)")
+parser.add_argument("--requests", type=int, default=200, help="Number of requests per replica")
+parser.add_argument("--tokens", type=int, default=100, help="Tokens used per request")
+parser.add_argument("--max-tokens-per-minute", type=int, default=10**12, help="Budget of the client per minute")
+parser.add_argument("--latency-ms", type=float, default=1.0, help="Simulated latency per round-trip (fakeredis only)")
+parser.add_argument("--redis-host", help="Host of a real Redis server to use instead of fakeredis")
+parser.add_argument("--redis-port", type=int, default=6380, help="Port of the real Redis server")
+parser.add_argument("--redis-password", help="Password of the real Redis server")
+parser.add_argument("--no-ssl", action="store_true", help="Connect to the real Redis server without SSL")
+args = parser.parse_args()
+
+
+class RoundTripCountingRedis:
+    """Wraps a Redis client, counting round-trips and adding the simulated latency to each."""
+
+    def __init__(self, redis_client, latency_seconds):
+        """Constructor."""
+        self.redis_client = redis_client
+        self.latency_seconds = latency_seconds
+        self.round_trips = 0
+
+    async def round_trip(self):
+        """Count a round-trip and wait for the simulated latency."""
+        self.round_trips += 1
+        if self.latency_seconds:
+            await asyncio.sleep(self.latency_seconds)
+
+    async def get(self, key):
+        """Send a GET."""
+        value = await self.redis_client.get(key)
+        await self.round_trip()
+        return value
+
+    async def set(self, key, value):
+        """Send a SET."""
+        # note: the latency is added before writing, so racing replicas overwrite each other like over a network
+        await self.round_trip()
+        return await self.redis_client.set(key, value)
+
+    def pipeline(self, transaction=True):
+        """Return a pipeline whose execution counts as one round-trip."""
+        pipeline = self.redis_client.pipeline(transaction=transaction)
+        execute = pipeline.execute
+
+        async def execute_with_round_trip():
+            await self.round_trip()
+            return await execute()
+
+        pipeline.execute = execute_with_round_trip
+        return pipeline
+
+    def register_script(self, script):
+        """Register the given Lua script."""
+        return self.redis_client.register_script(script)
+
+
+class PreviousReplica:
+    """Replica admitting and debiting requests like the LimitUsage plugin did before."""
+
+    def __init__(self, redis_client):
+        """Constructor."""
+        self.redis_client = redis_client
+
+    async def admit_and_debit(self, key):
+        """Admit and debit a request, returning True if admitted."""
+        current_minute = int(time.time() / 60)
+        current_minute_from_cache = int(await self.redis_client.get(f"LimitUsage-{key}-minute") or 0)
+        if not current_minute_from_cache or current_minute_from_cache != current_minute:
+            await self.redis_client.set(f"LimitUsage-{key}-minute", current_minute)
+            await self.redis_client.set(f"LimitUsage-{key}-budget", args.max_tokens_per_minute)
+        current_minute_from_cache = int(await self.redis_client.get(f"LimitUsage-{key}-minute"))
+        current_budget_from_cache = int(await self.redis_client.get(f"LimitUsage-{key}-budget"))
+        if current_minute_from_cache == current_minute and current_budget_from_cache <= 0:
+            return False
+        old_budget = int(await self.redis_client.get(f"LimitUsage-{key}-budget"))
+        await self.redis_client.set(f"LimitUsage-{key}-budget", old_budget - args.tokens)
+        return True
+
+    async def finish(self):
+        """Finish the replica's work."""
+
+    @staticmethod
+    async def get_used_tokens(redis_client, key):
+        """Return the tokens used as recorded in Redis."""
+        return args.max_tokens_per_minute - int(await redis_client.get(f"LimitUsage-{key}-budget"))
+
+
+class CurrentReplica(PreviousReplica):
+    """Replica admitting and debiting requests like the LimitUsage plugin does now without budget leasing."""
+
+    def __init__(self, redis_client):
+        """Constructor."""
+        super().__init__(redis_client)
+        self.usage_storage = RedisUsageStorage(redis_client)
+
+    async def admit_and_debit(self, key):
+        """Admit and debit a request, returning True if admitted."""
+        current_minute = int(time.time() / 60)
+        if await self.usage_storage.get_used_tokens(key, current_minute) >= args.max_tokens_per_minute:
+            return False
+        await self.usage_storage.add_used_tokens(key, current_minute, args.tokens)
+        return True
+
+    @staticmethod
+    async def get_used_tokens(redis_client, key):
+        """Return the tokens used as recorded in Redis."""
+        return await RedisUsageStorage(redis_client).get_used_tokens(key, int(time.time() / 60))
+
+
+class LeasingReplica(CurrentReplica):
+    """Replica admitting and debiting requests like the LimitUsage plugin does now with budget leasing."""
+
+    def __init__(self, redis_client):
+        """Constructor."""
+        super().__init__(redis_client)
+        self.usage_leases = UsageLeases(self.usage_storage)
+
+    async def admit_and_debit(self, key):
+        """Admit and debit a request, returning True if admitted."""
+        current_minute = int(time.time() / 60)
+        if not await self.usage_leases.try_admit(key, current_minute, args.max_tokens_per_minute):
+            return False
+        await self.usage_leases.add_used_tokens(key, current_minute, args.tokens)
+        return True
+
+    async def finish(self):
+        """Return the unused leases, like at the end of a minute."""
+        await self.usage_leases.return_leases()
+
+
+def get_redis_client():
+    """Return the Redis client to benchmark against."""
+    if args.redis_host:
+        return redis.asyncio.Redis(
+            host=args.redis_host,
+            port=args.redis_port,
+            db=0,
+            password=args.redis_password,
+            ssl=not args.no_ssl,
+        )
+    import fakeredis  # pylint: disable=import-outside-toplevel
+
+    return fakeredis.FakeAsyncRedis()
+
+
+async def run(name, replica_class):
+    """Run the given implementation with concurrent replicas and print the results."""
+    key = f"benchmark-{name}-{time.time_ns()}"
+    redis_client = RoundTripCountingRedis(get_redis_client(), 0 if args.redis_host else args.latency_ms / 1000)
+    admitted_requests = 0
+
+    async def run_replica():
+        nonlocal admitted_requests
+        replica = replica_class(redis_client)
+        for _ in range(args.requests):
+            is_admitted = await replica.admit_and_debit(key)
+            admitted_requests += is_admitted
+        await replica.finish()
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run_replica() for _ in range(args.replicas)))
+    duration = time.perf_counter() - start
+
+    requests = args.replicas * args.requests
+    used_tokens = admitted_requests * args.tokens
+    recorded_tokens = await replica_class.get_used_tokens(redis_client.redis_client, key)
+    print(
+        f"{name:>10}: {redis_client.round_trips / requests:6.3f} round-trips/request, "
+        f"{duration / requests * 1000:6.3f} ms/request, "
+        f"{admitted_requests:>6} of {requests} requests admitted, "
+        f"{recorded_tokens:>9} of {used_tokens} tokens recorded "
+        f"({(used_tokens - recorded_tokens) / used_tokens:6.1%} lost), "
+        f"{max(0, used_tokens - args.max_tokens_per_minute)} tokens over budget"
+    )
+
+
+async def main():
+    """Run all implementations."""
+    await run("previous", PreviousReplica)
+    await run("current", CurrentReplica)
+    await run("leasing", LeasingReplica)
+
+
+asyncio.run(main())
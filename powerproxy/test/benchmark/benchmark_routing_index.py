@@ -0,0 +1,88 @@
+"""
+Benchmarks the per-request cost of finding the candidate targets for a virtual deployment.
+
+Compares walking all configured targets (as PowerProxy did before the routing index was introduced) against a lookup in
+the routing index, for a growing number of endpoints. Run from the powerproxy folder:
+
+    python test/benchmark/benchmark_routing_index.py
+"""
+
+import argparse
+import random
+import sys
+import timeit
+
+sys.path.append("app")
+
+from helpers.routing import RoutingIndex  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--deployments-per-endpoint", type=int, default=4, help="Virtual deployments per endpoint")
+parser.add_argument("--standins-per-deployment", type=int, default=2, help="Standins per virtual deployment")
+parser.add_argument("--lookups", type=int, default=20_000, help="Number of lookups per measurement")
+args = parser.parse_args()
+
+
+def get_targets(endpoint_count):
+    """Return synthetic targets for the given number of endpoints."""
+    targets = []
+    for endpoint in range(endpoint_count):
+        for deployment in range(args.deployments_per_endpoint):
+            for standin in range(args.standins_per_deployment):
+                targets.append(
+                    {
+                        "name": f"standin-{standin}@deployment-{deployment}@endpoint-{endpoint}",
+                        "type": "virtual_deployment_standin",
+                        "endpoint": f"endpoint-{endpoint}",
+                        "virtual_deployment": f"deployment-{deployment}",
+                        "standin": f"standin-{standin}",
+                        "priority": 0,
+                        "weight": 1.0,
+                        "max_outstanding_requests": None,
+                    }
+                )
+    return targets
+
+
+def get_candidates_by_scanning(targets, virtual_deployment_names, virtual_deployment):
+    """Return the candidate targets by walking all targets."""
+    if virtual_deployment not in virtual_deployment_names:
+        return []
+    return [
+        target
+        for target in targets
+        if not (
+            target["type"] == "virtual_deployment_standin" and virtual_deployment != target["virtual_deployment"]
+        )
+    ]
+
+
+def get_candidates_from_index(routing_index, virtual_deployment):
+    """Return the candidate targets from the routing index."""
+    if not routing_index.is_virtual_deployment_available(virtual_deployment):
+        return []
+    return routing_index.get_targets(virtual_deployment)
+
+
+print(f"{'endpoints':>10} {'targets':>8} {'scan (µs/request)':>18} {'index (µs/request)':>19}")
+for endpoint_count in [1, 10, 50, 100, 500]:
+    targets = get_targets(endpoint_count)
+    virtual_deployment_names = [target["virtual_deployment"] for target in targets]
+    routing_index = RoutingIndex(targets)
+    requested_deployments = [f"deployment-{random.randrange(args.deployments_per_endpoint)}" for _ in range(100)]
+    scan_seconds = timeit.timeit(
+        lambda: [
+            get_candidates_by_scanning(targets, virtual_deployment_names, deployment)
+            for deployment in requested_deployments
+        ],
+        number=max(1, args.lookups // 100),
+    )
+    index_seconds = timeit.timeit(
+        lambda: [get_candidates_from_index(routing_index, deployment) for deployment in requested_deployments],
+        number=max(1, args.lookups // 100),
+    )
+    lookups = max(1, args.lookups // 100) * 100
+    print(
+        f"{endpoint_count:>10} {len(targets):>8} {scan_seconds / lookups * 1e6:>18.2f} "
+        f"{index_seconds / lookups * 1e6:>19.2f}"
+    )
@@ -0,0 +1,130 @@
+"""
+Benchmarks the per-token cost of forwarding a streamed (SSE) response from AOAI to the client.
+
+Compares decoding the stream into lines and re-encoding each line (as PowerProxy did before the SSE passthrough was
+introduced) against forwarding the received byte chunks unchanged, both with and without scanning the chunks for data
+events. The stream is synthetic and split into chunks of random size, like chunks received from the network. Run from
+the powerproxy folder:
+
+    python test/benchmark/benchmark_sse_passthrough.py
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import sys
+import time
+
+import httpx
+
+sys.path.append("app")
+
+from helpers.sse import ServerSentEventScanner  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--tokens", type=int, default=200_000, help="Number of streamed tokens (data events)")
+parser.add_argument("--max-chunk-size", type=int, default=512, help="Maximum size of chunks received from AOAI")
+parser.add_argument("--rounds", type=int, default=3, help="Number of measurements per path, the best one is reported")
+args = parser.parse_args()
+
+
+class ChunkStream(httpx.AsyncByteStream):
+    """Stream returning the given chunks."""
+
+    def __init__(self, chunks):
+        """Constructor."""
+        self.chunks = chunks
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+
+
+def get_chunks():
+    """Return a synthetic event stream with the given number of tokens, split into chunks of random size."""
+    events = [
+        "data: "
+        + json.dumps(
+            {
+                "id": "chatcmpl-123",
+                "object": "chat.completion.chunk",
+                "model": "gpt-4o",
+                "choices": [{"index": 0, "delta": {"content": f"token{index} "}, "finish_reason": None}],
+            }
+        )
+        + "\n\n"
+        for index in range(args.tokens)
+    ]
+    stream = ("".join(events) + "data: [DONE]\n\n").encode()
+    chunks = []
+    position = 0
+    while position < len(stream):
+        chunk_size = random.randint(1, args.max_chunk_size)
+        chunks.append(stream[position : position + chunk_size])
+        position += chunk_size
+    return chunks
+
+
+def get_response(chunks):
+    """Return a streamed response for the given chunks."""
+    return httpx.Response(200, headers={"content-type": "text/event-stream"}, stream=ChunkStream(chunks))
+
+
+async def forward_lines(chunks):
+    """Forward the stream line by line, invoking a no-op data event hook per data line."""
+    data_events = 0
+    async for line in get_response(chunks).aiter_lines():
+        output = f"{line}\r\n"
+        if line.startswith("data: "):
+            data = line[6:]
+            if data != "[DONE]":
+                data_events += 1
+        del output
+    return data_events
+
+
+async def forward_raw(chunks):
+    """Forward the byte chunks unchanged, without scanning for data events."""
+    async for chunk in get_response(chunks).aiter_raw():
+        del chunk
+    return 0
+
+
+async def forward_raw_and_scan(chunks):
+    """Forward the byte chunks unchanged, scanning them for data events and decoding the data of each event."""
+    data_events = 0
+    sse_scanner = ServerSentEventScanner()
+    async for chunk in get_response(chunks).aiter_raw():
+        for data in sse_scanner.feed(chunk):
+            if data != b"[DONE]":
+                data.decode()
+                data_events += 1
+    for data in sse_scanner.flush():
+        if data != b"[DONE]":
+            data_events += 1
+    return data_events
+
+
+def measure(forward, chunks):
+    """Return the best wall clock and CPU time and the number of data events seen for the given forward function."""
+    best_wall_seconds, best_cpu_seconds, data_events = None, None, None
+    for _ in range(args.rounds):
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        data_events = asyncio.run(forward(chunks))
+        wall_seconds, cpu_seconds = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        best_wall_seconds = min(best_wall_seconds or wall_seconds, wall_seconds)
+        best_cpu_seconds = min(best_cpu_seconds or cpu_seconds, cpu_seconds)
+    return best_wall_seconds, best_cpu_seconds, data_events
+
+
+chunks = get_chunks()
+stream_size_mb = sum(len(chunk) for chunk in chunks) / 1_000_000
+print(f"{args.tokens} tokens, {len(chunks)} chunks, {stream_size_mb:.1f} MB")
+print(f"{'path':>14} {'data events':>12} {'MB/s':>8} {'CPU (µs/token)':>15}")
+for name, forward in [("lines", forward_lines), ("raw", forward_raw), ("raw + scan", forward_raw_and_scan)]:
+    wall_seconds, cpu_seconds, data_events = measure(forward, chunks)
+    print(
+        f"{name:>14} {data_events if forward is not forward_raw else '-':>12} "
+        f"{stream_size_mb / wall_seconds:>8.1f} {cpu_seconds / args.tokens * 1e6:>15.2f}"
+    )
@@ -0,0 +1,125 @@
+"""
+Benchmarks counting the completion tokens of streamed chat completions.
+
+Compares the previous approach (counting one token per data event) against the current one (collecting the text of the
+deltas and encoding it in batches off the event loop, see StreamedCompletionTokenCounter) for recorded-like event
+streams of growing length. Prints the time spent on the event loop per event and per stream as well as the counted
+tokens next to the exact number of tokens of the streamed text. Run from the powerproxy folder:
+
+    python test/benchmark/benchmark_streamed_token_counting.py
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+import time
+
+sys.path.append("app")
+
+from helpers.tokens import (  # pylint: disable=wrong-import-position
+    StreamedCompletionTokenCounter,
+    get_encoding_for_model,
+)
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--model", default="gpt-4o", help="Model or deployment name the requests are sent to")
+parser.add_argument("--repetitions", type=int, default=20, help="Number of streams counted per measurement")
+args = parser.parse_args()
+
+# number of data events of the benchmarked streams
+STREAM_LENGTHS = (50, 500, 5_000)
+
+# words streamed in the deltas, cycled through
+WORDS = ("The", " proxy", " forwards", " each", " chunk", " unchanged", ",", " and", " counts", " tokens", ".", "\n")
+
+
+def get_events(event_count):
+    """Return the data of the events of a synthetic stream as sent by AOAI, and the text streamed in it."""
+    events = [
+        json.dumps({"choices": [], "created": 0, "id": "", "model": "", "object": "", "prompt_filter_results": []})
+    ]
+    texts = []
+    for index in range(event_count):
+        text = WORDS[index % len(WORDS)]
+        texts.append(text)
+        events.append(
+            json.dumps(
+                {
+                    "choices": [
+                        {
+                            "content_filter_results": {"hate": {"filtered": False, "severity": "safe"}},
+                            "delta": {"content": text},
+                            "finish_reason": None,
+                            "index": 0,
+                            "logprobs": None,
+                        }
+                    ],
+                    "created": 1_700_000_000,
+                    "id": "chatcmpl-0123456789",
+                    "model": "gpt-4o-2024-08-06",
+                    "object": "chat.completion.chunk",
+                    "system_fingerprint": "fp_0123456789",
+                }
+            )
+        )
+    return [event.encode() for event in events], "".join(texts)
+
+
+def count_previously(events):
+    """Return the completion tokens of the given events, as PowerProxy counted them before."""
+    completion_tokens = None
+    for _ in events:
+        completion_tokens = completion_tokens + 1 if completion_tokens else 1
+    return completion_tokens
+
+
+async def count_currently(events):
+    """Return the completion tokens of the given events and the seconds spent on the event loop for them."""
+    loop_seconds = 0.0
+    token_counter = StreamedCompletionTokenCounter(args.model)
+    for event in events:
+        start_time = time.perf_counter()
+        token_counter.feed(event)
+        loop_seconds += time.perf_counter() - start_time
+        # note: yield to the event loop as if the event was forwarded to the client
+        await asyncio.sleep(0)
+    start_time = time.perf_counter()
+    tokens_task = asyncio.ensure_future(token_counter.get_tokens())
+    # note: the time waiting for the batches encoded off the event loop is not spent on the event loop
+    while not tokens_task.done():
+        loop_seconds += time.perf_counter() - start_time
+        await asyncio.sleep(0)
+        start_time = time.perf_counter()
+    return tokens_task.result(), loop_seconds
+
+
+async def main():
+    """Run the benchmark."""
+    encoding = get_encoding_for_model(args.model)
+    for event_count in STREAM_LENGTHS:
+        events, text = get_events(event_count)
+        exact_tokens = len(encoding.encode_ordinary(text))
+
+        start_time = time.perf_counter()
+        for _ in range(args.repetitions):
+            tokens = count_previously(events)
+        seconds = (time.perf_counter() - start_time) / args.repetitions
+        print(
+            f"{event_count:>6} events, previous: {seconds / len(events) * 1_000_000:6.2f} µs/event on loop, "
+            f"{seconds * 1_000:8.2f} ms/stream on loop, {tokens:>6} tokens (exact: {exact_tokens})"
+        )
+
+        # note: the first count loads the encoding, which is not part of the per-stream cost
+        await count_currently(events)
+        seconds = 0.0
+        for _ in range(args.repetitions):
+            tokens, loop_seconds = await count_currently(events)
+            seconds += loop_seconds / args.repetitions
+        print(
+            f"{event_count:>6} events,  current: {seconds / len(events) * 1_000_000:6.2f} µs/event on loop, "
+            f"{seconds * 1_000:8.2f} ms/stream on loop, {tokens:>6} tokens (exact: {exact_tokens})"
+        )
+
+
+asyncio.run(main())
@@ -0,0 +1,116 @@
+"""
+Benchmarks the per-request CPU time of estimating the prompt tokens of a chat completion request.
+
+Compares the previous implementation (resolving the encoding of gpt-3.5-turbo-0613 for every request and encoding the
+message fields one by one) against the current one (encodings resolved once per model or deployment name, encoding the
+fields of large requests in a batch), for requests of growing size. Also prints the estimated tokens, which differ for
+models using another encoding than gpt-3.5-turbo (e.g. o200k_base for gpt-4o). Also compares both for vision requests
+with base64-encoded images of growing size, whose data is no longer encoded. Run from the powerproxy folder:
+
+    python test/benchmark/benchmark_token_estimation.py
+"""
+
+import argparse
+import base64
+import os
+import struct
+import sys
+import timeit
+
+import tiktoken
+
+sys.path.append("app")
+
+from helpers.tokens import estimate_tokens_from_messages  # pylint: disable=wrong-import-position
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--model", default="gpt-4o", help="Model or deployment name the requests are sent to")
+parser.add_argument("--repetitions", type=int, default=200, help="Number of estimations per measurement")
+args = parser.parse_args()
+
+# number of messages and words per message of the benchmarked requests
+REQUEST_SIZES = ((4, 50), (20, 200), (100, 2_000))
+
+# sizes in bytes of the images in the benchmarked vision requests
+IMAGE_SIZES = (100_000, 1_000_000, 5_000_000)
+
+
+def estimate_tokens_from_messages_previously(messages):
+    """Return the estimated number of tokens used by a list of messages, as PowerProxy did before."""
+    try:
+        encoding = tiktoken.encoding_for_model("gpt-3.5-turbo-0613")
+    except KeyError:
+        encoding = tiktoken.get_encoding("cl100k_base")
+    num_tokens = 0
+    for message in messages:
+        num_tokens += 3
+        for key, value in message.items():
+            num_tokens += len(encoding.encode(f"{value}"))
+            if key == "name":
+                num_tokens += 1
+    return num_tokens + 3
+
+
+def get_messages(message_count, words_per_message):
+    """Return synthetic chat messages of the given size."""
+    return [
+        {
+            "role": "user" if index % 2 == 0 else "assistant",
+            "content": " ".join(
+                f"word{(index * words_per_message + word) % 1_000}" for word in range(words_per_message)
+            ),
+        }
+        for index in range(message_count)
+    ]
+
+
+def get_vision_messages(image_size):
+    """Return chat messages with a synthetic base64-encoded PNG image of the given size (1920x1080 px)."""
+    image = (
+        b"\x89PNG\r\n\x1a\n"
+        + struct.pack(">I", 13)
+        + b"IHDR"
+        + struct.pack(">IIBBBBB", 1920, 1080, 8, 2, 0, 0, 0)
+        + os.urandom(image_size)
+    )
+    return [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": "What's in this image?"},
+                {
+                    "type": "image_url",
+                    "image_url": {"url": f"data:image/png;base64,{base64.b64encode(image).decode()}"},
+                },
+            ],
+        }
+    ]
+
+
+for message_count, words_per_message in REQUEST_SIZES:
+    messages = get_messages(message_count, words_per_message)
+    for name, estimate in (
+        ("previous", estimate_tokens_from_messages_previously),
+        ("current", lambda messages: estimate_tokens_from_messages(messages, args.model)),
+    ):
+        # note: the first estimation loads the encoding, which is not part of the per-request cost
+        tokens = estimate(messages)
+        seconds = timeit.timeit(lambda: estimate(messages), number=args.repetitions) / args.repetitions
+        print(
+            f"{message_count:>4} messages x {words_per_message:>5} words, {name:>8}: "
+            f"{seconds * 1_000_000:10.1f} µs/request, {tokens:>8} tokens"
+        )
+
+for image_size in IMAGE_SIZES:
+    messages = get_vision_messages(image_size)
+    for name, estimate in (
+        ("previous", estimate_tokens_from_messages_previously),
+        ("current", lambda messages: estimate_tokens_from_messages(messages, args.model)),
+    ):
+        tokens = estimate(messages)
+        repetitions = max(1, args.repetitions // 100) if name == "previous" else args.repetitions
+        seconds = timeit.timeit(lambda: estimate(messages), number=repetitions) / repetitions
+        print(
+            f"image of {image_size / 1_000_000:4.1f} MB, {name:>8}: "
+            f"{seconds * 1_000_000:10.1f} µs/request, {tokens:>8} tokens"
+        )
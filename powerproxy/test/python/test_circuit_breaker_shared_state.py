@@ -0,0 +1,133 @@
+"""
+Tests of the circuit breakers of several workers sharing the targets' state in shared memory.
+
+The workers are simulated by separate target states attached to the same shared memory, each with its own worker slot.
+Covers that a breaker opened by one worker blocks the target for all workers, that afterwards all workers are half-open
+and compete for the same probes, and that a probe of any worker closes the breakers of all workers. Does not need a
+running PowerProxy.
+"""
+
+import argparse
+import os
+import sys
+import uuid
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+# pylint: disable=wrong-import-position
+from helpers.circuit_breaker import CLOSED, HALF_OPEN, OPEN, CircuitBreaker, CircuitBreakerSettings
+from helpers.shared_state import TargetStates
+
+# pylint: enable=wrong-import-position
+
+# note: the arguments passed by run_tests.py are not needed here
+parser = argparse.ArgumentParser()
+args, unknown = parser.parse_known_args()
+
+
+def get_circuit_breakers_of_workers(worker_count, half_open_max_probes=1):
+    """Return the target states of the given number of workers sharing their state, and their circuit breakers."""
+    shared_memory_name = f"powerproxy_test_{uuid.uuid4().hex[:16]}"
+    settings = CircuitBreakerSettings(half_open_max_probes=half_open_max_probes)
+    target_states_of_workers = [
+        TargetStates(["target"], max_workers=worker_count, shared_memory_name=shared_memory_name)
+        for _ in range(worker_count)
+    ]
+    assert len({target_states.worker_slot for target_states in target_states_of_workers}) == worker_count
+    circuit_breakers = [
+        CircuitBreaker("target", settings, target_states.get_target_state("target"))
+        for target_states in target_states_of_workers
+    ]
+    return target_states_of_workers, circuit_breakers
+
+
+def close_target_states(target_states_of_workers):
+    """Release the shared memory of the given target states."""
+    for target_states in target_states_of_workers:
+        target_states.close()
+
+
+def test_opening_blocks_all_workers():
+    """Test that a breaker opened by one worker blocks the target for all workers until its open time has passed."""
+    target_states_of_workers, (breaker_a, breaker_b) = get_circuit_breakers_of_workers(2)
+    try:
+        assert breaker_a.try_acquire_permission(0) == (True, False)
+        breaker_a.record_failure(0, retry_after_ms=1_000)
+        assert breaker_a.state == OPEN
+        assert breaker_a.try_acquire_permission(500) == (False, False)
+        assert breaker_b.try_acquire_permission(500) == (False, False)
+        assert not breaker_b.is_request_permitted(500)
+    finally:
+        close_target_states(target_states_of_workers)
+    print("Opening blocks all workers: OK")
+
+
+def test_all_workers_compete_for_probes():
+    """Test that all workers are half-open after the open time and that the limit of probes applies to all of them."""
+    target_states_of_workers, (breaker_a, breaker_b, breaker_c) = get_circuit_breakers_of_workers(3)
+    try:
+        breaker_a.record_failure(0, retry_after_ms=1_000)
+
+        # the breaker of worker b never saw a failure, but must not send full traffic once the open time has passed
+        assert breaker_b.is_request_permitted(1_500)
+        assert breaker_b.try_acquire_permission(1_500) == (True, True)
+        assert breaker_b.state == HALF_OPEN
+        # the probe of worker b is the only one allowed, for all workers
+        assert breaker_a.try_acquire_permission(1_500) == (False, False)
+        assert breaker_c.try_acquire_permission(1_500) == (False, False)
+        assert breaker_b.try_acquire_permission(1_500) == (False, False)
+        assert not breaker_c.is_request_permitted(1_500)
+
+        # a released probe frees the slot for any worker
+        breaker_b.release_permission(True)
+        assert breaker_c.try_acquire_permission(1_600) == (True, True)
+        assert breaker_a.try_acquire_permission(1_600) == (False, False)
+    finally:
+        close_target_states(target_states_of_workers)
+    print("All workers compete for probes: OK")
+
+
+def test_probe_closes_all_workers():
+    """Test that a successful probe of any worker closes the breakers of all workers."""
+    target_states_of_workers, (breaker_a, breaker_b) = get_circuit_breakers_of_workers(2)
+    try:
+        breaker_a.record_failure(0, retry_after_ms=1_000)
+        assert breaker_b.try_acquire_permission(1_500) == (True, True)
+        breaker_b.record_success(1_600, 100, is_probe=True)
+        assert breaker_b.state == CLOSED
+
+        # the worker which opened the breaker closes it as well and sends full traffic again
+        assert breaker_a.try_acquire_permission(1_700) == (True, False)
+        assert breaker_a.state == CLOSED
+        assert breaker_a.try_acquire_permission(1_700) == (True, False)
+        assert breaker_b.try_acquire_permission(1_700) == (True, False)
+    finally:
+        close_target_states(target_states_of_workers)
+    print("Probe closes all workers: OK")
+
+
+def test_failed_probe_opens_all_workers():
+    """Test that a failed probe of any worker opens the breakers of all workers again."""
+    target_states_of_workers, (breaker_a, breaker_b) = get_circuit_breakers_of_workers(2)
+    try:
+        breaker_a.record_failure(0, retry_after_ms=1_000)
+        assert breaker_b.try_acquire_permission(1_500) == (True, True)
+        breaker_b.record_failure(1_600, retry_after_ms=1_000, is_probe=True)
+        assert breaker_b.state == OPEN
+        assert breaker_a.try_acquire_permission(2_000) == (False, False)
+
+        # afterwards, both workers are half-open again
+        assert breaker_a.try_acquire_permission(2_700) == (True, True)
+        assert breaker_b.try_acquire_permission(2_700) == (False, False)
+        breaker_a.record_success(2_800, 100, is_probe=True)
+        assert breaker_b.try_acquire_permission(2_900) == (True, False)
+        assert breaker_b.state == CLOSED
+    finally:
+        close_target_states(target_states_of_workers)
+    print("Failed probe opens all workers: OK")
+
+
+test_opening_blocks_all_workers()
+test_all_workers_compete_for_probes()
+test_probe_closes_all_workers()
+test_failed_probe_opens_all_workers()
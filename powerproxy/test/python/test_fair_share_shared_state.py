@@ -0,0 +1,137 @@
+"""
+Tests of the fair share schedulers of several workers sharing the clients' requests in shared memory.
+
+The workers are simulated by separate target states attached to the same shared memory, each with its own worker slot
+and fair share scheduler. Covers that a client's requests in flight at all workers count towards its share, that the
+activity of a client at any worker keeps its share reserved, and that the shares of idle clients go to the others.
+Does not need a running PowerProxy.
+"""
+
+import argparse
+import os
+import sys
+import uuid
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+# pylint: disable=wrong-import-position
+from helpers.fair_share import FairShareScheduler
+from helpers.shared_state import TargetStates
+
+# pylint: enable=wrong-import-position
+
+# note: the arguments passed by run_tests.py are not needed here
+parser = argparse.ArgumentParser()
+args, unknown = parser.parse_known_args()
+
+FAIR_SHARE_CONFIG = {"activity_window_ms": 10_000}
+CLIENTS_CONFIG = [{"name": "heavy"}, {"name": "light"}]
+TIER_TARGETS = [{"name": "ptu-1", "max_outstanding_requests": 2}, {"name": "ptu-2", "max_outstanding_requests": 2}]
+
+
+def get_fair_share_schedulers_of_workers(worker_count):
+    """Return the target states of the given number of workers sharing their state, and their fair share schedulers."""
+    shared_memory_name = f"powerproxy_test_{uuid.uuid4().hex[:16]}"
+    fair_share_keys = FairShareScheduler.get_fair_share_keys(FAIR_SHARE_CONFIG, CLIENTS_CONFIG, ["gpt-4o"])
+    target_states_of_workers = [
+        TargetStates(
+            [target["name"] for target in TIER_TARGETS],
+            max_workers=worker_count,
+            shared_memory_name=shared_memory_name,
+            fair_share_keys=fair_share_keys,
+        )
+        for _ in range(worker_count)
+    ]
+    assert len({target_states.worker_slot for target_states in target_states_of_workers}) == worker_count
+    fair_share_schedulers = [
+        FairShareScheduler.from_config(FAIR_SHARE_CONFIG, CLIENTS_CONFIG, target_states)
+        for target_states in target_states_of_workers
+    ]
+    return target_states_of_workers, fair_share_schedulers
+
+
+def close_target_states(target_states_of_workers):
+    """Release the shared memory of the given target states."""
+    for target_states in target_states_of_workers:
+        target_states.close()
+
+
+def try_acquire(fair_share_scheduler, client, now_timestamp_ms):
+    """Acquire the first tier for a request of the given client if permitted, and return whether it was permitted."""
+    if not fair_share_scheduler.is_tier_permitted("gpt-4o", client, TIER_TARGETS, now_timestamp_ms):
+        return False
+    fair_share_scheduler.acquire("gpt-4o", client)
+    return True
+
+
+def test_share_applies_to_all_workers():
+    """Test that a client's requests in flight at all workers count towards its share."""
+    target_states_of_workers, (scheduler_a, scheduler_b) = get_fair_share_schedulers_of_workers(2)
+    try:
+        # the light client is active at worker b, so the heavy client is entitled to half of the capacity of 4
+        assert try_acquire(scheduler_b, "light", 0)
+        scheduler_b.release("gpt-4o", "light")
+
+        # the heavy client sends its requests to both workers, but gets its share only once
+        assert try_acquire(scheduler_a, "heavy", 100)
+        assert try_acquire(scheduler_b, "heavy", 100)
+        assert not try_acquire(scheduler_a, "heavy", 100)
+        assert not try_acquire(scheduler_b, "heavy", 100)
+
+        # the light client still gets its share, at any worker
+        assert try_acquire(scheduler_a, "light", 200)
+        assert try_acquire(scheduler_b, "light", 200)
+
+        # once the heavy client's request at worker a is done, it may send another request to any worker
+        scheduler_a.release("gpt-4o", "heavy")
+        assert try_acquire(scheduler_b, "heavy", 300)
+        assert not try_acquire(scheduler_a, "heavy", 300)
+    finally:
+        close_target_states(target_states_of_workers)
+    print("Share applies to all workers: OK")
+
+
+def test_idle_shares_go_to_active_clients():
+    """Test that the share of a client idle at all workers goes to the other clients."""
+    target_states_of_workers, (scheduler_a, scheduler_b) = get_fair_share_schedulers_of_workers(2)
+    try:
+        assert try_acquire(scheduler_b, "light", 0)
+        scheduler_b.release("gpt-4o", "light")
+
+        # the light client's activity at worker b reserves its share at worker a as well
+        assert try_acquire(scheduler_a, "heavy", 5_000)
+        assert try_acquire(scheduler_a, "heavy", 5_000)
+        assert not try_acquire(scheduler_a, "heavy", 5_000)
+
+        # once the light client has been idle for the activity window, the heavy client may use the full capacity
+        assert try_acquire(scheduler_b, "heavy", 10_001)
+        assert try_acquire(scheduler_a, "heavy", 10_001)
+        assert not try_acquire(scheduler_b, "heavy", 10_001)
+    finally:
+        close_target_states(target_states_of_workers)
+    print("Idle shares go to active clients: OK")
+
+
+def test_requests_without_virtual_deployment():
+    """Test that requests for deployments which are not virtual share the fair share states of the other targets."""
+    target_states_of_workers, (scheduler_a, scheduler_b) = get_fair_share_schedulers_of_workers(2)
+    try:
+        assert try_acquire(scheduler_a, "light", 0)
+        scheduler_a.release("gpt-4o", "light")
+        assert scheduler_a.is_tier_permitted("some-deployment", "heavy", TIER_TARGETS, 100)
+        scheduler_a.acquire("some-deployment", "heavy")
+        scheduler_b.acquire("other-deployment", "heavy")
+        assert scheduler_b.get_fair_share_states("some-deployment")["heavy"].get_requests_in_flight() == 2
+        # note: the virtual deployment has its own states
+        assert scheduler_b.get_fair_share_states("gpt-4o")["heavy"].get_requests_in_flight() == 0
+        scheduler_a.release("some-deployment", "heavy")
+        scheduler_b.release("other-deployment", "heavy")
+        assert scheduler_a.get_fair_share_states("some-deployment")["heavy"].get_requests_in_flight() == 0
+    finally:
+        close_target_states(target_states_of_workers)
+    print("Requests without virtual deployment: OK")
+
+
+test_share_applies_to_all_workers()
+test_idle_shares_go_to_active_clients()
+test_requests_without_virtual_deployment()
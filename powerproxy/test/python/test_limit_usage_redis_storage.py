@@ -0,0 +1,188 @@
+"""
+Tests of the Redis usage storage of the LimitUsage plugin, against an in-process fakeredis server.
+
+Covers the fixed-window usage (INCRBY and EXPIRE), the theoretical arrival time used by mode 'gcra' (Lua script),
+including the rollback of rejected requests, and the concurrency slots (Lua script). Does not need a running
+PowerProxy or Redis server.
+
+Requires fakeredis with Lua support: pip install "fakeredis[lua]"
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+import uuid
+
+import fakeredis
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "app"))
+
+# pylint: disable=wrong-import-position
+from plugins.LimitUsage.LimitUsage import GCRA, LimitUsage
+from plugins.LimitUsage.UsageStorage import (
+    THEORETICAL_ARRIVAL_TIME_EXPIRY_MARGIN_MS,
+    USAGE_EXPIRY_SECONDS,
+    RedisUsageStorage,
+    UsageStorage,
+)
+
+# pylint: enable=wrong-import-position
+
+# note: the arguments passed by run_tests.py are not needed here
+parser = argparse.ArgumentParser()
+args, unknown = parser.parse_known_args()
+
+
+def get_storage():
+    """Return a Redis usage storage on a new, empty fakeredis server, and the Redis client."""
+    redis_client = fakeredis.FakeAsyncRedis(server=fakeredis.FakeServer())
+    return RedisUsageStorage(redis_client), redis_client
+
+
+def get_now_timestamp_ms():
+    """Return the current time in ms, as the storage's expiry times are relative to the current time of Redis."""
+    return int(time.time() * 1000)
+
+
+async def test_used_tokens():
+    """Test adding and reading the tokens used per key and minute."""
+    usage_storage, redis_client = get_storage()
+    minute = get_now_timestamp_ms() // 60_000
+
+    assert await usage_storage.get_used_tokens("client-a", minute) == 0
+    assert await usage_storage.add_used_tokens("client-a", minute, 100) == 100
+    assert await usage_storage.add_used_tokens("client-a", minute, 50) == 150
+    assert await usage_storage.add_used_tokens("client-a", minute, -30) == 120
+    assert await usage_storage.get_used_tokens("client-a", minute) == 120
+    # note: other keys and minutes are counted separately
+    assert await usage_storage.get_used_tokens("client-b", minute) == 0
+    assert await usage_storage.get_used_tokens("client-a", minute + 1) == 0
+
+    # several keys in one transaction
+    assert await usage_storage.add_used_tokens_for_keys(
+        [("client-a", minute, 10), ("client-b", minute, 20), ("client-a", minute + 1, 30)]
+    ) == [130, 20, 30]
+    assert await usage_storage.get_used_tokens("client-a", minute) == 130
+    assert await usage_storage.get_used_tokens("client-b", minute) == 20
+    assert await usage_storage.get_used_tokens("client-a", minute + 1) == 30
+
+    # the usage of a minute expires
+    ttl = await redis_client.ttl(UsageStorage.get_usage_key("client-a", minute))
+    assert 0 < ttl <= USAGE_EXPIRY_SECONDS, ttl
+    print("Used tokens: OK")
+
+
+async def test_theoretical_arrival_time():
+    """Test advancing the theoretical arrival time with the Lua script."""
+    usage_storage, redis_client = get_storage()
+    now_timestamp_ms = get_now_timestamp_ms()
+    tat_key = UsageStorage.get_theoretical_arrival_time_key("client-a")
+
+    # without a theoretical arrival time, it starts from now
+    assert await usage_storage.get_theoretical_arrival_timestamp_ms("client-a") == 0
+    assert (
+        await usage_storage.advance_theoretical_arrival_timestamp_ms("client-a", now_timestamp_ms, 1_000)
+        == now_timestamp_ms + 1_000
+    )
+    # a theoretical arrival time in the future is advanced from there
+    assert (
+        await usage_storage.advance_theoretical_arrival_timestamp_ms("client-a", now_timestamp_ms, 2_000)
+        == now_timestamp_ms + 3_000
+    )
+    assert await usage_storage.get_theoretical_arrival_timestamp_ms("client-a") == now_timestamp_ms + 3_000
+    # the key expires once the theoretical arrival time has passed (plus a margin)
+    pttl = await redis_client.pttl(tat_key)
+    assert 0 < pttl <= 3_000 + THEORETICAL_ARRIVAL_TIME_EXPIRY_MARGIN_MS, pttl
+
+    # negative increments release reserved tokens
+    assert (
+        await usage_storage.advance_theoretical_arrival_timestamp_ms("client-a", now_timestamp_ms, -2_000)
+        == now_timestamp_ms + 1_000
+    )
+
+    # a theoretical arrival time in the past is advanced from now
+    later_timestamp_ms = now_timestamp_ms + 5_000
+    assert (
+        await usage_storage.advance_theoretical_arrival_timestamp_ms("client-a", later_timestamp_ms, 1_000)
+        == later_timestamp_ms + 1_000
+    )
+    # note: other keys are not affected
+    assert await usage_storage.get_theoretical_arrival_timestamp_ms("client-b") == 0
+    print("Theoretical arrival time: OK")
+
+
+async def test_gcra_rollback():
+    """Test that LimitUsage in mode 'gcra' rolls back the theoretical arrival time of rejected requests."""
+    usage_storage, _ = get_storage()
+    limit_usage = LimitUsage(None, {})
+    limit_usage.mode = GCRA
+    limit_usage.burst_tolerance_ms = 30_000
+    limit_usage.usage_storage = usage_storage
+    now_timestamp_ms = get_now_timestamp_ms()
+
+    # 600 tokens per minute -> 100 tokens advance the theoretical arrival time by 10s
+    assert await limit_usage._try_reserve("client-a", 600, now_timestamp_ms, 100, None) == 0
+    assert await limit_usage._try_reserve("client-a", 600, now_timestamp_ms, 200, None) == 0
+    assert await limit_usage._try_reserve("client-a", 600, now_timestamp_ms, 100, None) == 0
+    assert await usage_storage.get_theoretical_arrival_timestamp_ms("client-a") == now_timestamp_ms + 40_000
+
+    # the burst tolerance is exceeded -> rejected, retry once the theoretical arrival time is within the tolerance
+    assert await limit_usage._try_reserve("client-a", 600, now_timestamp_ms, 100, None) == 10_000
+    # the rejected request must not have advanced the theoretical arrival time
+    assert await usage_storage.get_theoretical_arrival_timestamp_ms("client-a") == now_timestamp_ms + 40_000
+    # reading the retry time (no tokens) does not advance it either
+    assert await limit_usage._try_reserve("client-a", 600, now_timestamp_ms, 0, None) == 10_000
+    assert await usage_storage.get_theoretical_arrival_timestamp_ms("client-a") == now_timestamp_ms + 40_000
+
+    # after the retry time, the request is admitted
+    assert await limit_usage._try_reserve("client-a", 600, now_timestamp_ms + 10_000, 100, None) == 0
+    assert await usage_storage.get_theoretical_arrival_timestamp_ms("client-a") == now_timestamp_ms + 50_000
+    print("GCRA rollback: OK")
+
+
+async def test_concurrency_slots():
+    """Test acquiring, releasing and timing out concurrency slots with the Lua script."""
+    usage_storage, redis_client = get_storage()
+    now_timestamp_ms = get_now_timestamp_ms()
+    slot_timeout_ms = 60_000
+    slots_key = UsageStorage.get_slots_key("client-a")
+    slot_ids = [str(uuid.uuid4()) for _ in range(4)]
+
+    # slots are acquired up to the maximum
+    assert await usage_storage.try_acquire_slot("client-a", slot_ids[0], 2, now_timestamp_ms, slot_timeout_ms)
+    assert await usage_storage.try_acquire_slot("client-a", slot_ids[1], 2, now_timestamp_ms, slot_timeout_ms)
+    assert not await usage_storage.try_acquire_slot("client-a", slot_ids[2], 2, now_timestamp_ms, slot_timeout_ms)
+    assert await redis_client.zcard(slots_key) == 2
+    # note: other keys have their own slots
+    assert await usage_storage.try_acquire_slot("client-b", slot_ids[2], 2, now_timestamp_ms, slot_timeout_ms)
+    # the slots expire if no slot is acquired anymore
+    pttl = await redis_client.pttl(slots_key)
+    assert 0 < pttl <= slot_timeout_ms, pttl
+
+    # released slots can be acquired again
+    await usage_storage.release_slot("client-a", slot_ids[0])
+    assert await redis_client.zcard(slots_key) == 1
+    assert await usage_storage.try_acquire_slot("client-a", slot_ids[2], 2, now_timestamp_ms, slot_timeout_ms)
+    assert not await usage_storage.try_acquire_slot("client-a", slot_ids[3], 2, now_timestamp_ms, slot_timeout_ms)
+    # note: releasing a slot which is not held has no effect
+    await usage_storage.release_slot("client-a", slot_ids[0])
+    assert await redis_client.zcard(slots_key) == 2
+
+    # slots held longer than the timeout are dropped, e.g. of replicas which died
+    later_timestamp_ms = now_timestamp_ms + slot_timeout_ms + 1
+    assert await usage_storage.try_acquire_slot("client-a", slot_ids[3], 2, later_timestamp_ms, slot_timeout_ms)
+    assert await redis_client.zrange(slots_key, 0, -1) == [slot_ids[3].encode()]
+    print("Concurrency slots: OK")
+
+
+async def main():
+    """Run the tests."""
+    await test_used_tokens()
+    await test_theoretical_arrival_time()
+    await test_gcra_rollback()
+    await test_concurrency_slots()
+
+
+asyncio.run(main())